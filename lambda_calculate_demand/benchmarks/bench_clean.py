@@ -0,0 +1,54 @@
+"""
+Compares the throughput of clean_active_flights with the former cleaning steps (format_time_values, which converts
+and sorts, then drop_cancelled_flights and drop_stale_flights, each taking a filtered copy).
+
+    python -m benchmarks.bench_clean --flights 10000 100000 1000000
+
+run from the lambda_calculate_demand directory.
+"""
+import argparse
+import time
+from datetime import datetime, timezone
+
+from benchmarks.synthetic import generate_active_flight_frame
+from dependencies.utils.dynamodb_utils import clean_active_flights, format_time_values, drop_cancelled_flights, \
+    drop_stale_flights, cancel_triggers
+
+
+def legacy_clean(active_flights_df, now):
+    active_flights_df = format_time_values(active_flights_df.copy())  # the former function converted in place
+    return drop_stale_flights(drop_cancelled_flights(active_flights_df, cancel_triggers), now)
+
+
+def _best_time(clean, active_flights, now, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cleaned = clean(active_flights, now)
+        timings.append(time.perf_counter() - start)
+    return cleaned, min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flights', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    now = datetime.now(timezone.utc)
+    for n_flights in args.flights:
+        active_flights = generate_active_flight_frame(n_flights, now=now)
+        legacy, legacy_time = _best_time(legacy_clean, active_flights, now, args.repeat)
+        kernel, kernel_time = _best_time(clean_active_flights, active_flights, now, args.repeat)
+        ordered, ordered_time = _best_time(lambda flights, run_time: clean_active_flights(flights, run_time, True),
+                                           active_flights, now, args.repeat)
+
+        assert sorted(kernel.index) == sorted(legacy.index) == sorted(ordered.index)
+        print(f"flights={n_flights:8d} "
+              f"legacy: {n_flights / legacy_time / 1e6:6.2f} M flights/s | "
+              f"kernel: {n_flights / kernel_time / 1e6:6.2f} M flights/s ({legacy_time / kernel_time:4.1f}x) | "
+              f"kernel ordered: {n_flights / ordered_time / 1e6:6.2f} M flights/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Measures the cold start of the demand Lambda: every run is a fresh interpreter that imports calculate_demand and
+invokes lambda_demand_calculator twice (the cold and a warm invocation), against a local active flights table and
+the local stand-in of the InfluxDB write endpoint.
+
+By default the table lives in moto, inside the measured interpreter. moto imports boto3 itself, so the first
+invocation is then measured without the boto3 import. Pass the url of DynamoDB Local to measure the full cost:
+
+    docker run -p 8000:8000 amazon/dynamodb-local
+    python -m benchmarks.bench_cold_start --endpoint-url http://localhost:8000
+
+To measure in the Lambda base image, build the image of the Dockerfile and run the benchmark with the benchmarks
+directory mounted, e.g.
+
+    docker run --network host -v $PWD/benchmarks:/var/task/benchmarks --entrypoint python3.9 \\
+        lambda_calculate_demand_test -m benchmarks.bench_cold_start --endpoint-url http://localhost:8000
+
+run from the lambda_calculate_demand directory. With --json the medians are written to a file, to compare runs.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+TABLE_NAME = 'ActiveFlightsColdStart'
+AIRPORTS = ['EWR', 'JFK']
+LAMBDA_DIR = Path(__file__).resolve().parent.parent
+
+# runs in the measured interpreter, only the json and time modules are imported before calculate_demand
+_CHILD = r'''
+import json, sys, time
+start = time.perf_counter()
+import calculate_demand
+imported = time.perf_counter()
+
+items_path = sys.argv[1]
+if items_path:
+    import boto3
+    from moto import mock_aws
+    mock_aws().start()
+    table = boto3.resource('dynamodb', region_name='us-east-1').create_table(
+        TableName=calculate_demand.DB_TABLE, KeySchema=[{'AttributeName': 'flight_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'flight_id', 'AttributeType': 'S'}], BillingMode='PAY_PER_REQUEST')
+    with open(items_path) as items_file, table.batch_writer() as batch:
+        for item in json.load(items_file):
+            batch.put_item(Item=item)
+
+ready = time.perf_counter()
+calculate_demand.lambda_demand_calculator({}, None)
+first = time.perf_counter()
+calculate_demand.lambda_demand_calculator({}, None)
+warm = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_invocation': first - ready, 'warm_invocation': warm - first}))
+'''
+
+
+def _run_child(env, items_path):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', _CHILD, items_path or ''], cwd=LAMBDA_DIR, env=env,
+                            capture_output=True, text=True, check=True)
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['process'] = time.perf_counter() - start
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flights', type=int, default=2000)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--endpoint-url', default=None, help='DynamoDB Local url, moto is used when omitted')
+    parser.add_argument('--json', default=None, help='file the median timings are written to')
+    args = parser.parse_args()
+
+    from aerology_influxdb_api.testing import InfluxStub
+    from benchmarks.synthetic import generate_active_flight_items
+
+    items = generate_active_flight_items(args.flights, AIRPORTS)
+    env = dict(os.environ, DYNAMODB_TABLE=TABLE_NAME, AWS_DEFAULT_REGION='us-east-1')
+    env.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+    with InfluxStub() as stub, tempfile.TemporaryDirectory() as directory:
+        airports = [{"short_name": airport, "influx_bucket": "aerology.test", "lane_names": []} for airport in AIRPORTS]
+        env['INFLUX_CONFIG_PATH'] = stub.write_config(Path(directory) / 'config.json', airports=airports)
+
+        table = None
+        items_path = None
+        if args.endpoint_url:
+            import boto3
+            from benchmarks.synthetic import create_active_flights_table
+            env['AWS_ENDPOINT_URL_DYNAMODB'] = args.endpoint_url
+            dynamodb = boto3.resource('dynamodb', region_name='us-east-1', endpoint_url=args.endpoint_url)
+            table = create_active_flights_table(dynamodb, TABLE_NAME, items)
+        else:
+            items_path = str(Path(directory) / 'items.json')
+            with open(items_path, 'w') as items_file:
+                json.dump(items, items_file)
+
+        try:
+            runs = [_run_child(env, items_path) for _ in range(args.runs)]
+        finally:
+            if table is not None:
+                table.delete()
+
+    medians = {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+    print(f"runs={args.runs} flights={args.flights} " +
+          " | ".join(f"{name}: {seconds * 1000:7.1f} ms" for name, seconds in medians.items()))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'flights': args.flights, 'runs': args.runs, 'median_seconds': medians}, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
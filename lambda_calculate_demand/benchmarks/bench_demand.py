@@ -0,0 +1,54 @@
+"""
+Compares the demand aggregation with the former floor + groupby count, and the cost of the 15/30/60 minute demand
+computed in one pass with the hourly demand alone.
+
+    python -m benchmarks.bench_demand --flights 10000 100000 1000000
+
+run from the lambda_calculate_demand directory.
+"""
+import argparse
+import time
+from datetime import datetime, timezone
+
+from benchmarks.synthetic import generate_active_flight_frame
+from dependencies.utils.dynamodb_utils import clean_active_flights
+from dependencies.utils.flight_msg_utils import calculate_demand_from_flights, calculate_demands_from_flights
+
+
+def groupby_demand(active_flights, now):
+    active_flights = active_flights.copy(deep=False)
+    active_flights['scheduled_landing_hour'] = active_flights.sched_landing_time.dt.floor('h')
+    demand_by_hour = active_flights.groupby('scheduled_landing_hour').count()['sched_landing_time'].reset_index()
+    demand_by_hour.columns = ['valid_time', 'demand']
+    return demand_by_hour
+
+
+def _best_time(aggregate, active_flights, now, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        aggregate(active_flights, now)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flights', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    now = datetime.now(timezone.utc)
+    for n_flights in args.flights:
+        active_flights = clean_active_flights(generate_active_flight_frame(n_flights, now=now), now)
+        timings = {
+            'groupby hourly': _best_time(groupby_demand, active_flights, now, args.repeat),
+            'histogram hourly': _best_time(calculate_demand_from_flights, active_flights, now, args.repeat),
+            'histogram 15/30/60': _best_time(calculate_demands_from_flights, active_flights, now, args.repeat),
+        }
+        print(f"flights={n_flights:8d} " + " | ".join(f"{name}: {seconds * 1000:8.2f} ms"
+                                                        for name, seconds in timings.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Compares the memory and cleaning time of the active flights held as an ActiveFlightBatch with the object-dtype frame
+of the table resource items (Decimal numbers and str values, as the flights were read before the low-level client).
+
+    python -m benchmarks.bench_flight_batch --flights 10000 100000 500000
+
+run from the lambda_calculate_demand directory.
+"""
+import argparse
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import pandas as pd
+
+from benchmarks.synthetic import iter_active_flight_items, iter_low_level_pages
+from dependencies.utils.dynamodb_utils import clean_active_flights, PIPELINE_COLUMNS
+from dependencies.utils.flight_batch import ActiveFlightBatch
+
+
+def _object_frame(n_flights, now):
+    return pd.DataFrame([{name: Decimal(value) if isinstance(value, int) else value for name, value in item.items()
+                          if name in PIPELINE_COLUMNS}
+                         for item in iter_active_flight_items(n_flights, now=now)], dtype=object)
+
+
+def _best_time(clean, flights, now, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        clean(flights, now)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flights', type=int, nargs='+', default=[10000, 100000, 500000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    now = datetime.now(timezone.utc)
+    for n_flights in args.flights:
+        object_frame = _object_frame(n_flights, now)
+        batch = ActiveFlightBatch.concat(ActiveFlightBatch.from_items(page, PIPELINE_COLUMNS)
+                                         for page in iter_low_level_pages(n_flights, now=now))
+
+        object_bytes = object_frame.memory_usage(deep=True).sum()
+        frame_time = _best_time(clean_active_flights, object_frame, now, args.repeat)
+        batch_time = _best_time(clean_active_flights, batch, now, args.repeat)
+        print(f"flights={n_flights:8d} "
+              f"object frame: {object_bytes / 2 ** 20:7.1f} MiB, clean {frame_time * 1000:7.1f} ms | "
+              f"batch: {batch.nbytes / 2 ** 20:6.1f} MiB ({object_bytes / batch.nbytes:4.1f}x smaller), "
+              f"clean {batch_time * 1000:6.1f} ms ({frame_time / batch_time:4.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Compares the lane status query of the InfluxDB handler in the records query mode (a FluxRecord per row, pivoted in
+pandas) with the streaming mode (annotated CSV parsed in chunks to numpy columns, pivoted on integer codes).
+
+The response is served by a local stand-in of the InfluxDB query endpoint: a recorded response (the body of a
+/api/v2/query request saved with curl) or a synthetic lane status history of `--days` days at one minute resolution.
+
+    python -m benchmarks.bench_influx_query --days 1 7 30
+    python -m benchmarks.bench_influx_query --response lane_status_response.csv
+
+run from the lambda_calculate_demand directory.
+"""
+import argparse
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+from aerology_influxdb_api.flux_csv import DEFAULT_CHUNK_ROWS
+from aerology_influxdb_api.testing import InfluxStub, flux_csv_response
+
+LANES = ['runway_04L', 'runway_04R', 'runway_11']
+
+
+def _lane_status_response(days):
+    times = pd.date_range('2023-02-01', periods=days * 24 * 60, freq='min')
+    rng = np.random.default_rng(0)
+    lanes = pd.DataFrame({'_time': times, **{lane: rng.integers(0, 2, len(times)) for lane in LANES}})
+    return flux_csv_response(lanes, 'lane_status').encode('utf-8')
+
+
+def _measure(handler, repeat):
+    start_time, end_time = datetime(2023, 2, 1), datetime(2023, 3, 1)
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frame = handler.query_lane_status('EWR', start_time, end_time)
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    handler.query_lane_status('EWR', start_time, end_time)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(seconds), peak, frame
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, nargs='+', default=[1, 7])
+    parser.add_argument('--response', type=Path, default=None, help='recorded annotated CSV response to serve')
+    parser.add_argument('--chunk-rows', type=int, default=DEFAULT_CHUNK_ROWS)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    responses = [(args.response.name, args.response.read_bytes())] if args.response else \
+        [(f"{days} day(s)", _lane_status_response(days)) for days in args.days]
+
+    with InfluxStub() as stub, tempfile.TemporaryDirectory() as directory:
+        records = InfluxDBHandler(stub.write_config(Path(directory) / 'records.json'))
+        streaming = InfluxDBHandler(stub.write_config(Path(directory) / 'streaming.json', query_mode='streaming',
+                                                      query_chunk_rows=args.chunk_rows))
+        for name, response in responses:
+            stub.respond_to_queries(response)
+            records_seconds, records_peak, expected = _measure(records, args.repeat)
+            streaming_seconds, streaming_peak, result = _measure(streaming, args.repeat)
+            assert np.array_equal(result.drop(columns='valid_time').to_numpy(),
+                                  expected.drop(columns='valid_time').to_numpy(), equal_nan=True)
+            print(f"{name:>12} ({len(response) / 2 ** 20:6.1f} MiB, {len(result):7d} rows) "
+                  f"records: {records_seconds * 1000:8.1f} ms {records_peak / 2 ** 20:7.1f} MiB | "
+                  f"streaming: {streaming_seconds * 1000:8.1f} ms {streaming_peak / 2 ** 20:7.1f} MiB | "
+                  f"speedup={records_seconds / streaming_seconds:5.1f}x")
+
+
+if __name__ == '__main__':
+    main()
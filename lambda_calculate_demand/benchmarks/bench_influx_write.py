@@ -0,0 +1,65 @@
+"""
+Compares writing a demand DataFrame one Point per request (the former push_demand) with the bulk line protocol writer.
+
+The writes go to a local stand-in of the InfluxDB write endpoint, `--latency` adds a delay to every request to mimic
+the round trip to a remote host.
+
+    python -m benchmarks.bench_influx_write --points 1000 10000 --latency 0.002
+
+run from the lambda_calculate_demand directory.
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from influxdb_client import Point
+from influxdb_client.domain.write_precision import WritePrecision
+
+from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+from aerology_influxdb_api.testing import InfluxStub
+
+
+def _demand(n_points):
+    valid_time = pd.date_range('2023-03-24 21:00', periods=n_points, freq='min', tz='UTC')
+    return pd.DataFrame({'valid_time': valid_time, 'demand': np.random.default_rng(0).integers(0, 60, n_points)})
+
+
+def row_by_row(handler, demand):
+    for _, row in demand.iterrows():
+        point = Point('demand').field('demand', row['demand']).time(row['valid_time'], WritePrecision.S)
+        handler._influx_writer.write(bucket='aerology.test', org=handler._config['influx']['org'], record=point,
+                                     write_precision=WritePrecision.S)
+
+
+def bulk(handler, demand):
+    handler.push_demand(demand, 'EWR')
+
+
+def _measure(writer, handler, demand):
+    start = time.perf_counter()
+    writer(handler, demand)
+    return len(demand) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    with InfluxStub(latency=args.latency) as stub, tempfile.TemporaryDirectory() as directory:
+        handler = InfluxDBHandler(stub.write_config(Path(directory) / 'config.json', write_batch_size=args.batch_size))
+        for n_points in args.points:
+            demand = _demand(n_points)
+            row_rate = _measure(row_by_row, handler, demand)
+            bulk_rate = _measure(bulk, handler, demand)
+            print(f"points={n_points:8d} row by row: {row_rate:10.0f} points/s | "
+                  f"bulk: {bulk_rate:10.0f} points/s | speedup={bulk_rate / row_rate:6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
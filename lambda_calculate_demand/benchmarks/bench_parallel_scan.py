@@ -0,0 +1,66 @@
+"""
+Benchmarks query_active_flights with 1, 4 and 16 scan segments against a local stand-in table.
+
+By default the table lives in moto. moto answers in process, so it mostly measures client overhead; for numbers
+closer to the real service start DynamoDB Local and pass its url:
+
+    docker run -p 8000:8000 amazon/dynamodb-local
+    python -m benchmarks.bench_parallel_scan --endpoint-url http://localhost:8000
+
+run from the lambda_calculate_demand directory.
+"""
+import argparse
+import contextlib
+import os
+import time
+
+import boto3
+
+from benchmarks.synthetic import generate_active_flight_items, create_active_flights_table
+from dependencies.utils.dynamodb_utils import query_active_flights, DYNAMODB_REGION
+
+TABLE_NAME = 'ActiveFlightsBenchmark'
+
+
+def _local_dynamodb(endpoint_url):
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    if endpoint_url:
+        # picked up by every boto3 client, including the ones created inside query_active_flights
+        os.environ['AWS_ENDPOINT_URL_DYNAMODB'] = endpoint_url
+        return contextlib.nullcontext()
+
+    from moto import mock_aws
+    return mock_aws()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flights', type=int, default=20000)
+    parser.add_argument('--airports', type=int, default=4, help='airports the flights are spread over')
+    parser.add_argument('--segments', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--endpoint-url', default=None, help='DynamoDB Local url, moto is used when omitted')
+    args = parser.parse_args()
+
+    airports = ['EWR', 'JFK', 'LGA', 'BOS', 'ATL', 'ORD', 'SFO', 'LAX'][:args.airports]
+
+    with _local_dynamodb(args.endpoint_url):
+        dynamodb = boto3.resource('dynamodb', region_name=DYNAMODB_REGION)
+        table = create_active_flights_table(dynamodb, TABLE_NAME,
+                                            generate_active_flight_items(args.flights, airports))
+        try:
+            for total_segments in args.segments:
+                timings = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    flights = query_active_flights(TABLE_NAME, 'EWR', total_segments=total_segments)
+                    timings.append(time.perf_counter() - start)
+                print(f"segments={total_segments:3d} flights={len(flights):7d} "
+                      f"best={min(timings):.3f}s mean={sum(timings) / len(timings):.3f}s")
+        finally:
+            table.delete()
+
+
+if __name__ == '__main__':
+    main()
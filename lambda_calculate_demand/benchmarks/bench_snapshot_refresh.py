@@ -0,0 +1,82 @@
+"""
+Compares a full read of the active flights with a delta refresh of the snapshot cache, after a share of the flights
+got a new message.
+
+By default the table lives in moto, which answers in process and mostly measures the client and decoding work. Pass
+the url of DynamoDB Local for numbers closer to the real service:
+
+    docker run -p 8000:8000 amazon/dynamodb-local
+    python -m benchmarks.bench_snapshot_refresh --endpoint-url http://localhost:8000
+
+run from the lambda_calculate_demand directory.
+"""
+import argparse
+import random
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import boto3
+
+from benchmarks.bench_parallel_scan import _local_dynamodb
+from benchmarks.synthetic import generate_active_flight_items, create_active_flights_table, FLIGHT_KEY
+from dependencies.utils.array_backend import query_active_flights_by_airport
+from dependencies.utils.dynamodb_reader import DYNAMODB_REGION, PIPELINE_COLUMNS
+from dependencies.utils.flight_snapshot import FlightSnapshotCache
+
+TABLE_NAME = 'ActiveFlightsSnapshotBenchmark'
+AIRPORTS = ['EWR', 'JFK', 'LGA', 'BOS']
+
+
+def _update_flights(table, items, share, now, seed=0):
+    """
+    Gives a new message to `share` of the flights, returns the number of updated flights.
+    """
+    updated = random.Random(seed).sample(items, int(len(items) * share))
+    with table.batch_writer() as batch:
+        for item in updated:
+            batch.put_item(Item=dict(item, last_msg_time=int(now.timestamp()) + 60,
+                                     est_arrival_time=item['est_arrival_time'] + 300))
+    return len(updated)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flights', type=int, default=20000)
+    parser.add_argument('--updated', type=float, nargs='+', default=[0.01, 0.05, 0.2],
+                        help='share of the flights updated between two runs')
+    parser.add_argument('--endpoint-url', default=None, help='DynamoDB Local url, moto is used when omitted')
+    args = parser.parse_args()
+
+    now = datetime.now(timezone.utc)
+    items = generate_active_flight_items(args.flights, AIRPORTS, now=now)
+
+    with _local_dynamodb(args.endpoint_url):
+        dynamodb = boto3.resource('dynamodb', region_name=DYNAMODB_REGION)
+        table = create_active_flights_table(dynamodb, TABLE_NAME, items)
+        try:
+            for share in args.updated:
+                with tempfile.TemporaryDirectory() as directory:
+                    cache = FlightSnapshotCache(directory)
+                    columns = PIPELINE_COLUMNS + [FLIGHT_KEY]
+                    cache.query_active_flights_by_airport(TABLE_NAME, AIRPORTS, columns=columns, now=now)
+                    n_updated = _update_flights(table, items, share, now)
+
+                    start = time.perf_counter()
+                    full = query_active_flights_by_airport(TABLE_NAME, AIRPORTS, columns=columns)
+                    full_time = time.perf_counter() - start
+
+                    start = time.perf_counter()
+                    delta = cache.query_active_flights_by_airport(TABLE_NAME, AIRPORTS, columns=columns, now=now)
+                    delta_time = time.perf_counter() - start
+
+                print(f"flights={args.flights:7d} updated={n_updated:6d} "
+                      f"full read: {full_time * 1000:8.1f} ms ({sum(map(len, full.values()))} flights) | "
+                      f"delta refresh: {delta_time * 1000:8.1f} ms ({sum(map(len, delta.values()))} flights, "
+                      f"{full_time / delta_time:4.1f}x)")
+        finally:
+            table.delete()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Compares the peak memory of the batch and the streaming demand pipelines.
+
+The DynamoDB pages are generated in the low-level client format, so both pipelines run the same decode, clean and
+aggregation code as the Lambda does. Peak memory is measured with tracemalloc (numpy and pandas buffers included).
+
+    python -m benchmarks.bench_streaming_memory --flights 100000 250000
+
+run from the lambda_calculate_demand directory.
+"""
+import argparse
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from benchmarks.synthetic import iter_low_level_pages
+from dependencies.utils.dynamodb_utils import clean_active_flights, decode_flight_items, PIPELINE_COLUMNS, \
+    _to_frame_columns
+from dependencies.utils.flight_msg_utils import calculate_demand_from_flights, calculate_demand_from_flight_pages
+
+
+def _frame(items):
+    return pd.DataFrame(_to_frame_columns(decode_flight_items(items, PIPELINE_COLUMNS)), copy=False)
+
+
+def batch_pipeline(n_flights, page_size, now):
+    items = [item for page in iter_low_level_pages(n_flights, page_size, now=now) for item in page]
+    return calculate_demand_from_flights(clean_active_flights(_frame(items), now), now)
+
+
+def streaming_pipeline(n_flights, page_size, now):
+    flight_pages = (_frame(items) for items in iter_low_level_pages(n_flights, page_size, now=now))
+    return calculate_demand_from_flight_pages((clean_active_flights(page, now) for page in flight_pages), now)
+
+
+def _measure(pipeline, n_flights, page_size, now):
+    tracemalloc.start()
+    start = time.perf_counter()
+    demand = pipeline(n_flights, page_size, now)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return demand, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flights', type=int, nargs='+', default=[100000])
+    parser.add_argument('--page-size', type=int, default=2500)
+    args = parser.parse_args()
+
+    # both pipelines get the same flights and the same stale cutoff
+    now = datetime.now(timezone.utc)
+    for n_flights in args.flights:
+        batch, batch_time, batch_peak = _measure(batch_pipeline, n_flights, args.page_size, now)
+        streamed, streaming_time, streaming_peak = _measure(streaming_pipeline, n_flights, args.page_size, now)
+
+        pd.testing.assert_frame_equal(streamed, batch, check_dtype=False)
+        print(f"flights={n_flights:8d} "
+              f"batch: peak={batch_peak / 2 ** 20:8.1f} MiB time={batch_time:6.2f}s | "
+              f"streaming: peak={streaming_peak / 2 ** 20:8.1f} MiB time={streaming_time:6.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Replays captured runs (see `flight_capture`) through the cleaning, the demand calculation and the InfluxDB handler
+writing to the local stand-in of the write endpoint, without AWS.
+
+Captures are written by the Lambda when CAPTURE_DIRECTORY is set, or by `query_active_flights(capture_path=...)`.
+Pass capture directories, or a directory holding many (e.g. the captures of a day), which are replayed in order:
+
+    python -m benchmarks.replay_captures captures/ActiveFlightsStaging --backend numpy
+    python -m benchmarks.replay_captures captures/ActiveFlightsStaging/20230324T213000 --repeat 5 --no-write
+
+run from the lambda_calculate_demand directory. To capture a synthetic input of production size instead:
+
+    python -m benchmarks.replay_captures /tmp/captures --generate 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from dependencies.utils import array_backend, pandas_backend
+from dependencies.utils.flight_capture import iter_flight_captures, read_flight_capture, replay_flight_capture, \
+    write_flight_capture, capture_path
+
+BACKENDS = {'numpy': array_backend, 'pandas': pandas_backend}
+
+
+def _capture_paths(paths):
+    for path in paths:
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            yield path
+        else:
+            yield from iter_flight_captures(path)
+
+
+def _generate_capture(directory, n_flights):
+    from benchmarks.synthetic import generate_active_flight_frame
+    from dependencies.utils.flight_batch import ActiveFlightBatch
+
+    now = datetime.now(timezone.utc)
+    airports = ['EWR', 'JFK', 'LGA', 'BOS']
+    path = capture_path(directory, 'ActiveFlightsSynthetic', now)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    flights = ActiveFlightBatch.from_frame(generate_active_flight_frame(n_flights, airports, now=now))
+    write_flight_capture(flights, path, 'ActiveFlightsSynthetic', airports, now)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='capture directories, or directories of captures')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='pandas')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-mmap', action='store_true', help='read the captures into memory')
+    parser.add_argument('--no-write', action='store_true', help='skip the InfluxDB handler')
+    parser.add_argument('--generate', type=int, default=None, metavar='FLIGHTS',
+                        help='first write a synthetic capture of this many flights to the (first) path')
+    args = parser.parse_args()
+
+    if args.generate:
+        print(f"generated {_generate_capture(args.paths[0], args.generate)}")
+
+    from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+    from aerology_influxdb_api.testing import InfluxStub
+
+    backend = BACKENDS[args.backend]
+    with InfluxStub() as stub, tempfile.TemporaryDirectory() as directory:
+        handler = None
+        totals = {'captures': 0, 'flights': 0, 'replay': 0.0, 'write': 0.0}
+        for path in _capture_paths(args.paths):
+            flights, meta = read_flight_capture(path, mmap=not args.no_mmap)
+            airports = meta['airports'] or []
+            if handler is None and not args.no_write:
+                handler = InfluxDBHandler(stub.write_config(
+                    Path(directory) / 'config.json',
+                    airports=[{"short_name": airport, "influx_bucket": "aerology.replay", "lane_names": []}
+                              for airport in airports]))
+
+            replay_times = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                demands = replay_flight_capture(path, backend, mmap=not args.no_mmap)
+                replay_times.append(time.perf_counter() - start)
+
+            write_time = 0.0
+            if handler is not None and set(airports) <= set(handler.get_airport_names()):
+                start = time.perf_counter()
+                handler.push_demands(demands)
+                write_time = time.perf_counter() - start
+
+            totals['captures'] += 1
+            totals['flights'] += len(flights)
+            totals['replay'] += min(replay_times)
+            totals['write'] += write_time
+            print(f"{path}: flights={len(flights):8d} airports={len(airports):3d} "
+                  f"replay: {min(replay_times) * 1000:8.1f} ms | write: {write_time * 1000:7.1f} ms | "
+                  f"demand: {sum(int(sum(demand['demand'])) for demand in demands.values())} flights")
+
+        print(f"{totals['captures']} capture(s), {totals['flights']} flights, backend {args.backend}: "
+              f"replay {totals['replay']:.3f} s, write {totals['write']:.3f} s, {len(stub.lines)} points written")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Benchmark suite of the demand pipeline, stage by stage, with machine-readable results to track regressions between
+releases.
+
+For every number of synthetic active flights (see `synthetic`, items in the low-level DynamoDB format of the
+ActiveFlights table, with the cancel triggers and stale departure time types) the suite times:
+
+    items_to_frame / items_to_batch     decoding the read items to a DataFrame (pandas) or ActiveFlightBatch (numpy)
+    clean_active_flights[backend]       dropping the cancelled and stale flights
+    calculate_demand[backend]           the hourly demand of the cleaned flights
+    push_*                              every InfluxDBHandler.push_* with as many points as flights (the capacity
+                                        vector is capped at a day of minutes), against a local write stand-in
+
+The best time of `--repeat` runs is reported. Results are written as JSON (`--output`, stdout by default), and compared
+with the results of a previous release with `--compare`, which exits with status 1 when a stage got slower by more
+than `--threshold`:
+
+    python -m benchmarks.suite --flights 1000 10000 100000 1000000 --output results/1.4.0.json
+    python -m benchmarks.suite --output results/head.json --compare results/1.4.0.json
+
+run from the lambda_calculate_demand directory.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import iter_low_level_pages
+from dependencies.utils import array_backend, pandas_backend
+from dependencies.utils.dynamodb_reader import PIPELINE_COLUMNS, decode_flight_items
+from dependencies.utils.dynamodb_utils import _to_frame_columns
+from dependencies.utils.flight_batch import ActiveFlightBatch
+
+SUITE_VERSION = 1
+DEFAULT_FLIGHTS = [1000, 10000, 100000, 1000000]
+AIRPORTS = ['EWR', 'JFK', 'LGA', 'BOS']
+LANES = ['runway_04L', 'runway_04R', 'runway_11']
+MAX_VECTOR_LENGTH = 24 * 60
+
+
+def _best_time(function, repeat):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return min(seconds), float(np.mean(seconds))
+
+
+def pipeline_stages(items, now):
+    """(stage name, function) of the read, cleaning and demand stages of both backends"""
+    frame = pd.DataFrame(_to_frame_columns(decode_flight_items(items, PIPELINE_COLUMNS)), copy=False)
+    batch = ActiveFlightBatch.from_items(items, PIPELINE_COLUMNS)
+    cleaned_frame = pandas_backend.clean_active_flights(frame, now)
+    cleaned_batch = array_backend.clean_active_flights(batch, now)
+    return [
+        ('items_to_frame',
+         lambda: pd.DataFrame(_to_frame_columns(decode_flight_items(items, PIPELINE_COLUMNS)), copy=False)),
+        ('items_to_batch', lambda: ActiveFlightBatch.from_items(items, PIPELINE_COLUMNS)),
+        ('clean_active_flights[pandas]', lambda: pandas_backend.clean_active_flights(frame, now)),
+        ('clean_active_flights[numpy]', lambda: array_backend.clean_active_flights(batch, now)),
+        ('calculate_demand[pandas]', lambda: pandas_backend.calculate_demand_from_flights(cleaned_frame, now)),
+        ('calculate_demand[numpy]', lambda: array_backend.calculate_demand_from_flights(cleaned_batch, now)),
+    ]
+
+
+def push_stages(handler, n_points, now):
+    """(stage name, function) of every push of the InfluxDB handler, with `n_points` points each"""
+    rng = np.random.default_rng(0)
+    times = pd.date_range(now.replace(tzinfo=None), periods=n_points, freq='min')
+    demand = pd.DataFrame({'valid_time': times, 'demand': rng.integers(0, 60, n_points)})
+    demands = {airport: demand.iloc[i::len(AIRPORTS)] for i, airport in enumerate(AIRPORTS)}
+    predictions = pd.DataFrame({'predicted_time': times, 'predicted_capacity': rng.integers(20, 60, n_points),
+                                'prediction_variance': rng.random(n_points) * 5,
+                                'init_time': times.floor('h').strftime('%Y-%m-%d %H:%M:%S'),
+                                'model_id': np.array(['model_a', 'model_b'])[np.arange(n_points) % 2]})
+    capacity = pd.DataFrame({'time': times, 'capacity': rng.integers(20, 60, n_points)})
+    lanes = pd.DataFrame({'status_time': times, **{lane: rng.integers(0, 2, n_points) for lane in LANES}})
+    calculations = {'_time': times, 'predicted_delay': rng.random(n_points) * 30,
+                    'published_delay': rng.random(n_points) * 30,
+                    'flight_id': [f"FL{i:08d}" for i in range(n_points)],
+                    'eta_hour': times.hour, 'slt_hour': times.hour}
+    vector = capacity.iloc[:MAX_VECTOR_LENGTH]
+    return [
+        ('push_demand', lambda: handler.push_demand(demand, 'EWR')),
+        ('push_demands', lambda: handler.push_demands(demands)),
+        ('push_capacity_predictions', lambda: handler.push_capacity_predictions(predictions, 'EWR')),
+        ('push_capacity_measurements', lambda: handler.push_capacity_measurements(capacity, 'EWR')),
+        ('push_vectoral_capacity_measurements',
+         lambda: handler.push_vectoral_capacity_measurements(vector, now, 'EWR', 'APTC')),
+        ('push_lane_status', lambda: handler.push_lane_status(lanes, 'EWR')),
+        ('push_flight_calculations', lambda: handler.push_flight_calculations(calculations, 'EWR')),
+    ]
+
+
+def run_suite(flights=DEFAULT_FLIGHTS, repeat=3, stages=None, log=print):
+    """
+    Runs the suite, returns the results as a dict (see the module documentation), `stages` restricts the stages run
+    to the given names.
+    """
+    from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+    from aerology_influxdb_api.testing import InfluxStub
+
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    results = []
+    with InfluxStub() as stub, tempfile.TemporaryDirectory() as directory:
+        handler = InfluxDBHandler(stub.write_config(
+            Path(directory) / 'config.json',
+            airports=[{"short_name": airport, "influx_bucket": "aerology.benchmark", "lane_names": LANES}
+                      for airport in AIRPORTS]))
+        for n_flights in flights:
+            items = [item for page in iter_low_level_pages(n_flights, airports=AIRPORTS, now=now) for item in page]
+            for name, function in pipeline_stages(items, now) + push_stages(handler, n_flights, now):
+                if stages and name not in stages:
+                    continue
+                best, mean = _best_time(function, repeat)
+                results.append({'stage': name, 'flights': n_flights, 'seconds': best, 'mean_seconds': mean,
+                                'flights_per_second': n_flights / best if best > 0 else None})
+                log(f"{name:>38} flights={n_flights:8d} {best * 1000:10.2f} ms")
+                stub.requests.clear()  # the recorded writes would hold every line written
+        handler.close()
+
+    return {'suite_version': SUITE_VERSION,
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'commit': _git_commit(),
+            'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                            'numpy': np.__version__, 'pandas': pd.__version__},
+            'repeat': repeat,
+            'results': results}
+
+
+def compare_results(results, baseline, threshold=0.2, min_seconds=0.001):
+    """
+    Compares the stages of two suite results, returns (stage, flights, baseline seconds, seconds, relative change)
+    of the stages slower than the baseline by more than `threshold` (0.2 is 20% slower) and by more than
+    `min_seconds`, below which the timings are mostly noise.
+    """
+    baseline_seconds = {(result['stage'], result['flights']): result['seconds'] for result in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        before = baseline_seconds.get((result['stage'], result['flights']))
+        if before and result['seconds'] > before * (1 + threshold) and result['seconds'] - before > min_seconds:
+            regressions.append((result['stage'], result['flights'], before, result['seconds'],
+                                result['seconds'] / before - 1))
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flights', type=int, nargs='+', default=DEFAULT_FLIGHTS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', nargs='+', default=None, help='only run these stages')
+    parser.add_argument('--output', type=Path, default=None, help='JSON file of the results, stdout by default')
+    parser.add_argument('--compare', type=Path, default=None, help='JSON results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown reported as a regression')
+    parser.add_argument('--min-seconds', type=float, default=0.001,
+                        help='slowdowns smaller than this are not reported')
+    args = parser.parse_args()
+
+    results = run_suite(args.flights, args.repeat, args.stages, log=lambda line: print(line, file=sys.stderr))
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(results, indent=2) + '\n')
+
+    if args.compare is not None:
+        regressions = compare_results(results, json.loads(args.compare.read_text()), args.threshold,
+                                      args.min_seconds)
+        for stage, n_flights, before, after, change in regressions:
+            print(f"regression: {stage} flights={n_flights} {before * 1000:.2f} ms -> {after * 1000:.2f} ms "
+                  f"(+{change:.0%})", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
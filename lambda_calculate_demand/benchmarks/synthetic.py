@@ -0,0 +1,136 @@
+"""
+Synthetic active flights, shaped like the items of the ActiveFlights DynamoDB table.
+"""
+import random
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+from boto3.dynamodb.types import TypeSerializer
+
+FLIGHT_KEY = 'flight_id'
+ETD_TYPES = ['ACTUAL', 'ESTIMATED', 'SCHEDULED', 'PROPOSED']
+MSG_TRIGGERS = ['HCS_TRACK_MSG', 'FD_FLIGHT_AMENDMENT_MSG', 'FD_FLIGHT_PLAN_MSG', 'FD_DEPARTURE_MSG',
+                'FD_FLIGHT_CANCEL_MSG', 'UPDATE_CANCEL_TIMEOUT']
+CANCEL_SHARE = 0.03  # share of flights carrying a cancel trigger
+
+_serializer = TypeSerializer()
+
+
+def generate_active_flight_items(n_flights, airports=('EWR',), now=None, seed=0):
+    """
+    Generates `n_flights` active flight items with unix timestamps, as they are stored in DynamoDB.
+
+    Parameters
+    ----------
+    See `iter_active_flight_items`.
+
+    Returns
+    -------
+    list of dict
+    """
+    return list(iter_active_flight_items(n_flights, airports, now, seed))
+
+
+def iter_active_flight_items(n_flights, airports=('EWR',), now=None, seed=0):
+    """
+    Yields `n_flights` active flight items with unix timestamps, as they are stored in DynamoDB.
+
+    Parameters
+    ----------
+    n_flights: int
+    airports: sequence of str, destination airports the flights are spread over
+    now: datetime, optional, the run time the flights are generated around, defaults to the current time
+    seed: int
+
+    Yields
+    ------
+    dict
+    """
+    rng = random.Random(seed)
+    now = int((now or datetime.now(timezone.utc)).timestamp())
+
+    for i in range(n_flights):
+        sched_landing = now + rng.randint(-2 * 3600, 24 * 3600)
+        est_arrival = sched_landing + rng.randint(-20 * 60, 90 * 60)
+        duration = rng.randint(3600, 6 * 3600)
+        if rng.random() < CANCEL_SHARE:
+            msg_trigger = rng.choice(MSG_TRIGGERS[4:])
+        else:
+            msg_trigger = rng.choice(MSG_TRIGGERS[:4])
+
+        yield {
+            FLIGHT_KEY: f"FL{i:08d}",
+            'airport': airports[i % len(airports)],
+            'msg_trigger': msg_trigger,
+            'est_dept_time_type': rng.choice(ETD_TYPES),
+            'sched_dept_time': sched_landing - duration,
+            'est_dept_time': est_arrival - duration,
+            'sched_landing_time': sched_landing,
+            'est_arrival_time': est_arrival,
+            'last_msg_time': now - rng.randint(0, 3 * 3600),
+            'flight_creation_time': now - rng.randint(12 * 3600, 36 * 3600),
+        }
+
+
+def iter_low_level_pages(n_flights, page_size=2500, airports=('EWR',), now=None, seed=0):
+    """
+    Yields the flights in the low-level client format, `page_size` items at a time, like the pages of a scan.
+
+    2500 items is about the 1 MB DynamoDB page of these items.
+    """
+    page = []
+    for item in iter_active_flight_items(n_flights, airports, now, seed):
+        page.append({name: _serializer.serialize(value) for name, value in item.items()})
+        if len(page) == page_size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def generate_active_flight_frame(n_flights, airports=('EWR',), now=None, seed=0):
+    """
+    Generates `n_flights` active flights directly as a decoded frame (see `decode_flight_items`): int64 epoch
+    seconds and categorical columns, with the same distributions as `iter_active_flight_items`.
+
+    Much faster than decoding generated items, for benchmarks of the steps after the read.
+    """
+    rng = np.random.default_rng(seed)
+    now = int((now or datetime.now(timezone.utc)).timestamp())
+
+    sched_landing = now + rng.integers(-2 * 3600, 24 * 3600, n_flights, endpoint=True)
+    est_arrival = sched_landing + rng.integers(-20 * 60, 90 * 60, n_flights, endpoint=True)
+    duration = rng.integers(3600, 6 * 3600, n_flights, endpoint=True)
+    cancelled = rng.random(n_flights) < CANCEL_SHARE
+    trigger_codes = np.where(cancelled, rng.integers(4, len(MSG_TRIGGERS), n_flights), rng.integers(0, 4, n_flights))
+
+    return pd.DataFrame({
+        'sched_dept_time': sched_landing - duration,
+        'est_dept_time': est_arrival - duration,
+        'sched_landing_time': sched_landing,
+        'est_arrival_time': est_arrival,
+        'last_msg_time': now - rng.integers(0, 3 * 3600, n_flights, endpoint=True),
+        'flight_creation_time': now - rng.integers(12 * 3600, 36 * 3600, n_flights, endpoint=True),
+        'msg_trigger': pd.Categorical.from_codes(trigger_codes, MSG_TRIGGERS),
+        'est_dept_time_type': pd.Categorical.from_codes(rng.integers(0, len(ETD_TYPES), n_flights), ETD_TYPES),
+        'airport': pd.Categorical.from_codes(np.arange(n_flights) % len(airports), list(airports)),
+    })
+
+
+def create_active_flights_table(dynamodb, table_name, items=()):
+    """
+    Creates an on-demand active flights table on the given boto3 resource (moto or DynamoDB Local) and loads `items`.
+    """
+    table = dynamodb.create_table(
+        TableName=table_name,
+        KeySchema=[{'AttributeName': FLIGHT_KEY, 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': FLIGHT_KEY, 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    table.wait_until_exists()
+
+    with table.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+    return table
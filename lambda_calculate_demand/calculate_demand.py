@@ -1,33 +1,71 @@
+import json
 import logging
 import os
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
-import pandas as pd
-import boto3
-from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
-from botocore.config import Config
-from boto3.dynamodb.conditions import Key
+from dependencies.utils import instrumentation
 
-from dependencies.utils.flight_msg_utils import calculate_demand_from_flights
-from dependencies.utils.dynamodb_utils import query_active_flights, format_time_values,clean_active_flights
+# the heavy imports (pandas, numpy, boto3, influxdb_client) are done inside the handlers, and the clients are created
+# on first use, so the module loads fast and the work is only done for the paths that are invoked
 
 # db access constants:
 LOGGING_LEVEL = logging.INFO  # default logging level
-DB_TABLE = os.environ.get('DYNAMODB_TABLE')  # table to use, created by the sam template
-DYNAMODB_CONFIG = Config(connect_timeout=5, read_timeout=10, retries={'max_attempts': 10})  # config for dynamoDB conn
+DB_TABLE = os.environ.get('DYNAMODB_TABLE', 'ActiveFlightsStaging')  # table to use, created by the sam template
+DB_SCAN_SEGMENTS = int(os.environ.get('DYNAMODB_SCAN_SEGMENTS', 1))  # parallel scan segments of the flights table
+DEMAND_STREAMING = os.environ.get('DEMAND_STREAMING', '0') == '1'  # reduce the flights page by page
+AIRPORT_WORKERS = int(os.environ.get('AIRPORT_WORKERS', 4))  # airports cleaned and aggregated concurrently
+DEMAND_STATE_BUCKET = os.environ.get('DEMAND_STATE_BUCKET', '')  # S3 bucket of the incremental demand states
+DEMAND_STATE_DIRECTORY = os.environ.get('DEMAND_STATE_DIRECTORY', '/tmp/demand_state')  # without a bucket, local runs
+DEMAND_STATE_MAX_AGE_HOURS = float(os.environ.get('DEMAND_STATE_MAX_AGE_HOURS', 6))  # re-seed from a full read after
+DEMAND_STATE_RETRIES = 5  # saves of a state attempted when other invocations save it at the same time
+INFLUX_CONFIG_PATH = os.environ.get('INFLUX_CONFIG_PATH', './res/config.json')  # influxdb settings and airports
+DEMAND_BACKEND = os.environ.get('DEMAND_BACKEND', 'pandas')  # 'numpy' calculates the demand without pandas
+SNAPSHOT_DIRECTORY = os.environ.get('SNAPSHOT_DIRECTORY', '')  # flight snapshots with delta reads, e.g. under /tmp
+CAPTURE_DIRECTORY = os.environ.get('CAPTURE_DIRECTORY', '')  # captures of the flights read, for offline replay
+PIPELINE_METRICS = os.environ.get('PIPELINE_METRICS', '0') == '1'  # per stage metrics, as EMF and to influxDB
 
 # globals
 _logger = logging.getLogger()  # logger handle
 _logger.setLevel(LOGGING_LEVEL)
-_influxdb_client = InfluxDBHandler('./res/config.json')  # influxdb handle
+_influxdb_client = None  # influxdb handle, created on first use and kept across warm invocations
+_snapshot_cache = None  # snapshot cache of the active flights, when SNAPSHOT_DIRECTORY is set
 
-_dynamodb_resource = boto3.resource('dynamodb', config=DYNAMODB_CONFIG)
-_db_table = _dynamodb_resource.Table(DB_TABLE)
+
+def _get_influxdb_client():
+    global _influxdb_client
+    if _influxdb_client is None:
+        from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+        _influxdb_client = InfluxDBHandler(INFLUX_CONFIG_PATH)
+    return _influxdb_client
+
+
+def _get_snapshot_cache():
+    global _snapshot_cache
+    if _snapshot_cache is None:
+        from dependencies.utils.flight_snapshot import FlightSnapshotCache
+        _snapshot_cache = FlightSnapshotCache(SNAPSHOT_DIRECTORY)
+    return _snapshot_cache
+
+
+def _demand_backend():
+    """
+    The module calculating the demand, selected by DEMAND_BACKEND. Both give the same demand.
+    """
+    if DEMAND_BACKEND == 'numpy':
+        from dependencies.utils import array_backend
+        return array_backend
+    if DEMAND_BACKEND != 'pandas':
+        raise ValueError(f"unknown DEMAND_BACKEND {DEMAND_BACKEND}, expected 'pandas' or 'numpy'")
+    from dependencies.utils import pandas_backend
+    return pandas_backend
 
 
 def lambda_demand_calculator(event, context):
     """lambda function that on a schedule processes capacity messages from s3 into dynamoDB
 
+    Calculates the demand of every configured airport, or of the airports listed under 'airports' in the event.
+
     Parameters
     ----------
     event: dict, required
@@ -43,21 +81,252 @@ def lambda_demand_calculator(event, context):
     API Gateway Lambda Proxy Output Format: dict
         Return doc: https://docs.aws.amazon.com/apigateway/latest/developerguide/set-up-lambda-proxy-integrations.html
     """
-    _ = event, context
+    _ = context
+    # the DynamoDB client is created on the first read and reused by the warm invocations
+    backend = _demand_backend()
+    influxdb_client = _get_influxdb_client()
+    airports = _requested_airports(event)
+    if not airports:
+        _logger.warning("no configured airport to calculate the demand of, nothing to do.")
+        return {"statusCode": 200}
+    run_time = datetime.now(timezone.utc)  # one stale cutoff for all the airports and pages
 
-    _logger.info(f"querying flights ...")
-    active_flights = query_active_flights('ActiveFlightsStaging', 'EWR')
-    _logger.info(f"loaded {len(active_flights)} flights.")
+    metrics = instrumentation.start_run(Function='lambda_demand_calculator') if PIPELINE_METRICS else None
+    try:
+        _calculate_and_push_demands(backend, influxdb_client, airports, run_time)
+    finally:
+        if metrics is not None:
+            instrumentation.finish_run()
+            _publish_metrics(metrics, influxdb_client, airports, run_time)
 
-    _logger.info(f"Cleaning active flights.")
-    active_flights = clean_active_flights(active_flights)
+    return {"statusCode": 200}
 
-    demand = calculate_demand_from_flights(active_flights)
+
+def _calculate_and_push_demands(backend, influxdb_client, airports, run_time):
+    from dependencies.utils.demand_histogram import horizon_start
+
+    # the points written by the previous runs from the start of the horizon on are replaced
+    start = datetime.fromtimestamp(horizon_start(run_time), timezone.utc)
+    if DEMAND_STREAMING:
+        _logger.info(f"streaming flights of {', '.join(airports)} ...")
+        demands = _stream_demands(backend, airports, run_time)
+    else:
+        _logger.info(f"querying flights of {', '.join(airports)} ...")
+        capture_path = _capture_path(run_time)
+        with instrumentation.stage('read') as read:
+            if SNAPSHOT_DIRECTORY:
+                # only the flights updated since the previous run are read, the cleaning and demand take the batches
+                flights_by_airport = _get_snapshot_cache().query_active_flights_by_airport(
+                    DB_TABLE, airports, total_segments=DB_SCAN_SEGMENTS, columns=backend.PIPELINE_COLUMNS,
+                    now=run_time, capture_path=capture_path)
+            else:
+                flights_by_airport = backend.query_active_flights_by_airport(DB_TABLE, airports,
+                                                                             total_segments=DB_SCAN_SEGMENTS,
+                                                                             columns=backend.PIPELINE_COLUMNS,
+                                                                             capture_path=capture_path,
+                                                                             run_time=run_time)
+            read.add(rows_out=sum(len(flights) for flights in flights_by_airport.values()))
+
+        _logger.info(f"Cleaning active flights.")
+        demands = _map_airports(lambda airport: _airport_demand(backend, flights_by_airport[airport], run_time),
+                                airports)
+
+    if not influxdb_client.asynchronous:
+        demands = list(demands)  # calculated before the 'write' stage starts
 
     _logger.info(f"pushing results to influxDB..")
-    _influxdb_client.push_demand(data = demand, airport = 'EWR')
+    with instrumentation.stage('write') as write:
+        before = dict(influxdb_client.write_stats)
+        if influxdb_client.asynchronous:
+            # every demand is queued as soon as its airport is done, and written while the next ones are calculated
+            for airport, demand in demands:
+                influxdb_client.push_demand(data=demand, airport=airport, horizon_start=start)
+            influxdb_client.flush()
+        else:
+            influxdb_client.push_demands(dict(demands), horizon_start=start)
+        after = influxdb_client.write_stats
+        write.add(points=after['points'] - before['points'], requests=after['requests'] - before['requests'],
+                  skipped_points=after['skipped'] - before['skipped'])
     _logger.info(f"successfully pushed results to influxDB.")
 
+
+def _airport_demand(backend, flights, run_time):
+    with instrumentation.stage('clean') as clean:
+        cleaned_flights = backend.clean_active_flights(flights, run_time)
+        clean.add(rows_in=len(flights), rows_out=len(cleaned_flights))
+    with instrumentation.stage('demand') as aggregate:
+        demand = backend.calculate_demand_from_flights(cleaned_flights, run_time)
+        aggregate.add(rows_in=len(cleaned_flights), rows_out=len(demand['demand']))
+    return demand
+
+
+def _publish_metrics(metrics, influxdb_client, airports, run_time):
+    """
+    Writes the metrics of the run as one CloudWatch Embedded Metric Format line to stdout and pushes them to
+    influxDB. A failed push is logged, it does not fail the run.
+    """
+    print(json.dumps(metrics.emf_record(run_time=run_time.isoformat(), airports=airports, backend=DEMAND_BACKEND)),
+          flush=True)
+    try:
+        influxdb_client.push_run_metrics(metrics.stages, run_time, tags={'function': 'lambda_demand_calculator'})
+        influxdb_client.flush()
+    except Exception as error:
+        _logger.warning(f"could not push the run metrics to influxDB: {error}")
+
+
+def _capture_path(run_time):
+    """
+    Capture directory of the flights read by the run, None when CAPTURE_DIRECTORY is not set.
+    """
+    if not CAPTURE_DIRECTORY:
+        return None
+    from dependencies.utils.flight_capture import capture_path
+    return capture_path(CAPTURE_DIRECTORY, DB_TABLE, run_time)
+
+
+def _requested_airports(event):
+    """
+    The airports of the run: the 'airports' list of the event, or every airport of the configuration. The names of
+    the event are matched without case, as by the InfluxDBHandler, and returned as configured.
+    """
+    configured_airports = {airport.casefold(): airport for airport in _get_influxdb_client().get_airport_names()}
+    requested_airports = (event or {}).get('airports') or list(configured_airports.values())
+
+    unknown_airports = [airport for airport in requested_airports if airport.casefold() not in configured_airports]
+    if unknown_airports:
+        _logger.warning(f"skipping airport(s) without configuration: {', '.join(sorted(unknown_airports))}")
+    airports = [configured_airports[airport.casefold()] for airport in requested_airports
+                if airport.casefold() in configured_airports]
+    return list(dict.fromkeys(airports))
+
+
+def _map_airports(calculate_demand, airports):
+    """
+    Runs the per-airport demand calculation on a thread pool, yields (airport, demand) in the order of the airports
+    as soon as each demand is ready.
+    """
+    with ThreadPoolExecutor(max_workers=min(AIRPORT_WORKERS, len(airports)) or 1) as executor:
+        yield from zip(airports, executor.map(calculate_demand, airports))
+
+
+def _stream_demands(backend, airports, run_time):
+    """
+    The demand of the airports from one streamed read of the table, every page is cleaned once and split by airport.
+    Yields (airport, demand) in the order of the airports once the read is done.
+    """
+    flight_pages = backend.iter_active_flight_pages(DB_TABLE, airports, total_segments=DB_SCAN_SEGMENTS,
+                                                    columns=backend.PIPELINE_COLUMNS)
+
+    def cleaned_pages():
+        for page in flight_pages:
+            with instrumentation.stage('clean') as clean:
+                cleaned_page = backend.clean_active_flights(page, run_time)
+                clean.add(rows_in=len(page), rows_out=len(cleaned_page))
+            yield cleaned_page
+
+    # the pages are read, cleaned and reduced together, the 'stream' stage covers all of it
+    with instrumentation.stage('stream') as stream:
+        demands = backend.calculate_demand_by_airport_from_flight_pages(cleaned_pages(), airports, run_time)
+        stream.add(rows_out=sum(len(demand['demand']) for demand in demands.values()))
+    for airport in airports:
+        yield airport, demands[airport]
+
+
+def lambda_demand_stream_handler(event, context):
+    """lambda function triggered by the DynamoDB stream of the active flights table, updates the demand incrementally
+
+    The demand state of every airport (every configured airport, or the ones listed under 'airports' in the event)
+    is kept in the DEMAND_STATE_BUCKET S3 bucket, shared by all the invocations: the records of a batch are applied
+    to the state saved by the previous batches, whichever container processed them. The save is conditional, when
+    another invocation saved the state meanwhile the records are applied again on its state. A state is seeded from
+    a full read of the table when there is none yet, and seeded again once it is DEMAND_STATE_MAX_AGE_HOURS old, so a
+    drift (e.g. from batches lost after their retries) does not last. Without a bucket the states are kept in
+    DEMAND_STATE_DIRECTORY, which is only shared by the invocations of one container. The stream needs the NEW_IMAGE
+    or NEW_AND_OLD_IMAGES view type.
+
+    Parameters
+    ----------
+    event: dict, required
+        DynamoDB Streams event, with the change records under 'Records'
+        Event doc: https://docs.aws.amazon.com/lambda/latest/dg/with-ddb.html
+
+    context: object, required
+        Lambda Context runtime methods and attributes
+        Context doc: https://docs.aws.amazon.com/lambda/latest/dg/python-context-object.html
+
+    Returns
+    ------
+    dict
+    """
+    _ = context
+    from dependencies.utils.dynamodb_utils import get_key_attributes
+    from dependencies.utils.demand_histogram import horizon_start
+
+    airports = _requested_airports(event)
+    if not airports:
+        _logger.warning("no configured airport to calculate the demand of, nothing to do.")
+        return {"statusCode": 200}
+    run_time = datetime.now(timezone.utc)
+    records = event.get('Records', [])
+    key_attributes = get_key_attributes(DB_TABLE)
+    seed = _SeedFlights(airports, key_attributes)
+
+    demands = {airport: _update_demand_state(_demand_state_store(), airport, records, key_attributes, seed, run_time)
+               for airport in airports}
+
+    _logger.info(f"pushing results to influxDB..")
+    influxdb_client = _get_influxdb_client()
+    start = datetime.fromtimestamp(horizon_start(run_time), timezone.utc)  # the points replaced from there on
+    influxdb_client.push_demands(demands, horizon_start=start)
+    influxdb_client.flush()
+    _logger.info(f"successfully pushed results to influxDB.")
     return {"statusCode": 200}
 
 
+def _demand_state_store():
+    from dependencies.utils.incremental_demand import S3StateStore, FileStateStore
+    if DEMAND_STATE_BUCKET:
+        return S3StateStore(DEMAND_STATE_BUCKET)
+    return FileStateStore(DEMAND_STATE_DIRECTORY)
+
+
+def _update_demand_state(store, airport, records, key_attributes, seed, run_time):
+    """
+    Applies the records to the stored demand state of the airport and saves it, returns the demand of the state.
+    """
+    from dependencies.utils.incremental_demand import IncrementalDemand
+
+    for _ in range(DEMAND_STATE_RETRIES):
+        demand_state, token = store.load(airport)
+        if demand_state is None or demand_state.seeded_time is None or \
+                run_time.timestamp() - demand_state.seeded_time >= DEMAND_STATE_MAX_AGE_HOURS * 3600:
+            _logger.info(f"no current demand state of {airport}, seeding it from the active flights table ...")
+            # the table already holds the changes of the records
+            demand_state = IncrementalDemand.from_flights(seed.flights(), airport, key_attributes, run_time)
+        else:
+            demand_state.apply_records(records, run_time)
+        demand = demand_state.demand(run_time)
+        if store.save(airport, demand_state, token):
+            return demand
+        _logger.info(f"the demand state of {airport} was saved by another invocation, applying the records again.")
+    raise RuntimeError(f"could not save the demand state of {airport} after {DEMAND_STATE_RETRIES} attempts")
+
+
+class _SeedFlights:
+    """
+    The active flights of all the airports, read from the table on first use.
+    """
+
+    def __init__(self, airports, key_attributes):
+        self._airports = airports
+        self._key_attributes = key_attributes
+        self._flights = None
+
+    def flights(self):
+        if self._flights is None:
+            from dependencies.utils.dynamodb_utils import query_active_flights, PIPELINE_COLUMNS
+            # a key attribute can also be a pipeline column (e.g. airport), DynamoDB rejects a repeated path
+            columns = list(dict.fromkeys(self._key_attributes + PIPELINE_COLUMNS))
+            self._flights = query_active_flights(DB_TABLE, self._airports, total_segments=DB_SCAN_SEGMENTS,
+                                                 columns=columns)
+        return self._flights
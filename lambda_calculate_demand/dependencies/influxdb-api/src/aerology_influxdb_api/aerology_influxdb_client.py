@@ -1,15 +1,24 @@
 import json
+import logging
 import warnings
 from datetime import datetime, timedelta
 import time
 import os
-import influxdb_client
 import pandas
 from jsonschema import validate
 from .schemas import configuration_json_schema
+from .line_protocol import dataframe_to_line_protocol, epoch_seconds
+from .async_writer import AsyncLineWriter, WriteFailedError
+from .query_cache import QueryCache, DEFAULT_QUERY_CACHE_SIZE, normalize_time
+from .flux_csv import iter_flux_csv, flux_csv_to_frame, pivot_flux_chunks, DEFAULT_CHUNK_ROWS
+from .flux_query import build_flux_query, flux_time
+from .capacity_vector import encode_capacity_vector, decode_capacity_vector
+from .range_read import time_shards, read_shards, stitch_results, DEFAULT_RANGE_WORKERS, DEFAULT_RANGE_RETRIES
+from .async_writer import DEFAULT_RETRY_INTERVAL, DEFAULT_MAX_RETRY_DELAY
+from .demand_diff import DemandWriteCache, DemandDiff, DEFAULT_REFRESH_INTERVAL
 from influxdb_client import InfluxDBClient
-from influxdb_client import Point
 from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.configuration import Configuration
 from influxdb_client.domain.write_precision import WritePrecision
 
 measurement_vector_cap = 'gdp_apt_capacity'
@@ -18,6 +27,11 @@ measurement_cap_pred = "capacity_prediction"
 measurement_lanes = "lane_status"
 measurement_demand = "demand"
 delay_calculations = "delay_calculations"
+measurement_run_metrics = "pipeline_metrics"
+
+DEFAULT_WRITE_BATCH_SIZE = 5000  # lines per write request
+
+_logger = logging.getLogger(__name__)
 
 
 class InfluxDBHandler:
@@ -28,32 +42,25 @@ class InfluxDBHandler:
         'predicted_time',
         'predicted_capacity',
         'prediction_variance',
-        'prediction_offset' """
+        'prediction_offset'
+        and the 'init_time' and 'model_id' tags. With store_init_timestamp in the configuration the init time is
+        also written as the integer field 'init_timestamp' (epoch seconds), see
+        `query_capacity_predictions_for_slotting`. Naive predicted times are taken as UTC, see `line_protocol`. """
 
         airport_data = self._get_airport_data(airport)
         if airport_data is None:
             warnings.warn("can not push data, no settings are configured for the selected airport!")
             return
 
-        for index, row in data.iterrows():
-            # dict_structure = {"measurement": 'capacity_prediction',
-            #                   "tags": {"init_time": row['init_time'], "model_id": row['model_id']},
-            #                   "fields": {"predicted_capacity": row['predicted_capacity'],
-            #                              "prediction_variance": row['prediction_variance'],
-            #                              "time": row['predicted_time']}}
-            # data_point = Point.from_dict(dict_structure, WritePrecision.S)
-
-            data_point = influxdb_client.Point(measurement_cap_pred) \
-                .tag('init_time', row['init_time']) \
-                .tag('model_id', row['model_id']) \
-                .field('predicted_capacity', row['predicted_capacity']) \
-                .field('prediction_variance', row['prediction_variance']) \
-                .time(int(row['predicted_time'].timestamp()), WritePrecision.S)
-
-            # TODO: verify that it doesn't need unix timestamp
-            self._influx_writer.write(bucket=airport_data['influx_bucket'], org=self._config['influx']['org'],
-                                      record=data_point)
-        self._influx_writer.flush()
+        fields = ['predicted_capacity', 'prediction_variance']
+        if self._store_init_timestamp:
+            data = data.assign(init_timestamp=epoch_seconds(data['init_time']))
+            fields.append('init_timestamp')
+        lines = dataframe_to_line_protocol(data, measurement_cap_pred,
+                                           fields=fields,
+                                           time_column='predicted_time',
+                                           tags=['init_time', 'model_id'])
+        self._write_lines(airport_data['influx_bucket'], lines)
 
     def push_capacity_measurements(self, data: pandas.DataFrame, airport: str):
         airport_data = self._get_airport_data(airport)
@@ -61,36 +68,26 @@ class InfluxDBHandler:
             warnings.warn("can not push data, no settings are configured for the selected airport!")
             return
 
-        for index, row in data.iterrows():
-            data_point = influxdb_client.Point(measurement_real_cap) \
-                .field('measured_capacity', row['capacity']) \
-                .time(row['time'], WritePrecision.S)  # TODO: verify that it doesn't need unix timestamp
-            self._influx_writer.write(bucket=airport_data['influx_bucket'], org=self._config['influx']['org'],
-                                      record=data_point)
-        self._influx_writer.flush()
+        lines = dataframe_to_line_protocol(data, measurement_real_cap, fields={'measured_capacity': 'capacity'},
+                                           time_column='time')
+        self._write_lines(airport_data['influx_bucket'], lines)
 
     def push_vectoral_capacity_measurements(self, data: pandas.DataFrame, init_time: datetime, airport: str,
                                             msg_type: str):
+        """expects an input with the 'time' and 'capacity' columns, written as one 'capacity_vector' point at
+        `init_time` tagged with the message type. The vector is encoded as set by capacity_vector_encoding in the
+        configuration: 'text' (the default) or the compact 'binary' one, which needs evenly spaced times, see
+        `capacity_vector`."""
         airport_data = self._get_airport_data(airport)
         if airport_data is None:
             warnings.warn("can not push data, no settings are configured for the selected airport!")
             return
 
-        # create vector string:
-        start_time = data.iloc[0]['time'].strftime("%d/%m/%y %H:%M")
-        end_time = data.iloc[-1]['time'].strftime("%d/%m/%y %H:%M")
-        vector_field_str = f"time: {start_time} - {end_time}, values: "
-        for _, row in data.iterrows():
-            vector_field_str += f"{row['capacity']},"
-
-        data_point = influxdb_client.Point(measurement_vector_cap) \
-            .field('capacity_vector', vector_field_str) \
-            .tag('message_type', msg_type) \
-            .time(init_time, WritePrecision.S)
-
-        self._influx_writer.write(bucket=airport_data['influx_bucket'], org=self._config['influx']['org'],
-                                  record=data_point)
-        self._influx_writer.flush()
+        vector = encode_capacity_vector(data['time'], data['capacity'], self._capacity_vector_encoding)
+        point = pandas.DataFrame({'capacity_vector': [vector], 'message_type': [msg_type], 'init_time': [init_time]})
+        lines = dataframe_to_line_protocol(point, measurement_vector_cap, fields=['capacity_vector'],
+                                           time_column='init_time', tags=['message_type'])
+        self._write_lines(airport_data['influx_bucket'], lines)
 
     def push_lane_status(self, data: pandas.DataFrame, airport: str):
         airport_data = self._get_airport_data(airport)
@@ -103,129 +100,413 @@ class InfluxDBHandler:
                           .format(airport_data['lane_names']))
             return
 
-        for index, row in data.iterrows():
-            data_point = influxdb_client.Point(measurement_lanes).time(row['status_time'],
-                                                                       WritePrecision.S)  # TODO: verify that it doesn't need unix timestamp
-            for lane in airport_data['lane_names']:
-                data_point.field(lane, row[lane])
-
-            self._influx_writer.write(bucket=airport_data['influx_bucket'], org=self._config['influx']['org'],
-                                      record=data_point)
-        self._influx_writer.flush()
+        lines = dataframe_to_line_protocol(data, measurement_lanes, fields=airport_data['lane_names'],
+                                           time_column='status_time')
+        self._write_lines(airport_data['influx_bucket'], lines)
 
-    def querry_capacity_predictions(self, airport: str, start_time, end_time, prediction_offset):
+    def querry_capacity_predictions(self, airport: str, start_time, end_time, prediction_offset, window=None):
+        """reads the predicted capacity and variance of a prediction offset between the start and end time
+        (datetimes or epoch seconds), pivoted to one row per time and series. `window` (a timedelta) averages the
+        predictions in windows of this length on the server."""
         airport_data = self._get_airport_data(airport)
         if airport_data is None:
             warnings.warn("can not querry data, no settings are configured for the selected airport!")
             return None
 
-        query = ' from(bucket:"{}")\
-        |> range({}: {})\
-        |> filter(fn:(r) => r._measurement == "{}")\
-        |> filter(fn: (r) => r.prediction_offset == {})\
-        |> filter(fn: (r) => r._field == "{}" or r._field == "{}")\
-        |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")' \
-            .format(airport_data['influx_bucket'],
-                    start_time,
-                    end_time,
-                    measurement_cap_pred,
-                    prediction_offset,
-                    "predicted_capacity",
-                    "prediction_variance"
-                    )
-
-        return self._influx_reader.query(org=self._config['influx']['org'], query=query)
-
-    def query_capacity_predictions_for_slotting(self, airport):
+        def build_query(start, stop):
+            return build_flux_query(airport_data['influx_bucket'], start, stop, measurement_cap_pred,
+                                    fields=['predicted_capacity', 'prediction_variance'],
+                                    tags={'prediction_offset': prediction_offset},
+                                    keep=['_time', '_field', '_value', 'init_time', 'model_id', 'prediction_offset'],
+                                    window=window, pivot_fields=True)
+
+        def read(query):
+            return self._influx_reader.query(org=self._config['influx']['org'], query=query)
+
+        key = (airport_data['short_name'], 'capacity_predictions', normalize_time(start_time),
+               normalize_time(end_time), prediction_offset, window)
+        return self._cached_query(key, (airport_data['influx_bucket'], measurement_cap_pred),
+                                  lambda: self.query_range(build_query, start_time, end_time, read))
+
+    def query_capacity_predictions_for_slotting(self, airport, lookback=timedelta(hours=3),
+                                                horizon=timedelta(hours=48)):
+        """reads the predicted capacity of the latest init time of every model, from `lookback` before now to
+        `horizon` after now, pivoted to one column per model"""
 
         airport_data = self._get_airport_data(airport)
         if airport_data is None:
             warnings.warn("can not querry data, no settings are configured for the selected airport!")
             return None
 
-        query = '''
-          import "date"
-          import "strings"
-          
-          from(bucket: "aerology.release")
-            |> range(start: -3h, stop: 48h)
-            |> filter(fn: (r) => r._measurement == "capacity_prediction")
-            |> filter(fn: (r) => r._field == "predicted_capacity")
-            
-            // drop +00:00 from 10Nov dupes
-            |> filter(fn: (r) => strings.strlen(v: r.init_time) <= 19)
-            
-            // append time to midnight inits
-            |> map(fn: (r) => ({r with init_time: 
-              if strings.strlen(v: r.init_time) < 19 then
-                r.init_time + " 00:00:00"
-              else
-                r.init_time
-              })
-            )
-            
-            // convert init_time to timestamp
-            |> map(fn: (r) => ({r with initDtmz: 
-              time(v: 
-                strings.replace(v: r.init_time, t: " ", u: "T", i: 1) + "Z")
-            }))
-          
-            |> group(columns: ["_time", "model_id"])
-            |> sort(columns: ["initDtmz"])
-            |> last()
-            |> group()
-            |> pivot(rowKey: ["_time"], columnKey: ["model_id"], valueColumn: "_value")
-          '''
-
-        # query_api.query(org=self._config['influx']['org'], query=query)
-        # dataset =[]
-        # for table in results:
-        #     for record in table.records:
-        #         dataset.append([record.get_time(), record.get_value(), record.get_field()])
-        #
-        # # df = pandas.DataFrame(dataset, columns=['time', 'value', 'model_id'])
-        return self._influx_reader.query_data_frame(org=self._config['influx']['org'], query=query)
+        query = self._slotting_query(airport_data['influx_bucket'], -lookback, horizon)
+
+        def query_frame():
+            if self._streaming_queries:
+                return self.query_frame(query)
+            return self._influx_reader.query_data_frame(org=self._config['influx']['org'], query=query)
+
+        key = (airport_data['short_name'], 'capacity_predictions_for_slotting', flux_time(-lookback),
+               flux_time(horizon))
+        return self._cached_query(key, (airport_data['influx_bucket'], measurement_cap_pred), query_frame)
+
+    def _slotting_query(self, bucket, start, stop):
+        if self._store_init_timestamp:
+            # the latest init time is selected on the init_timestamp field, without any string processing
+            return build_flux_query(
+                bucket, start, stop, measurement_cap_pred, fields=['predicted_capacity', 'init_timestamp'],
+                keep=['_time', '_field', '_value', 'init_time', 'model_id'],
+                stages=['pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")',
+                        'group(columns: ["_time", "model_id"])',
+                        'max(column: "init_timestamp")',
+                        'group()',
+                        'pivot(rowKey: ["_time"], columnKey: ["model_id"], valueColumn: "predicted_capacity")'])
+
+        # init times written as tags only come in several formats, they are normalized after the pushed down stages
+        return build_flux_query(
+            bucket, start, stop, measurement_cap_pred, fields=['predicted_capacity'],
+            keep=['_time', '_value', 'init_time', 'model_id'], imports=['strings'],
+            stages=[
+                # drop +00:00 from 10Nov dupes
+                'filter(fn: (r) => strings.strlen(v: r.init_time) <= 19)',
+                # append time to midnight inits
+                'map(fn: (r) => ({r with init_time: if strings.strlen(v: r.init_time) < 19 then '
+                'r.init_time + " 00:00:00" else r.init_time}))',
+                # convert init_time to timestamp
+                'map(fn: (r) => ({r with initDtmz: '
+                'time(v: strings.replace(v: r.init_time, t: " ", u: "T", i: 1) + "Z")}))',
+                'group(columns: ["_time", "model_id"])',
+                'sort(columns: ["initDtmz"])',
+                'last()',
+                'group()',
+                'pivot(rowKey: ["_time"], columnKey: ["model_id"], valueColumn: "_value")'])
 
     def push_flight_calculations(self, data, airport: str):
 
         airport_data = self._get_airport_data(airport)
         if airport_data is None:
             warnings.warn("can not push data, no settings are configured for the selected airport!")
+            return
 
-        for row in data:
-            data_point = influxdb_client.Point(delay_calculations) \
-                .tag('flight_id', row['flight_id']) \
-                .tag('eta_hour', row['eta_hour']) \
-                .tag('slt_hour', row['slt_hour']) \
-                .field('predicted_delay', row['predicted_delay']) \
-                .field('published_delay', row['published_delay']) \
-                .time(row['_time'], WritePrecision.S)
+        lines = dataframe_to_line_protocol(pandas.DataFrame(data), delay_calculations,
+                                           fields=['predicted_delay', 'published_delay'],
+                                           time_column='_time',
+                                           tags=['flight_id', 'eta_hour', 'slt_hour'])
+        self._write_lines(airport_data['influx_bucket'], lines)
+
+    def push_demand(self, data, airport: str, horizon_start: datetime = None):
+        """expects a DataFrame (or a dict of columns) with the 'valid_time' and 'demand' columns. Any other column is
+        written as a tag, e.g. the landing_time and dimension columns of `flight_msg_utils.calculate_demand_cube`;
+        missing values (the dimensions a breakdown sums over) are left out of the point. With demand_airport_tag in the
+        configuration the points are also tagged with the airport, for buckets shared by several airports. With the
+        'changes' demand_write_mode only the points that changed since the previous push are sent, and the points
+        pushed before from `horizon_start` on (by default the first valid_time) that are missing from the data are set
+        to 0, see `demand_diff`."""
 
-            self._influx_writer.write(bucket=airport_data['influx_bucket'], org=self._config['influx']['org'],
-                                      record=data_point)
+        airport_data = self._get_airport_data(airport)
+        if airport_data is None:
+            warnings.warn("can not push data, no settings are configured for the selected airport!")
+            return
 
-        self._influx_writer.flush()
+        bucket = airport_data['influx_bucket']
+        diff = self._diff_demand(bucket, airport, self._demand_lines(data, self._airport_tag(airport_data)),
+                                 horizon_start)
+        self._write_lines(bucket, diff.lines)
+        self._commit_demand(bucket, airport, diff)
+
+    def push_demands(self, demands: dict, horizon_start: datetime = None):
+        """pushes the demand of several airports at once, expects a dict of airport name to a DataFrame with the
+        'valid_time' and 'demand' columns. The points of all airports sharing a bucket are sent in one write, they
+        need demand_airport_tag in the configuration to be told apart. See `push_demand` for `horizon_start`."""
+
+        lines_by_bucket = {}
+        diffs_by_bucket = {}
+        for airport, data in demands.items():
+            airport_data = self._get_airport_data(airport)
+            if airport_data is None:
+                warnings.warn("can not push data for {}, no settings are configured for the airport!".format(airport))
+                continue
+            bucket = airport_data['influx_bucket']
+            diff = self._diff_demand(bucket, airport, self._demand_lines(data, self._airport_tag(airport_data)),
+                                     horizon_start)
+            lines_by_bucket.setdefault(bucket, []).extend(diff.lines)
+            diffs_by_bucket.setdefault(bucket, []).append((airport, diff))
+
+        for bucket, lines in lines_by_bucket.items():
+            if len(diffs_by_bucket[bucket]) > 1 and not self._demand_airport_tag:
+                warnings.warn("the demands of {} are written to the same series of bucket {}, set demand_airport_tag "
+                              "in the configuration to tag them with their airport"
+                              .format(', '.join(airport for airport, _ in diffs_by_bucket[bucket]), bucket))
+            self._write_lines(bucket, lines)
+            for airport, diff in diffs_by_bucket[bucket]:
+                self._commit_demand(bucket, airport, diff)
+
+    def push_run_metrics(self, stages: dict, run_time: datetime, tags: dict = None):
+        """pushes the metrics of a pipeline run, a dict of stage name to a dict of counter name to value (e.g. the
+        stages of `instrumentation.RunMetrics`), one point per stage tagged with the stage and `tags`. The points go
+        to the metrics_bucket of the configuration, by default to the bucket of the first airport."""
+        if not stages:
+            return
+        bucket = self._config['influx'].get('metrics_bucket') or self._config['airports'][0]['influx_bucket']
+        # every counter is written as a float, so that a field keeps its type from one run to the next
+        data = pandas.DataFrame.from_dict(stages, orient='index').astype(float)
+        counters = list(data.columns)
+        data['stage'] = data.index
+        data['run_time'] = run_time
+        for key, value in (tags or {}).items():
+            data[key] = value
+        lines = dataframe_to_line_protocol(data.reset_index(drop=True), measurement_run_metrics, fields=counters,
+                                           time_column='run_time', tags=['stage'] + list(tags or {}))
+        self._write_lines(bucket, lines)
+
+    def _diff_demand(self, bucket, airport, lines, horizon_start=None):
+        if self._demand_cache is None:
+            return DemandDiff(lines, 0, 0, True, None)
+        start = None if horizon_start is None else int(epoch_seconds(pandas.Series([horizon_start]))[0])
+        diff = self._demand_cache.diff(bucket, airport, lines, start)
+        if not diff.full:
+            _logger.info("skipping {} unchanged demand points of {}, {} dropped bin(s) set to 0"
+                         .format(diff.skipped, airport, diff.zeroed))
+        return diff
+
+    def _commit_demand(self, bucket, airport, diff):
+        if self._demand_cache is not None:
+            # in the asynchronous write mode the lines are only queued, a failed flush clears the cache
+            self._demand_cache.commit(bucket, airport, diff)
+            self.write_stats['skipped'] += diff.skipped
+
+    def _airport_tag(self, airport_data):
+        return airport_data['short_name'] if self._demand_airport_tag else None
+
+    @staticmethod
+    def _demand_lines(data, airport=None):
+        # data can also be a dict of columns, valid_time as datetimes, date strings or epoch seconds. With an airport
+        # the points are tagged with it, otherwise the series keep the key they had before the tag existed
+        data = pandas.DataFrame(data)
+        constant_tags = None if airport is None else {'airport': airport}
+        tags = [column for column in data.columns
+                if column not in ('valid_time', 'demand') and not (constant_tags and column in constant_tags)]
+        return dataframe_to_line_protocol(data, measurement_demand, fields=['demand'], time_column='valid_time',
+                                          tags=tags, constant_tags=constant_tags)
+
+    def _write_lines(self, bucket: str, lines: list):
+        """sends line protocol to the bucket in requests of at most `write_batch_size` lines (gzip compressed unless
+        disabled in the configuration), and logs the write throughput. Returns the statistics of the write.
+        In the asynchronous write mode the lines are only queued, and None is returned."""
+        if self._async_writer is not None:
+            self._async_writer.write(bucket, lines)
+            return None
 
-    def push_demand(self, data, airport: str):
+        start = time.perf_counter()
+        for offset in range(0, len(lines), self._write_batch_size):
+            self._send_batch(bucket, lines[offset:offset + self._write_batch_size])
+        elapsed = time.perf_counter() - start
+
+        requests = -(-len(lines) // self._write_batch_size)
+        stats = {'points': len(lines), 'requests': requests, 'seconds': elapsed,
+                 'points_per_second': len(lines) / elapsed if elapsed > 0 else 0.0}
+        _logger.info("wrote {} points to {} in {} request(s), {:.0f} points/s"
+                     .format(len(lines), bucket, requests, stats['points_per_second']))
+        return stats
+
+    def _send_batch(self, bucket: str, lines: list):
+        """writes the lines in one request"""
+        start = time.perf_counter()
+        self._influx_writer.write(bucket=bucket, org=self._config['influx']['org'], record='\n'.join(lines),
+                                  write_precision=WritePrecision.S)
+        self.write_stats['points'] += len(lines)
+        self.write_stats['requests'] += 1
+        self.write_stats['seconds'] += time.perf_counter() - start
+        if self._query_cache is not None:
+            # once the points are written, a query that started before and returns after is not cached either (its
+            # generation is an older one), see `QueryCache.generation`
+            self._invalidate_queries(bucket, {line[:line.find(' ')].split(',', 1)[0] for line in lines})
+
+    def _cached_query(self, key, source, query):
+        """runs the query through the query cache, `source` is the (bucket, measurement) read by the query. Cached
+        data frames are returned as copies, lists of tables as new lists of the same tables."""
+        if self._query_cache is None:
+            return query()
+        result = self._query_cache.get(key)
+        if result is QueryCache.MISSING:
+            generation = self._query_cache.generation(source)
+            result = query()
+            self._query_cache.put(key, source, result, generation)
+        if isinstance(result, pandas.DataFrame):
+            return result.copy()
+        return list(result) if isinstance(result, list) else result
+
+    def query_stream(self, query: str, chunk_rows=None, columns=None):
+        """runs a Flux query and parses the annotated CSV response while it is received, yields chunks of at most
+        `chunk_rows` rows (query_chunk_rows of the configuration by default) as dicts of column name to numpy array,
+        see `flux_csv.iter_flux_csv`. `columns` restricts the parsed columns."""
+        response = self._influx_reader.query_raw(query=query, org=self._config['influx']['org'])
+        try:
+            yield from iter_flux_csv(response, chunk_rows or self._query_chunk_rows, columns)
+        finally:
+            response.close()
+
+    def query_frame(self, query: str, chunk_rows=None):
+        """runs a Flux query through `query_stream`, returns the DataFrame of the response (a list of DataFrames
+        when its tables have different columns) as `query_api.query_data_frame`"""
+        return flux_csv_to_frame(self.query_stream(query, chunk_rows))
+
+    def query_range(self, build_query, start_time, end_time, read=None, shard=None, progress=None):
+        """reads the window from start_time to end_time in time shards of `shard` (a timedelta, range_shard_ms of the
+        configuration by default), and returns their results stitched in time order, see `range_read.stitch_results`.
+        `build_query(start, stop)` returns the Flux query of a shard and `read(query)` its result, `query_frame` by
+        default. The shards are read by range_workers threads over the pooled connections of the client, each one
+        retried up to range_retries times (after retry_interval_ms, doubling up to max_retry_delay_ms), and
+        `progress(done, total, (start, stop))` is called as they complete. Without a shard length the window is read
+        with one query."""
+        read = read or self.query_frame
+        shard = shard or self._range_shard
+        if shard is None:
+            return read(build_query(start_time, end_time))
+
+        influx_config = self._config['influx']
+        results = read_shards(lambda start, stop: read(build_query(start, stop)),
+                              time_shards(start_time, end_time, shard),
+                              max_workers=self._range_workers,
+                              max_retries=influx_config.get('range_retries', DEFAULT_RANGE_RETRIES),
+                              retry_interval=influx_config.get('retry_interval_ms',
+                                                               DEFAULT_RETRY_INTERVAL * 1000) / 1000,
+                              max_retry_delay=influx_config.get('max_retry_delay_ms',
+                                                                DEFAULT_MAX_RETRY_DELAY * 1000) / 1000,
+                              progress=progress)
+        return stitch_results(results)
+
+    def _clear_demand_cache(self):
+        # the points that could not be written may be anywhere in the cache, the next pushes are full ones
+        if self._demand_cache is not None:
+            self._demand_cache.clear()
+
+    def _invalidate_queries(self, bucket, measurements):
+        if self._query_cache is not None:
+            for measurement in measurements:
+                self._query_cache.invalidate(bucket, measurement)
+
+    @property
+    def query_cache_stats(self):
+        """hits, misses, expirations, evictions, invalidations, results not cached since their source was written
+        meanwhile (stale_puts) and current entries of the query cache, None when the cache is not enabled
+        (query_cache_ttl_ms in the configuration)"""
+        if self._query_cache is None:
+            return None
+        return dict(self._query_cache.stats, entries=len(self._query_cache))
+
+    def clear_query_cache(self):
+        """drops every cached query result"""
+        if self._query_cache is not None:
+            self._query_cache.invalidate()
+
+    @property
+    def asynchronous(self):
+        """True when the writes are sent by a background thread, see `flush` and `close`"""
+        return self._async_writer is not None
+
+    def flush(self):
+        """blocks until every queued point is written (asynchronous write mode), raises WriteFailedError if points
+        could not be written after the retries"""
+        if self._async_writer is not None:
+            try:
+                self._async_writer.flush()
+            except WriteFailedError:
+                self._clear_demand_cache()
+                raise
+
+    def close(self):
+        """writes the queued points and closes the connections to InfluxDB"""
+        try:
+            if self._async_writer is not None:
+                self._async_writer.close()
+        except WriteFailedError:
+            self._clear_demand_cache()
+            raise
+        finally:
+            self._influx_client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def querry_capacity_measurements(self, airport: str, start_time, end_time) -> pandas.DataFrame:
+        """returns the measured capacity from start_time to end_time (excluded) as a DataFrame with the 'time'
+        (naive UTC) and 'capacity' columns, as pushed by `push_capacity_measurements`. Long windows are read in shards
+        when range_shard_ms is configured, see `query_range`."""
 
         airport_data = self._get_airport_data(airport)
         if airport_data is None:
-            warnings.warn("can not push data, no settings are configured for the selected airport!")
-        for index, row in data.iterrows():
-            data_point = influxdb_client.Point(measurement_demand) \
-                .field('demand', row['demand']) \
-                .time(row['valid_time'], WritePrecision.S)
-
-            self._influx_writer.write(bucket=airport_data['influx_bucket'], org=self._config['influx']['org'],
-                                      record=data_point)
+            warnings.warn("can not querry data, no settings are configured for the selected airport!")
+            return None
 
-        self._influx_writer.flush()
+        def build_query(start, stop):
+            return build_flux_query(airport_data['influx_bucket'], start, stop, measurement_real_cap,
+                                    fields=['measured_capacity'], keep=['_time', '_value'])
+
+        key = (airport_data['short_name'], 'capacity_measurements', normalize_time(start_time),
+               normalize_time(end_time))
+        return self._cached_query(key, (airport_data['influx_bucket'], measurement_real_cap),
+                                  lambda: self.query_range(build_query, start_time, end_time,
+                                                           self._capacity_measurement_frame))
+
+    def _capacity_measurement_frame(self, query):
+        if self._streaming_queries:
+            # the chunks come with the times as naive UTC datetime64
+            frames = [pandas.DataFrame({'time': chunk['_time'], 'capacity': chunk['_value']})
+                      for chunk in self.query_stream(query, columns=['_time', '_value'])]
+            if frames:
+                return pandas.concat(frames, ignore_index=True)
+            return pandas.DataFrame({'time': pandas.Series(dtype='datetime64[ns]'), 'capacity': pandas.Series()})
+
+        records = [record for table in self._influx_reader.query(org=self._config['influx']['org'], query=query)
+                   for record in table.records]
+        return pandas.DataFrame({
+            'time': pandas.to_datetime([record.get_time() for record in records], utc=True).tz_localize(None),
+            'capacity': [record.get_value() for record in records]})
+
+    def querry_vectoral_capacity_measurements(self, airport: str, start_time, end_time, msg_type: str = None):
+        """returns the capacity vectors with an init time in [start_time, end_time), of every message type or of
+        `msg_type`, decoded from the binary and the text encoding: a DataFrame with the init_time, message_type,
+        time and capacity columns (naive UTC times), one row per value of every vector."""
 
-    def querry_capacity_measurements(self, airport: str) -> pandas.DataFrame:
-        raise ValueError('NOT IMPLEMENTED!')
+        airport_data = self._get_airport_data(airport)
+        if airport_data is None:
+            warnings.warn("can not querry data, no settings are configured for the selected airport!")
+            return None
 
-    def querry_vectoral_capacity_measurements(self, airport: str, start_time, end_time):
-        raise ValueError('NOT IMPLEMENTED!')
+        query = build_flux_query(airport_data['influx_bucket'], start_time, end_time, measurement_vector_cap,
+                                 fields=['capacity_vector'], tags={'message_type': msg_type} if msg_type else None,
+                                 keep=['_time', '_value', 'message_type'])
+        key = (airport_data['short_name'], 'capacity_vectors', normalize_time(start_time), normalize_time(end_time),
+               msg_type)
+        return self._cached_query(key, (airport_data['influx_bucket'], measurement_vector_cap),
+                                  lambda: self._capacity_vector_frame(query))
+
+    def _capacity_vector_frame(self, query):
+        if self._streaming_queries:
+            vectors = [row for chunk in self.query_stream(query, columns=['_time', 'message_type', '_value'])
+                       for row in zip(chunk['_time'], chunk['message_type'], chunk['_value'])]
+        else:
+            vectors = [(record.get_time(), record.values.get('message_type'), record.get_value())
+                       for table in self._influx_reader.query(org=self._config['influx']['org'], query=query)
+                       for record in table.records]
+
+        parts = []
+        for init_time, message_type, vector in vectors:
+            times, capacity = decode_capacity_vector(vector)
+            parts.append(pandas.DataFrame({'init_time': pandas.Timestamp(init_time), 'message_type': message_type,
+                                           'time': times, 'capacity': capacity}))
+        if not parts:
+            return pandas.DataFrame({'init_time': pandas.Series(dtype='datetime64[ns]'),
+                                     'message_type': pandas.Series(dtype=object),
+                                     'time': pandas.Series(dtype='datetime64[s]'),
+                                     'capacity': pandas.Series(dtype='int64')})
+        frame = pandas.concat(parts, ignore_index=True)
+        if frame['init_time'].dt.tz is not None:
+            frame['init_time'] = frame['init_time'].dt.tz_convert('UTC').dt.tz_localize(None)
+        return frame
 
     def query_lane_status(self, airport: str, start_time, end_time):
 
@@ -234,13 +515,29 @@ class InfluxDBHandler:
             warnings.warn("can not querry data, no settings are configured for the selected airport!")
             return None
         end_time = end_time + timedelta(hours=1)  # Plus one because the last hour is excluded.
-        query = f' from(bucket:"{airport_data["influx_bucket"]}")\
-        |> range(start: {start_time.isoformat() + "Z"}, stop: {end_time.isoformat() + "Z"})\
+
+        def build_query(start, stop):
+            return f' from(bucket:"{airport_data["influx_bucket"]}")\
+        |> range(start: {flux_time(start)}, stop: {flux_time(stop)})\
         |> filter(fn: (r) => r._measurement == "lane_status")'
 
-        results = self._influx_reader.query(org=self._config['influx']['org'], query=query)
-        df = self._convert_query_to_dataframe(results)
-        return df
+        key = (airport_data['short_name'], 'lane_status', normalize_time(start_time), normalize_time(end_time))
+        return self._cached_query(key, (airport_data['influx_bucket'], measurement_lanes),
+                                  lambda: self.query_range(build_query, start_time, end_time,
+                                                           self._query_lane_status_frame))
+
+    def _query_lane_status_frame(self, query):
+        if not self._streaming_queries:
+            return self._convert_query_to_dataframe(
+                self._influx_reader.query(org=self._config['influx']['org'], query=query))
+        frame = pivot_flux_chunks(self.query_stream(query, columns=['_time', '_field', '_value']))
+        frame = frame.rename(columns={'_time': 'valid_time'})
+        frame.columns.name = 'runway'  # as the pivot of `_convert_query_to_dataframe`
+        return frame
+
+    def get_airport_names(self):
+        """returns the short names of the configured airports"""
+        return [airport["short_name"] for airport in self._config["airports"]]
 
     def _get_airport_data(self, airport_name: str):
         for airport in self._config["airports"]:
@@ -259,11 +556,49 @@ class InfluxDBHandler:
         return True
 
     def __init_db_clients(self):
+        self._range_workers = self._config['influx'].get('range_workers', DEFAULT_RANGE_WORKERS)
+        self._range_shard = None
+        if self._config['influx'].get('range_shard_ms'):
+            self._range_shard = timedelta(milliseconds=self._config['influx']['range_shard_ms'])
+        # the shards of a range read each keep a connection, besides the one of the writes
+        pool_size = max(Configuration().connection_pool_maxsize, self._range_workers + 1)
         self._influx_client = InfluxDBClient(url=self._config['influx']['url'],
                                              token=self._config['influx']['token'],
-                                             org=self._config['influx']['org'])
+                                             org=self._config['influx']['org'],
+                                             enable_gzip=self._config['influx'].get('enable_gzip', True),
+                                             connection_pool_maxsize=pool_size)
+        self._write_batch_size = self._config['influx'].get('write_batch_size', DEFAULT_WRITE_BATCH_SIZE)
+        # totals of all writes of the handler, 'skipped' counts the unchanged demand points not sent
+        self.write_stats = {'points': 0, 'requests': 0, 'seconds': 0.0, 'skipped': 0}
         self._influx_writer = self._influx_client.write_api(write_options=SYNCHRONOUS)
         self._influx_reader = self._influx_client.query_api()
+        self._streaming_queries = self._config['influx'].get('query_mode', 'records') == 'streaming'
+        self._store_init_timestamp = self._config['influx'].get('store_init_timestamp', False)
+        self._demand_airport_tag = self._config['influx'].get('demand_airport_tag', False)
+        self._capacity_vector_encoding = self._config['influx'].get('capacity_vector_encoding', 'text')
+        self._query_chunk_rows = self._config['influx'].get('query_chunk_rows', DEFAULT_CHUNK_ROWS)
+        self._async_writer = self.__init_async_writer(self._config['influx'])
+        self._demand_cache = None
+        if self._config['influx'].get('demand_write_mode', 'full') == 'changes':
+            self._demand_cache = DemandWriteCache(
+                self._config['influx'].get('demand_refresh_ms', DEFAULT_REFRESH_INTERVAL * 1000) / 1000)
+        self._query_cache = None
+        if self._config['influx'].get('query_cache_ttl_ms', 0) > 0:
+            self._query_cache = QueryCache(self._config['influx']['query_cache_ttl_ms'] / 1000,
+                                           self._config['influx'].get('query_cache_size', DEFAULT_QUERY_CACHE_SIZE))
+
+    def __init_async_writer(self, influx_config):
+        if influx_config.get('write_mode', 'synchronous') != 'asynchronous':
+            return None
+        options = {'batch_size': self._write_batch_size}
+        for key, option in (('flush_interval_ms', 'flush_interval'), ('retry_interval_ms', 'retry_interval'),
+                            ('max_retry_delay_ms', 'max_retry_delay')):
+            if key in influx_config:
+                options[option] = influx_config[key] / 1000
+        for key, option in (('write_queue_size', 'queue_size'), ('max_retries', 'max_retries')):
+            if key in influx_config:
+                options[option] = influx_config[key]
+        return AsyncLineWriter(self._send_batch, **options)
 
     def __init__(self, path_to_config="res/config_files.json"):
         if not self.__load_config(path_to_config):
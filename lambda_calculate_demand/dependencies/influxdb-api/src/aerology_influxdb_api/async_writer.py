@@ -0,0 +1,208 @@
+"""
+Background writer of line protocol, used by the asynchronous write mode of the InfluxDBHandler.
+
+The writes of the handler are put on a bounded queue and sent by one flusher thread, so the caller can go on with its
+calculations while the points travel to InfluxDB. A full queue blocks the caller instead of dropping points, and
+writes rejected with 429 or 5xx (or failing on the connection) are retried with exponential backoff.
+"""
+import logging
+import queue
+import threading
+import time
+
+import urllib3
+
+DEFAULT_FLUSH_INTERVAL = 1.0  # seconds a partial batch waits for more lines
+DEFAULT_QUEUE_SIZE = 100  # batches waiting to be sent before the writers block
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_INTERVAL = 1.0  # seconds before the first retry
+DEFAULT_MAX_RETRY_DELAY = 30.0  # seconds
+DEFAULT_EXPONENTIAL_BASE = 2
+
+_logger = logging.getLogger(__name__)
+
+
+class WriteFailedError(Exception):
+    """
+    Raised by flush and close when batches could not be written, the batches are kept in `failed_batches` as
+    (bucket, lines, error) tuples so that they can be written again.
+    """
+
+    def __init__(self, failed_batches):
+        self.failed_batches = failed_batches
+        n_points = sum(len(lines) for _, lines, _ in failed_batches)
+        super().__init__("{} points in {} batch(es) could not be written, last error: {}"
+                         .format(n_points, len(failed_batches), failed_batches[-1][2]))
+
+
+class _Flush:
+    def __init__(self):
+        self.done = threading.Event()
+
+
+_CLOSE = object()
+
+
+class AsyncLineWriter:
+    """
+    Sends line protocol from a bounded queue on a background thread.
+
+    usage:
+        with AsyncLineWriter(send) as writer:
+            writer.write('bucket', lines)  # returns once the lines are queued
+            ...
+        # every line is sent (or WriteFailedError is raised) when the block exits
+    """
+
+    def __init__(self, send, batch_size, flush_interval=DEFAULT_FLUSH_INTERVAL, queue_size=DEFAULT_QUEUE_SIZE,
+                 max_retries=DEFAULT_MAX_RETRIES, retry_interval=DEFAULT_RETRY_INTERVAL,
+                 max_retry_delay=DEFAULT_MAX_RETRY_DELAY, exponential_base=DEFAULT_EXPONENTIAL_BASE):
+        """
+        Parameters
+        ----------
+        send: callable(bucket, lines), writes one batch in one request, raises on failure
+        batch_size: int, maximum number of lines of a request
+        flush_interval: float, seconds after which a partial batch is sent
+        queue_size: int, batches that can wait in the queue, further writes block until the flusher catches up
+        max_retries: int, retries of a batch rejected with 429/5xx or failing on the connection
+        retry_interval: float, seconds before the first retry, multiplied by `exponential_base` on every retry
+            (a Retry-After header of the response takes precedence)
+        max_retry_delay: float, upper bound of the seconds between two retries
+        exponential_base: float
+        """
+        self._send = send
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_retries = max_retries
+        self._retry_interval = retry_interval
+        self._max_retry_delay = max_retry_delay
+        self._exponential_base = exponential_base
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._failed_batches = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self.retries = 0  # retried requests over the lifetime of the writer
+
+        self._thread = threading.Thread(target=self._run, name='influx-flusher', daemon=True)
+        self._thread.start()
+
+    def write(self, bucket: str, lines: list):
+        """
+        Queues the lines, blocks while the queue is full.
+        """
+        if self._closed:
+            raise ValueError("write to a closed writer")
+        for offset in range(0, len(lines), self._batch_size):
+            self._queue.put((bucket, lines[offset:offset + self._batch_size]))
+
+    def flush(self):
+        """
+        Blocks until every queued line is sent, raises WriteFailedError if batches could not be written.
+        """
+        if not self._closed:
+            marker = _Flush()
+            self._queue.put(marker)
+            marker.done.wait()
+        self._raise_failures()
+
+    def close(self):
+        """
+        Sends the queued lines and stops the flusher thread, raises WriteFailedError if batches could not be written.
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_CLOSE)
+            self._thread.join()
+        self._raise_failures()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _raise_failures(self):
+        with self._lock:
+            failed_batches, self._failed_batches = self._failed_batches, []
+        if failed_batches:
+            raise WriteFailedError(failed_batches)
+
+    def _run(self):
+        """
+        Collects the queued lines per bucket, sends a bucket once it has a full batch, and everything after
+        `flush_interval` without a full batch, on flush and on close.
+        """
+        pending = {}
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._send_pending(pending)
+                deadline = None
+                continue
+
+            if item is _CLOSE or isinstance(item, _Flush):
+                self._send_pending(pending)
+                deadline = None
+                if item is _CLOSE:
+                    return
+                item.done.set()
+                continue
+
+            bucket, lines = item
+            bucket_lines = pending.setdefault(bucket, [])
+            bucket_lines.extend(lines)
+            while len(bucket_lines) >= self._batch_size:
+                self._send_with_retry(bucket, bucket_lines[:self._batch_size])
+                del bucket_lines[:self._batch_size]
+            if deadline is None:
+                deadline = time.monotonic() + self._flush_interval
+
+    def _send_pending(self, pending):
+        for bucket, lines in pending.items():
+            if lines:
+                self._send_with_retry(bucket, lines)
+        pending.clear()
+
+    def _send_with_retry(self, bucket, lines):
+        attempt = 0
+        while True:
+            try:
+                self._send(bucket, lines)
+                return
+            except Exception as error:
+                if attempt >= self._max_retries or not _is_retryable(error):
+                    _logger.error("could not write {} points to {}: {}".format(len(lines), bucket, error))
+                    with self._lock:
+                        self._failed_batches.append((bucket, list(lines), error))
+                    return
+
+                delay = self._retry_delay(attempt, error)
+                _logger.warning("write to {} failed ({}), retrying in {:.1f}s".format(bucket, error, delay))
+                attempt += 1
+                self.retries += 1
+                time.sleep(delay)
+
+    def _retry_delay(self, attempt, error):
+        retry_after = _retry_after(error)
+        if retry_after is None:
+            retry_after = self._retry_interval * self._exponential_base ** attempt
+        return min(retry_after, self._max_retry_delay)
+
+
+def _is_retryable(error):
+    status = getattr(error, 'status', None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, (urllib3.exceptions.HTTPError, OSError))
+
+
+def _retry_after(error):
+    headers = getattr(error, 'headers', None)
+    try:
+        return float(headers['Retry-After']) if headers and 'Retry-After' in headers else None
+    except ValueError:
+        return None
@@ -0,0 +1,173 @@
+"""
+Compact encoding of the capacity vectors of the gdp_apt_capacity measurement.
+
+A vector is a regular time series: a start time, a step, and one capacity per step. It is stored in the string field
+'capacity_vector' as 'v1:' followed by the base64 of a little-endian header and the values:
+
+    version     uint8       1
+    kind        uint8       0: varint deltas, 1: float32 values, 2: varint runs
+    start       int64       epoch seconds of the first value
+    step        uint32      seconds between the values, 0 for a single value
+    count       uint32      number of values
+
+Whole capacities (the usual case) are written as LEB128 varints, either as the zigzag encoded differences between
+consecutive values (mostly one byte per value), or, when shorter, as runs of equal values: the zigzag difference to
+the previous run and the length of the run, a few bytes per change of capacity. Other capacities are written as
+float32 (missing values as NaN). All are encoded and decoded with numpy, without a loop over the values.
+
+`decode_capacity_vector` also reads the text vectors written before ('time: 09/11/22 10:00 - 09/11/22 12:00, values:
+100,150,'), and `encode_capacity_vector(..., encoding='text')` still writes them for the readers of that format.
+"""
+import base64
+import struct
+from datetime import datetime, timezone
+
+import numpy as np
+
+VECTOR_ENCODING_VERSION = 1
+VECTOR_ENCODINGS = ('text', 'binary')
+
+_HEADER = struct.Struct('<BBqII')
+_PREFIX = f"v{VECTOR_ENCODING_VERSION}:"
+_KIND_VARINT_DELTAS = 0
+_KIND_FLOAT32 = 1
+_KIND_VARINT_RUNS = 2
+_TEXT_TIME_FORMAT = '%d/%m/%y %H:%M'
+_VARINT_LIMITS = np.left_shift(np.uint64(1), np.arange(7, 64, 7, dtype=np.uint64))  # 2**7, 2**14, ... 2**63
+
+
+def encode_capacity_vector(times, values, encoding='binary'):
+    """
+    Encodes a capacity vector for the 'capacity_vector' field.
+
+    Parameters
+    ----------
+    times: array-like of datetimes (naive ones are UTC) or datetime64, at whole seconds, evenly spaced and increasing
+        for the binary encoding (the text one only keeps the first and the last)
+    values: array-like of numbers, the capacity at every time, NaN where missing
+    encoding: 'binary' (see the module documentation) or 'text', the format written before
+
+    Returns
+    -------
+    str
+    """
+    if encoding not in VECTOR_ENCODINGS:
+        raise ValueError(f"unknown capacity vector encoding {encoding}, expected one of {', '.join(VECTOR_ENCODINGS)}")
+    seconds = _epoch_seconds(times)
+    values = np.asarray(values)
+    if len(seconds) == 0 or len(seconds) != len(values):
+        raise ValueError(f"a capacity vector needs as many times as values, got {len(seconds)} and {len(values)}")
+
+    if encoding == 'text':
+        start, end = (datetime.fromtimestamp(int(value), timezone.utc).strftime(_TEXT_TIME_FORMAT)
+                      for value in (seconds[0], seconds[-1]))
+        return f"time: {start} - {end}, values: " + ''.join(f"{value}," for value in values.tolist())
+
+    steps = np.diff(seconds)
+    step = int(steps[0]) if len(steps) else 0
+    if len(steps) and (step <= 0 or (steps != step).any()):
+        raise ValueError("the times of a binary capacity vector must be evenly spaced and increasing")
+
+    numbers = values.astype(np.float64)
+    if np.isfinite(numbers).all() and (numbers == np.round(numbers)).all():
+        integers = numbers.astype(np.int64)
+        run_starts = np.flatnonzero(np.diff(integers, prepend=integers[0] - 1))
+        run_lengths = np.diff(run_starts, append=len(integers)).astype(np.uint64)
+        runs = np.column_stack([_zigzag(np.diff(integers[run_starts], prepend=0)), run_lengths]).ravel()
+        kind, payload = min([(_KIND_VARINT_DELTAS, _encode_varints(_zigzag(np.diff(integers, prepend=0)))),
+                             (_KIND_VARINT_RUNS, _encode_varints(runs))], key=lambda encoded: len(encoded[1]))
+    else:
+        kind, payload = _KIND_FLOAT32, numbers.astype('<f4').tobytes()
+    header = _HEADER.pack(VECTOR_ENCODING_VERSION, kind, int(seconds[0]), step, len(values))
+    return _PREFIX + base64.b64encode(header + payload).decode('ascii')
+
+
+def decode_capacity_vector(text):
+    """
+    Decodes a 'capacity_vector' field, binary or text.
+
+    Returns
+    -------
+    (np.ndarray of datetime64[s], np.ndarray of values), the values are int64 for the vectors of whole capacities and
+    float64 otherwise
+    """
+    if text.startswith('time:'):
+        return _decode_text(text)
+    if not text.startswith('v'):
+        raise ValueError(f"not a capacity vector: {text[:20]!r}")
+    version, _, encoded = text[1:].partition(':')
+    if version != str(VECTOR_ENCODING_VERSION):
+        raise ValueError(f"unsupported capacity vector version {version}")
+
+    data = base64.b64decode(encoded)
+    _, kind, start, step, count = _HEADER.unpack_from(data)
+    payload = np.frombuffer(data, dtype=np.uint8, offset=_HEADER.size)
+    if kind == _KIND_VARINT_DELTAS:
+        values = np.cumsum(_unzigzag(_decode_varints(payload)))
+    elif kind == _KIND_VARINT_RUNS:
+        runs = _decode_varints(payload).reshape(-1, 2)
+        values = np.repeat(np.cumsum(_unzigzag(runs[:, 0])), runs[:, 1].astype(np.int64))
+    elif kind == _KIND_FLOAT32:
+        values = payload.view('<f4').astype(np.float64)
+    else:
+        raise ValueError(f"unknown capacity vector kind {kind}")
+    if len(values) != count:
+        raise ValueError(f"capacity vector of {len(values)} values, expected {count}")
+    return _vector_times(start, step, count), values
+
+
+def _vector_times(start, step, count):
+    return (start + np.arange(count, dtype=np.int64) * step).astype('datetime64[s]')
+
+
+def _decode_text(text):
+    time_range, _, values = text[len('time:'):].partition(', values:')
+    start, end = (datetime.strptime(value.strip(), _TEXT_TIME_FORMAT) for value in time_range.split(' - '))
+    values = np.array([float(value) for value in values.split(',') if value.strip()])
+    if len(values) and (values == np.round(values)).all():
+        values = values.astype(np.int64)
+    # the text format only has the first and the last time, the values are taken as evenly spaced between them
+    step = (end - start).total_seconds() // (len(values) - 1) if len(values) > 1 else 0
+    return _vector_times(int(np.datetime64(start, 's').astype(np.int64)), int(step), len(values)), values
+
+
+def _epoch_seconds(times):
+    times = np.asarray(times)
+    if not np.issubdtype(times.dtype, np.datetime64):
+        # datetimes, aware ones are converted to UTC first
+        import pandas
+        times = pandas.to_datetime(pandas.Series(times), utc=True).dt.tz_localize(None).to_numpy()
+    return times.astype('datetime64[s]').astype(np.int64)
+
+
+def _zigzag(values):
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def _unzigzag(values):
+    return (values >> np.uint64(1)).view(np.int64) ^ -(values & np.uint64(1)).view(np.int64)
+
+
+def _encode_varints(values):
+    """LEB128 bytes of uint64 values, seven bits per byte, the high bit set on every byte but the last"""
+    n_bytes = 1 + (values[:, None] >= _VARINT_LIMITS).sum(axis=1)
+    value_of_byte = np.repeat(np.arange(len(values)), n_bytes)
+    ends = np.cumsum(n_bytes)
+    position = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - n_bytes, n_bytes)
+    groups = (values[value_of_byte] >> (np.uint64(7) * position.astype(np.uint64))) & np.uint64(0x7f)
+    last = position == n_bytes[value_of_byte] - 1
+    return (groups | np.where(last, np.uint64(0), np.uint64(0x80))).astype(np.uint8).tobytes()
+
+
+def _decode_varints(data):
+    """the uint64 values of LEB128 bytes"""
+    last = (data & 0x80) == 0
+    if len(data) and not last[-1]:
+        raise ValueError("truncated capacity vector")
+    ends = np.flatnonzero(last) + 1
+    if not len(ends):
+        return np.zeros(0, dtype=np.uint64)
+    starts = np.concatenate(([0], ends[:-1]))
+    position = np.arange(len(data)) - np.repeat(starts, ends - starts)
+    groups = (data & 0x7f).astype(np.uint64) << (np.uint64(7) * position.astype(np.uint64))
+    return np.add.reduceat(groups, starts)
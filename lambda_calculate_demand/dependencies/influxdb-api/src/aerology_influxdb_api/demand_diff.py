@@ -0,0 +1,116 @@
+"""
+Change detection of the demand writes, used by the 'changes' demand_write_mode of the InfluxDBHandler.
+
+Every run calculates the demand over the whole horizon again, but most bins keep their count from one run to the
+next. The cache remembers the demand points last written per (bucket, airport), as line protocol keyed by series and
+timestamp, and only lets the new and changed points through. A point written before and missing from the new demand
+(a bin of the demand cube that lost its last flight) is written again with a demand of 0, from the start of the
+horizon of the new demand on, the older ones have left the horizon. After `refresh_interval` every point is written
+again, which also repairs points lost on the Influx side.
+
+The cache lives in the handler, so the warm invocations of a Lambda share it and a cold start writes everything.
+
+    cache = DemandWriteCache(refresh_interval=6 * 3600)
+    diff = cache.diff('aerology.test', 'EWR', lines, start=1679698800)
+    write(diff.lines)
+    cache.commit('aerology.test', 'EWR', diff)  # once the lines are written
+"""
+import threading
+import time
+from collections import namedtuple
+
+DEFAULT_REFRESH_INTERVAL = 6 * 3600.0  # seconds between two full writes of the demand of an airport
+ZERO_DEMAND = 'demand=0i'  # field set of the bins that dropped out
+
+DemandDiff = namedtuple('DemandDiff', ['lines', 'skipped', 'zeroed', 'full', 'points'])
+DemandDiff.__doc__ = """the lines to write, the number of unchanged lines skipped and of dropped bins set to zero, if
+it is a full write, and the points (series and timestamp to field set) held once the lines are written"""
+
+
+class DemandWriteCache:
+    """
+    Demand points last written per (bucket, airport), see the module documentation.
+    """
+
+    def __init__(self, refresh_interval=DEFAULT_REFRESH_INTERVAL, clock=time.monotonic):
+        """
+        Parameters
+        ----------
+        refresh_interval: float, seconds after which the demand of an airport is written in full again, 0 writes it
+            in full every time
+        clock: function returning the current time in seconds
+        """
+        self._refresh_interval = refresh_interval
+        self._clock = clock
+        self._points = {}  # (bucket, airport) to the dict of point key to field set last written
+        self._refreshed = {}  # (bucket, airport) to the clock time of the last full write
+        self._lock = threading.Lock()
+
+    def diff(self, bucket, airport, lines, start=None):
+        """
+        The lines of a new demand of the airport to write, compared to the points last written.
+
+        Parameters
+        ----------
+        bucket, airport: str
+        lines: list of str, line protocol of the demand, lines without a timestamp are always written
+        start: int, optional, epoch seconds of the start of the horizon of the demand, every point written before at or
+            after it and missing from the lines is set to 0 (all of them for an empty demand). Defaults to the first
+            time of the lines.
+
+        Returns
+        -------
+        DemandDiff
+        """
+        with self._lock:
+            previous = self._points.get((bucket, airport))
+            refreshed = self._refreshed.get((bucket, airport))
+        full = previous is None or self._clock() - refreshed >= self._refresh_interval
+        previous = previous or {}
+
+        points = {}
+        changed = []
+        for line in lines:
+            point, fields = _split_line(line)
+            if point is None:
+                changed.append(line)
+                continue
+            points[point] = fields
+            if full or previous.get(point) != fields:
+                changed.append(line)
+        skipped = len(lines) - len(changed)
+
+        # the bins before the start of the horizon are left as they are
+        if start is None:
+            start = min((_timestamp(point) for point in points), default=None)
+        zeroed = [f"{series} {ZERO_DEMAND} {timestamp}"
+                  for series, timestamp in (point.rsplit(' ', 1) for point, fields in previous.items()
+                                            if point not in points and fields != ZERO_DEMAND)
+                  if start is not None and int(timestamp) >= start]
+        return DemandDiff(changed + zeroed, skipped, len(zeroed), full, points)
+
+    def commit(self, bucket, airport, diff):
+        """records the points of a diff as written"""
+        with self._lock:
+            self._points[(bucket, airport)] = diff.points
+            if diff.full:
+                self._refreshed[(bucket, airport)] = self._clock()
+
+    def clear(self):
+        """forgets every point, the next demand of every airport is written in full"""
+        with self._lock:
+            self._points.clear()
+            self._refreshed.clear()
+
+
+def _split_line(line):
+    """('series timestamp', field set) of a line, (None, None) for a line without timestamp"""
+    parts = line.rsplit(' ', 2)
+    if len(parts) < 3 or not parts[2].lstrip('-').isdigit():
+        return None, None
+    series, fields, timestamp = parts
+    return f"{series} {timestamp}", fields
+
+
+def _timestamp(point):
+    return int(point.rsplit(' ', 1)[1])
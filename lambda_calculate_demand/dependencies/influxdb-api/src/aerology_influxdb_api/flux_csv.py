@@ -0,0 +1,188 @@
+"""
+Streaming reader of the annotated CSV responses of Flux queries.
+
+`iter_flux_csv` parses the response as it arrives, in chunks of rows converted to typed numpy columns, without
+building a FluxRecord per row. `flux_csv_to_frame` builds the DataFrame of a whole response (as
+`query_api.query_data_frame`) and `pivot_flux_chunks` pivots the records to one column per field on integer codes
+(as `pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")`):
+
+    response = query_api.query_raw(query, org)
+    frame = pivot_flux_chunks(iter_flux_csv(response, columns=['_time', '_field', '_value']))
+"""
+import csv
+import io
+from operator import itemgetter
+
+import numpy as np
+import pandas
+
+DEFAULT_CHUNK_ROWS = 10000  # rows per chunk, bounds the memory of the parsed text
+
+_NUMBER_TYPES = {'long': np.int64, 'unsignedLong': np.uint64, 'double': np.float64}
+
+
+class FluxQueryError(Exception):
+    """error reported in the body of a query response"""
+
+    def __init__(self, message, reference=''):
+        super().__init__(message)
+        self.reference = reference
+
+
+def iter_flux_csv(response, chunk_rows=DEFAULT_CHUNK_ROWS, columns=None):
+    """
+    Parses an annotated CSV response in chunks of at most `chunk_rows` rows.
+
+    A chunk holds rows of one schema (the rows of consecutive tables with the same columns), as a dict of column name
+    to numpy array: datetime64[ns] (UTC) for dateTime columns, int64, uint64 and float64 for numbers (float64 with NaN
+    when values are missing), bool for booleans and object arrays of str for the other columns. Empty values take the
+    #default annotation of their column.
+
+    Parameters
+    ----------
+    response: file-like object of bytes or str (e.g. the response of `query_api.query_raw`), str or bytes
+    chunk_rows: int
+    columns: list of str, optional, the columns to parse, the others are skipped
+
+    Yields
+    ------
+    dict of str to numpy.ndarray
+
+    Raises
+    ------
+    FluxQueryError when the response reports an error
+    """
+    datatypes = defaults = names = None
+    rows = []
+    for row in csv.reader(_text_lines(response)):
+        if not row or row[0].startswith('#'):
+            # blank line or annotation: a new table schema follows
+            if rows:
+                yield _chunk(rows, names, datatypes, defaults, columns)
+                rows = []
+            names = None
+            if row and row[0] == '#datatype':
+                datatypes, defaults = row[1:], None
+            elif row and row[0] == '#default':
+                defaults = row[1:]
+            continue
+        if names is None:
+            names = row[1:]
+            continue
+        if names[:2] == ['error', 'reference']:
+            raise FluxQueryError(row[1], row[2] if len(row) > 2 else '')
+        rows.append(row)
+        if len(rows) >= chunk_rows:
+            yield _chunk(rows, names, datatypes, defaults, columns)
+            rows = []
+    if rows:
+        yield _chunk(rows, names, datatypes, defaults, columns)
+
+
+def flux_csv_to_frame(chunks):
+    """
+    DataFrame of the chunks of `iter_flux_csv`, with the dateTime columns as UTC timestamps.
+
+    Returns
+    -------
+    pandas.DataFrame, or a list of DataFrames (one per schema, in order of appearance) when the tables of the response
+    have different columns, as `query_api.query_data_frame`
+    """
+    parts = {}
+    for chunk in chunks:
+        parts.setdefault(tuple(chunk), []).append(chunk)
+
+    frames = []
+    for names, schema_chunks in parts.items():
+        frame = pandas.DataFrame({name: np.concatenate([chunk[name] for chunk in schema_chunks]) for name in names})
+        for name in names:
+            if frame[name].dtype.kind == 'M':
+                frame[name] = frame[name].dt.tz_localize('UTC')
+        frames.append(frame)
+
+    if not frames:
+        return pandas.DataFrame()
+    return frames[0] if len(frames) == 1 else frames
+
+
+def pivot_flux_chunks(chunks, row='_time', column='_field', value='_value'):
+    """
+    Pivots the records of the chunks of `iter_flux_csv` to one row per distinct `row` value and one column per
+    distinct `column` value, sorted by name. The labels of `column` are coded to integers chunk by chunk and the
+    values are placed in a numpy grid, the last value wins for a duplicate cell.
+
+    Returns
+    -------
+    pandas.DataFrame with the `row` column first (sorted), integer columns stay integer unless cells are missing (NaN)
+    """
+    codes = {}  # label of `column` to its code
+    row_parts, code_parts, value_parts = [], [], []
+    for chunk in chunks:
+        labels, inverse = np.unique(chunk[column], return_inverse=True)
+        lookup = np.array([codes.setdefault(label, len(codes)) for label in labels], dtype=np.int32)
+        code_parts.append(lookup[inverse.reshape(-1)])
+        row_parts.append(chunk[row])
+        value_parts.append(chunk[value])
+
+    if not row_parts:
+        return pandas.DataFrame({row: []})
+
+    row_values, row_index = np.unique(np.concatenate(row_parts), return_inverse=True)
+    values = np.concatenate(value_parts)
+    column_codes = np.concatenate(code_parts)
+    filled = np.zeros((len(row_values), len(codes)), dtype=bool)
+    filled[row_index, column_codes] = True
+
+    if values.dtype.kind in 'iub' and filled.all():
+        grid = np.empty(filled.shape, dtype=values.dtype)
+    elif values.dtype.kind in 'iubf':
+        grid = np.full(filled.shape, np.nan)
+    else:
+        grid = np.full(filled.shape, None, dtype=object)
+    grid[row_index, column_codes] = values
+
+    frame = pandas.DataFrame({row: row_values})
+    for label in sorted(codes):
+        frame[label] = grid[:, codes[label]]
+    return frame
+
+
+def _text_lines(response):
+    if isinstance(response, str):
+        return io.StringIO(response, newline='')
+    if isinstance(response, (bytes, bytearray)):
+        response = io.BytesIO(response)
+    if isinstance(response, io.TextIOBase):
+        return response
+    if hasattr(response, 'auto_close'):
+        # a urllib3 response would close itself once read, before the wrapper reaches the end of the text
+        response.auto_close = False
+    return io.TextIOWrapper(response, encoding='utf-8', newline='')
+
+
+def _chunk(rows, names, datatypes, defaults, columns):
+    chunk = {}
+    for position, name in enumerate(names):
+        if columns is not None and name not in columns:
+            continue
+        datatype = datatypes[position] if datatypes else 'string'
+        default = defaults[position] if defaults else ''
+        # the first value of a row is the (empty) annotation column
+        chunk[name] = _parse(list(map(itemgetter(position + 1), rows)), datatype, default)
+    return chunk
+
+
+def _parse(values, datatype, default):
+    if default and '' in values:
+        values = [value or default for value in values]
+    kind = datatype.split(':', 1)[0]
+    if kind == 'dateTime':
+        # numpy parses RFC3339 without the zone designator, Flux returns UTC times
+        return np.array([value.rstrip('Z') or 'NaT' for value in values], dtype='datetime64[ns]')
+    if kind in _NUMBER_TYPES:
+        if '' in values:
+            return np.array([value or 'nan' for value in values], dtype=np.float64)
+        return np.array(values, dtype=_NUMBER_TYPES[kind])
+    if kind == 'boolean':
+        return np.array([value == 'true' for value in values], dtype=bool)
+    return np.array(values, dtype=object)
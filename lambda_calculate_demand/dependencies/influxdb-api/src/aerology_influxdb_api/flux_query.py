@@ -0,0 +1,112 @@
+"""
+Builder of Flux queries that InfluxDB can push down to the storage engine.
+
+The storage engine runs `range()`, `filter()` on the measurement, fields and tags, `keep()` and `aggregateWindow()`
+(with the built-in aggregates) when they directly follow `from()`, and only sends the remaining rows and columns to
+the query engine. Functions such as `map()` or the `strings` package stop the pushdown and run on every row, so
+`build_flux_query` puts the pushed down stages first and any other stage after them:
+
+    build_flux_query('aerology.test', timedelta(hours=-3), timedelta(hours=48), 'capacity_prediction',
+                     fields=['predicted_capacity'], tags={'model_id': ['model_a', 'model_b']},
+                     keep=['_time', '_field', '_value', 'model_id'], window=timedelta(hours=1))
+"""
+from datetime import datetime, timedelta, timezone
+
+_DURATION_UNITS = [('h', 3600), ('m', 60), ('s', 1)]
+_AGGREGATES = {'mean', 'median', 'min', 'max', 'sum', 'count', 'first', 'last'}
+
+
+def build_flux_query(bucket, start, stop=None, measurement=None, fields=None, tags=None, keep=None, window=None,
+                     window_fn='mean', pivot_fields=False, stages=(), imports=()):
+    """
+    Parameters
+    ----------
+    bucket: str
+    start, stop: datetime (naive ones are UTC), epoch seconds, timedelta (relative to now) or a Flux time or
+        duration str (e.g. '-3h'), `stop` defaults to now
+    measurement: str, optional
+    fields: list of str, optional, the fields read
+    tags: dict of tag key to a value or a list of values, optional
+    keep: list of str, optional, the columns kept, the others are not sent by the storage engine
+    window: timedelta or Flux duration str, optional, aggregates the values in windows of this length
+    window_fn: str, aggregate of the window, one of mean, median, min, max, sum, count, first and last
+    pivot_fields: bool, pivot the fields to columns, one row per _time
+    stages: list of str, further stages of the query (without the leading '|>'), run by the query engine
+    imports: list of str, Flux packages imported by the stages, e.g. 'strings'
+
+    Returns
+    -------
+    str
+    """
+    range_arguments = f"start: {flux_time(start)}" + (f", stop: {flux_time(stop)}" if stop is not None else '')
+    header = ''.join(f"import {flux_string(package)}\n" for package in imports)
+    query = [f"from(bucket: {flux_string(bucket)})", f"range({range_arguments})"]
+
+    predicates = []
+    if measurement is not None:
+        predicates.append(f"r._measurement == {flux_string(measurement)}")
+    if fields:
+        predicates.append(_any_of('_field', fields))
+    for key, values in (tags or {}).items():
+        predicates.append(_any_of(key, values))
+    if predicates:
+        query.append(f"filter(fn: (r) => {' and '.join(predicates)})")
+
+    if keep:
+        if window is not None:
+            # the windows are built on the _start and _stop columns
+            keep = list(keep) + [column for column in ['_start', '_stop'] if column not in keep]
+        query.append(f"keep(columns: {_flux_list(keep)})")
+    if window is not None:
+        if window_fn not in _AGGREGATES:
+            raise ValueError(f"window_fn must be one of {sorted(_AGGREGATES)}, not {window_fn!r}")
+        every = flux_duration(window) if isinstance(window, timedelta) else window
+        query.append(f"aggregateWindow(every: {every}, fn: {window_fn}, createEmpty: false)")
+    if pivot_fields:
+        query.append('pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")')
+    query.extend(stages)
+    return header + '\n  |> '.join(query)
+
+
+def flux_time(value):
+    """
+    Flux literal of a range bound: datetimes as RFC3339 UTC times, epoch seconds as integers (Unix timestamps),
+    timedeltas as durations relative to now, strings are taken as Flux literals.
+    """
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat(timespec='microseconds' if value.microsecond else 'seconds') + 'Z'
+    if isinstance(value, timedelta):
+        return flux_duration(value)
+    if isinstance(value, (int, float)):
+        return str(int(value))
+    return value
+
+
+def flux_duration(value: timedelta):
+    """
+    Flux duration literal of a timedelta in whole seconds, e.g. '-3h', '90m'.
+    """
+    seconds = int(value.total_seconds())
+    sign, seconds = ('-' if seconds < 0 else ''), abs(seconds)
+    for unit, length in _DURATION_UNITS:
+        if seconds % length == 0:
+            return f"{sign}{seconds // length}{unit}"
+
+
+def flux_string(value):
+    """Flux string literal"""
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _flux_list(values):
+    return '[' + ', '.join(flux_string(value) for value in values) + ']'
+
+
+def _any_of(column, values):
+    if isinstance(values, (str, int, float)):
+        values = [values]
+    column = f"r.{column}" if column.isidentifier() else f"r[{flux_string(column)}]"
+    alternatives = [f"{column} == {flux_string(value)}" for value in values]
+    return alternatives[0] if len(alternatives) == 1 else '(' + ' or '.join(alternatives) + ')'
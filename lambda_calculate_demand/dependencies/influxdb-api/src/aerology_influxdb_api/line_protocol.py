@@ -0,0 +1,122 @@
+"""
+Vectorized InfluxDB line protocol encoding of DataFrames.
+
+Produces the same lines as building one influxdb_client.Point per row (tags and fields sorted by key, whole floats
+without the trailing '.0', missing tags and fields left out), but works on whole columns at a time.
+
+Times are written as epoch seconds. Naive datetimes are taken as UTC, not as the local time of the host (which
+`datetime.timestamp()` would use), and numbers, integer or float, are epoch seconds.
+"""
+import numpy as np
+import pandas
+
+_ESCAPE_MEASUREMENT = str.maketrans({'\\': '\\\\', ',': r'\,', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+_ESCAPE_KEY = str.maketrans({'\\': '\\\\', ',': r'\,', ' ': r'\ ', '=': r'\=', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+_ESCAPE_STRING = str.maketrans({'\\': '\\\\', '"': r'\"'})
+_EPOCH = pandas.Timestamp(0, tz='UTC')
+
+
+def dataframe_to_line_protocol(data: pandas.DataFrame, measurement: str, fields, time_column=None, tags=None,
+                               constant_tags=None):
+    """
+    Encodes every row of the DataFrame as one line of line protocol, with second precision timestamps.
+
+    Parameters
+    ----------
+    data: pandas.DataFrame
+    measurement: str
+    fields: dict of field key to column name, or a list of column names used as field keys
+    time_column: str, optional, column of datetimes (naive ones are taken as UTC), date strings or epoch seconds
+        (integers or floats, the fraction is dropped), rows without a time are written without timestamp
+    tags: dict of tag key to column name, or a list of column names used as tag keys, optional
+    constant_tags: dict of tag key to value added to every line, optional
+
+    Returns
+    -------
+    list of str, rows without any field value are left out
+    """
+    fields = _as_mapping(fields)
+    tags = _as_mapping(tags)
+    n_rows = len(data)
+
+    tag_segments = [(key, _tag_segment(key, data[column])) for key, column in tags.items()]
+    tag_segments += [(key, _tag_segment(key, pandas.Series([value] * n_rows, index=data.index)))
+                     for key, value in (constant_tags or {}).items()]
+    tag_set = _concat([segment for _, segment in sorted(tag_segments, key=lambda item: item[0])], n_rows)
+
+    # every present field comes with a leading comma, the one of the first field is cut off
+    field_set = _concat([_field_segment(key, data[column]) for key, column in sorted(fields.items())], n_rows).str[1:]
+
+    lines = measurement.translate(_ESCAPE_MEASUREMENT) + tag_set + ' ' + field_set
+    if time_column is not None:
+        lines = lines + _time_segment(data[time_column])
+
+    return lines[field_set != ''].tolist()
+
+
+def _as_mapping(columns):
+    if columns is None:
+        return {}
+    if isinstance(columns, dict):
+        return columns
+    return {column: column for column in columns}
+
+
+def _concat(segments, n_rows):
+    result = pandas.Series([''] * n_rows, dtype=object)
+    for segment in segments:
+        result = result + segment.to_numpy(dtype=object)
+    return result
+
+
+def _tag_segment(key, column):
+    values = column.astype(str).str.translate(_ESCAPE_KEY)
+    present = column.notna().to_numpy() & (values != '').to_numpy()
+    return pandas.Series(np.where(present, ',' + key.translate(_ESCAPE_KEY) + '=' + values, ''), dtype=object)
+
+
+def _field_segment(key, column):
+    """
+    `,key=value` per row, '' where the value is missing (or not finite for floats).
+    """
+    key = ',' + key.translate(_ESCAPE_KEY) + '='
+    if pandas.api.types.is_object_dtype(column.dtype):
+        inferred = pandas.api.types.infer_dtype(column, skipna=True)
+        if inferred in ('integer', 'floating', 'mixed-integer-float', 'decimal', 'boolean'):
+            column = pandas.to_numeric(column) if inferred != 'boolean' else column.astype('boolean')
+
+    if pandas.api.types.is_bool_dtype(column.dtype):
+        values = key + column.map({True: 'true', False: 'false'}).astype(object)
+        present = column.notna().to_numpy()
+    elif pandas.api.types.is_integer_dtype(column.dtype):
+        values = key + column.astype(str) + 'i'
+        present = column.notna().to_numpy()
+    elif pandas.api.types.is_float_dtype(column.dtype):
+        values = key + column.astype(str).str.replace(r'\.0$', '', regex=True)
+        present = np.isfinite(column.to_numpy(dtype=np.float64, na_value=np.nan))
+    else:
+        values = key + '"' + column.astype(str).str.translate(_ESCAPE_STRING) + '"'
+        present = column.notna().to_numpy()
+    return pandas.Series(np.where(present, values.to_numpy(dtype=object), ''), dtype=object)
+
+
+def epoch_seconds(column):
+    """
+    Epoch seconds of a column of datetimes (naive ones are taken as UTC), date strings (of mixed formats) or epoch
+    seconds (integers or floats, also in an object column, floored to whole seconds), as a nullable integer Series.
+    """
+    if pandas.api.types.is_integer_dtype(column.dtype):
+        return column.astype('Int64')
+    if pandas.api.types.is_float_dtype(column.dtype) or \
+            pandas.api.types.infer_dtype(column, skipna=True) in ('integer', 'floating', 'mixed-integer-float'):
+        # pandas.to_datetime would read the numbers as nanoseconds
+        return np.floor(pandas.to_numeric(column).astype(float)).astype('Int64')
+    times = pandas.to_datetime(column, utc=True, format='mixed')
+    return ((times - _EPOCH) // pandas.Timedelta(seconds=1)).astype('Int64')
+
+
+def _time_segment(column):
+    seconds = epoch_seconds(column)
+    present = seconds.notna().to_numpy()
+    values = ' ' + seconds.astype('Int64').astype(str)
+    return pandas.Series(np.where(present, values.to_numpy(dtype=object), ''), dtype=object)
@@ -0,0 +1,119 @@
+"""
+Read-through cache of the query results of the InfluxDBHandler.
+
+Results are kept for a time to live and the least recently used ones are evicted beyond `max_entries`. Every entry
+records the bucket and measurement it was read from, so that the handler can drop the entries of a measurement once
+it wrote to it. Every invalidation also moves the generation of the (bucket, measurement) on: a query that started
+before a write and returns after it is not cached, its generation is not the current one any more.
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+DEFAULT_QUERY_CACHE_SIZE = 128  # entries
+
+
+class QueryCache:
+    """
+    LRU cache with a time to live, keyed by (airport, query kind, normalized time range, ...) tuples.
+
+    usage:
+        cache = QueryCache(ttl=300)
+        result = cache.get(key)
+        if result is QueryCache.MISSING:
+            generation = cache.generation(('aerology.test', 'lane_status'))
+            result = run_query()
+            cache.put(key, ('aerology.test', 'lane_status'), result, generation)
+        cache.invalidate('aerology.test', 'lane_status')
+    """
+
+    MISSING = object()
+
+    def __init__(self, ttl, max_entries=DEFAULT_QUERY_CACHE_SIZE, clock=time.monotonic):
+        """
+        Parameters
+        ----------
+        ttl: float, seconds a result is served from the cache
+        max_entries: int, results kept at most, the least recently used are evicted first
+        clock: callable, returns the current time in seconds
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries = OrderedDict()  # key to (expiry time, (bucket, measurement), result)
+        self._generations = {}  # (bucket, measurement) to the number of its invalidations
+        self._generation = 0  # invalidations of every bucket or measurement
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'expirations': 0, 'evictions': 0, 'invalidations': 0, 'stale_puts': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        The cached result of the key, `QueryCache.MISSING` when it is not cached or has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self._clock():
+                del self._entries[key]
+                self.stats['expirations'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return self.MISSING
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[2]
+
+    def generation(self, source):
+        """
+        The current generation of the (bucket, measurement), to take before running a query and pass to `put`.
+        """
+        with self._lock:
+            return self._generation, self._generations.get(source, 0)
+
+    def put(self, key, source, result, generation=None):
+        """
+        Caches the result of the key, `source` is the (bucket, measurement) it was read from. With the `generation`
+        taken before the query, the result is dropped when the source was invalidated since.
+        """
+        with self._lock:
+            if generation is not None and generation != (self._generation, self._generations.get(source, 0)):
+                self.stats['stale_puts'] += 1
+                return
+            self._entries[key] = (self._clock() + self.ttl, source, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, bucket=None, measurement=None):
+        """
+        Drops the results read from the measurement of the bucket. None matches any bucket or measurement.
+        """
+        with self._lock:
+            if bucket is None or measurement is None:
+                self._generation += 1
+            else:
+                self._generations[(bucket, measurement)] = self._generations.get((bucket, measurement), 0) + 1
+            keys = [key for key, (_, (entry_bucket, entry_measurement), _) in self._entries.items()
+                    if bucket in (None, entry_bucket) and measurement in (None, entry_measurement)]
+            for key in keys:
+                del self._entries[key]
+            self.stats['invalidations'] += len(keys)
+
+
+def normalize_time(value):
+    """
+    Time range bound as a cache key: datetimes become epoch seconds (naive ones are UTC, as in the queries), whole
+    numbers become int, relative durations like '-3h' are kept.
+    """
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        value = value.timestamp()
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
@@ -0,0 +1,146 @@
+"""
+Time-sharded reads of long query windows, used by the range reads of the InfluxDBHandler.
+
+A long window is split into shards at the multiples of the shard length (counted from the epoch, so shards of a whole
+number of aggregation windows never cut one), the shards are read concurrently on a bounded thread pool, each with
+its own retries, and the results come back in time order to be stitched:
+
+    shards = time_shards(datetime(2023, 1, 1), datetime(2023, 3, 1), timedelta(days=1))
+    frames = read_shards(lambda start, stop: read_frame(build_query(start, stop)), shards, max_workers=4)
+    frame = stitch_results(frames)
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+
+from .async_writer import DEFAULT_RETRY_INTERVAL, DEFAULT_MAX_RETRY_DELAY, DEFAULT_EXPONENTIAL_BASE, \
+    _is_retryable, _retry_after
+
+DEFAULT_RANGE_WORKERS = 4  # shards read at the same time
+DEFAULT_RANGE_RETRIES = 3  # retries of a shard failing with 429/5xx or on the connection
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+_logger = logging.getLogger(__name__)
+
+
+class ShardReadError(Exception):
+    """
+    Raised when a shard could not be read after its retries, `shard` is its (start, stop) and the error of the last
+    attempt is the cause.
+    """
+
+    def __init__(self, shard, error):
+        self.shard = shard
+        super().__init__("could not read {} - {}: {}".format(shard[0].isoformat(), shard[1].isoformat(), error))
+
+
+def time_shards(start, stop, shard):
+    """
+    Splits [start, stop) at the multiples of `shard` since the epoch.
+
+    Parameters
+    ----------
+    start, stop: datetime (naive ones are UTC), epoch seconds or timedelta (relative to now)
+    shard: timedelta, a positive length
+
+    Returns
+    -------
+    list of (start, stop) tuples of UTC datetimes, empty when `stop` is not after `start`
+    """
+    if shard <= timedelta(0):
+        raise ValueError(f"shards must have a positive length, not {shard}")
+    now = datetime.now(timezone.utc)
+    start, stop = _as_datetime(start, now), _as_datetime(stop, now)
+
+    boundaries = [start]
+    boundary = _EPOCH + ((start - _EPOCH) // shard + 1) * shard
+    while boundary < stop:
+        boundaries.append(boundary)
+        boundary += shard
+    boundaries.append(stop)
+    return [(shard_start, shard_stop) for shard_start, shard_stop in zip(boundaries, boundaries[1:])
+            if shard_start < shard_stop]
+
+
+def read_shards(read_shard, shards, max_workers=DEFAULT_RANGE_WORKERS, max_retries=DEFAULT_RANGE_RETRIES,
+                retry_interval=DEFAULT_RETRY_INTERVAL, max_retry_delay=DEFAULT_MAX_RETRY_DELAY, progress=None):
+    """
+    Reads the shards concurrently, returns their results in the order of the shards.
+
+    Parameters
+    ----------
+    read_shard: function of the (start, stop) of a shard returning its result
+    shards: list of (start, stop), e.g. from `time_shards`
+    max_workers: int, shards read at the same time
+    max_retries: int, retries of a shard rejected with 429/5xx or failing on the connection, after `retry_interval`
+        seconds doubling on every retry (at most `max_retry_delay`, or the Retry-After of the response)
+    progress: function (shards done, number of shards, (start, stop) of the shard done), optional, called from the
+        calling thread as the shards complete
+
+    Returns
+    -------
+    list of the results, raises ShardReadError for the first shard that could not be read, the shards not started yet
+    are cancelled
+    """
+    results = [None] * len(shards)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(shards)) or 1) as executor:
+        futures = {executor.submit(_read_with_retry, read_shard, shard, max_retries, retry_interval, max_retry_delay):
+                   index for index, shard in enumerate(shards)}
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                index = futures[future]
+                results[index] = future.result()
+                _logger.info("read shard {}/{} ({} - {}), {:.1f}s elapsed".format(
+                    done, len(shards), shards[index][0].isoformat(), shards[index][1].isoformat(),
+                    time.perf_counter() - started))
+                if progress is not None:
+                    progress(done, len(shards), shards[index])
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return results
+
+
+def stitch_results(results):
+    """
+    Joins the results of the shards in order: DataFrames are concatenated (with a new index), lists (e.g. of
+    FluxTable) are chained, and a list of DataFrames of different columns per shard becomes one list.
+    """
+    import pandas
+
+    results = [result for result in results if result is not None]
+    if results and all(isinstance(result, pandas.DataFrame) for result in results):
+        return pandas.concat(results, ignore_index=True)
+    return [item for result in results for item in (result if isinstance(result, list) else [result])]
+
+
+def _read_with_retry(read_shard, shard, max_retries, retry_interval, max_retry_delay):
+    attempt = 0
+    while True:
+        try:
+            return read_shard(*shard)
+        except Exception as error:
+            if attempt >= max_retries or not _is_retryable(error):
+                raise ShardReadError(shard, error) from error
+            delay = _retry_after(error)
+            if delay is None:
+                delay = retry_interval * DEFAULT_EXPONENTIAL_BASE ** attempt
+            delay = min(delay, max_retry_delay)
+            _logger.warning("reading {} - {} failed ({}), retrying in {:.1f}s".format(
+                shard[0].isoformat(), shard[1].isoformat(), error, delay))
+            attempt += 1
+            time.sleep(delay)
+
+
+def _as_datetime(value, now):
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+    if isinstance(value, timedelta):
+        return now + value
+    if isinstance(value, (int, float)):
+        return _EPOCH + timedelta(seconds=value)
+    raise ValueError(f"can not shard the range bound {value!r}, use datetimes, epoch seconds or timedeltas")
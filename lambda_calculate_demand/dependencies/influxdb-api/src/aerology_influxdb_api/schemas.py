@@ -14,6 +14,82 @@ configuration_json_schema = {
                 },
                 "org": {
                     "type": "string"
+                },
+                "enable_gzip": {
+                    "type": "boolean"
+                },
+                "write_batch_size": {
+                    "type": "integer",
+                    "minimum": 1
+                },
+                "write_mode": {
+                    "enum": ["synchronous", "asynchronous"]
+                },
+                "flush_interval_ms": {
+                    "type": "integer",
+                    "minimum": 0
+                },
+                "write_queue_size": {
+                    "type": "integer",
+                    "minimum": 1
+                },
+                "max_retries": {
+                    "type": "integer",
+                    "minimum": 0
+                },
+                "retry_interval_ms": {
+                    "type": "integer",
+                    "minimum": 0
+                },
+                "max_retry_delay_ms": {
+                    "type": "integer",
+                    "minimum": 0
+                },
+                "query_cache_ttl_ms": {
+                    "type": "integer",
+                    "minimum": 0
+                },
+                "query_cache_size": {
+                    "type": "integer",
+                    "minimum": 1
+                },
+                "query_mode": {
+                    "enum": ["records", "streaming"]
+                },
+                "query_chunk_rows": {
+                    "type": "integer",
+                    "minimum": 1
+                },
+                "store_init_timestamp": {
+                    "type": "boolean"
+                },
+                "demand_airport_tag": {
+                    "type": "boolean"
+                },
+                "metrics_bucket": {
+                    "type": "string"
+                },
+                "capacity_vector_encoding": {
+                    "enum": ["text", "binary"]
+                },
+                "range_shard_ms": {
+                    "type": "integer",
+                    "minimum": 0
+                },
+                "range_workers": {
+                    "type": "integer",
+                    "minimum": 1
+                },
+                "range_retries": {
+                    "type": "integer",
+                    "minimum": 0
+                },
+                "demand_write_mode": {
+                    "enum": ["full", "changes"]
+                },
+                "demand_refresh_ms": {
+                    "type": "integer",
+                    "minimum": 0
                 }
             },
             "required": [
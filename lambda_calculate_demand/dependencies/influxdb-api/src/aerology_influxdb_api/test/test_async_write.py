@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+from aerology_influxdb_api.async_writer import AsyncLineWriter, WriteFailedError
+from aerology_influxdb_api.testing import InfluxStub
+
+
+@pytest.fixture
+def influx_stub():
+    with InfluxStub() as stub:
+        yield stub
+
+
+def _demand(n_points):
+    valid_time = pd.date_range('2023-03-24 21:00', periods=n_points, freq='h', tz='UTC')
+    return pd.DataFrame({'valid_time': valid_time, 'demand': range(n_points)})
+
+
+def _async_handler(stub, tmp_path, **influx_options):
+    options = dict({'write_mode': 'asynchronous', 'retry_interval_ms': 10}, **influx_options)
+    return InfluxDBHandler(stub.write_config(tmp_path / 'config.json', **options))
+
+
+def test_async_push_returns_before_write(influx_stub, tmp_path):
+    influx_stub.latency = 0.3
+    with _async_handler(influx_stub, tmp_path) as handler:
+        start = time.perf_counter()
+        handler.push_demand(_demand(10), 'EWR')
+        assert time.perf_counter() - start < 0.3
+        assert handler.asynchronous
+
+    assert len(influx_stub.lines) == 10
+
+
+def test_async_batches_across_pushes(influx_stub, tmp_path):
+    with _async_handler(influx_stub, tmp_path, write_batch_size=4, flush_interval_ms=60000) as handler:
+        for _ in range(3):
+            handler.push_demand(_demand(3), 'EWR')
+        handler.flush()
+        # two full batches while pushing, the last line on flush
+        assert [len(request['body'].split(b'\n')) for request in influx_stub.requests] == [4, 4, 1]
+
+
+def test_async_flush_interval(influx_stub, tmp_path):
+    with _async_handler(influx_stub, tmp_path, flush_interval_ms=50) as handler:
+        handler.push_demand(_demand(2), 'EWR')
+        time.sleep(0.5)
+        assert len(influx_stub.lines) == 2
+
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_async_retries(influx_stub, tmp_path, status):
+    influx_stub.fail_writes(status, times=2)
+    with _async_handler(influx_stub, tmp_path) as handler:
+        handler.push_demand(_demand(5), 'EWR')
+        handler.flush()
+
+    assert [request['status'] for request in influx_stub.requests] == [status, status, 204]
+    assert len(influx_stub.lines) == 5
+
+
+def test_async_reports_lost_points(influx_stub, tmp_path):
+    influx_stub.fail_writes(400)
+    handler = _async_handler(influx_stub, tmp_path)
+    handler.push_demand(_demand(5), 'EWR')
+
+    with pytest.raises(WriteFailedError) as error:
+        handler.close()
+    bucket, lines, _ = error.value.failed_batches[0]
+    assert bucket == 'aerology.test' and len(lines) == 5
+    assert len(influx_stub.requests) == 1
+
+
+def test_writer_blocks_when_queue_is_full():
+    release = threading.Event()
+    sent = []
+
+    def send(bucket, lines):
+        release.wait()
+        sent.extend(lines)
+
+    writer = AsyncLineWriter(send, batch_size=1, queue_size=1)
+    writer.write('bucket', ['a'])  # taken by the flusher, which waits in send
+    time.sleep(0.1)
+    writer.write('bucket', ['b'])  # fills the queue
+
+    blocked = threading.Thread(target=writer.write, args=('bucket', ['c']))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+
+    release.set()
+    blocked.join()
+    writer.close()
+    assert sent == ['a', 'b', 'c']
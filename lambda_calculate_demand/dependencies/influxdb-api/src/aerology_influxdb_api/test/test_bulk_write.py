@@ -0,0 +1,133 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+from influxdb_client import Point
+from influxdb_client.domain.write_precision import WritePrecision
+
+from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+from aerology_influxdb_api.line_protocol import dataframe_to_line_protocol, epoch_seconds
+from aerology_influxdb_api.testing import InfluxStub
+
+
+@pytest.fixture
+def influx_stub():
+    with InfluxStub() as stub:
+        yield stub
+
+
+def test_line_protocol_matches_points():
+    data = pd.DataFrame({
+        'valid_time': pd.to_datetime(['2023-03-24 21:00', '2023-03-24 22:00', '2023-03-24 23:00']),
+        'demand': [3, 5, 10],
+        'variance': [1.0, np.nan, 2.5],
+        'comment': ['a "quoted" text', 'a,b', None],
+        'model_id': ['model 1', '', 'model=2'],
+    })
+
+    lines = dataframe_to_line_protocol(data, 'demand', fields=['demand', 'variance', 'comment'],
+                                       time_column='valid_time', tags=['model_id'], constant_tags={'airport': 'EWR'})
+
+    expected = []
+    for _, row in data.iterrows():
+        point = Point('demand').tag('model_id', row['model_id']).tag('airport', 'EWR') \
+            .field('demand', row['demand']).field('comment', row['comment']) \
+            .time(row['valid_time'], WritePrecision.S)
+        if not np.isnan(row['variance']):
+            point.field('variance', row['variance'])
+        expected.append(point.to_line_protocol())
+    assert lines == expected
+
+
+def test_line_protocol_skips_rows_without_fields():
+    data = pd.DataFrame({'status_time': [1679691600, 1679695200], 'runway_04L': [np.nan, 1.0]})
+
+    assert dataframe_to_line_protocol(data, 'lane_status', ['runway_04L'], 'status_time') == \
+           ['lane_status runway_04L=1 1679695200']
+
+
+def test_epoch_seconds():
+    # naive datetimes are UTC, numbers are epoch seconds
+    naive = pd.Series([datetime.datetime(2023, 3, 24, 21), datetime.datetime(2023, 3, 24, 22), None])
+    assert epoch_seconds(naive).tolist() == [1679691600, 1679695200, pd.NA]
+    assert epoch_seconds(pd.Series([1679691600.0, 1679695200.9, np.nan])).tolist() == [1679691600, 1679695200, pd.NA]
+    assert epoch_seconds(pd.Series([1679691600, 1679695200.5, None], dtype=object)).tolist() == \
+           [1679691600, 1679695200, pd.NA]
+    assert epoch_seconds(pd.Series(['2023-03-24T21:00:00Z', '2023-03-24 22:00', None])).tolist() == \
+           [1679691600, 1679695200, pd.NA]
+    assert epoch_seconds(pd.Series([1679691600, 1679695200, None], dtype='Int64')).tolist() == \
+           [1679691600, 1679695200, pd.NA]
+    assert dataframe_to_line_protocol(pd.DataFrame({'status_time': [1679691600.0], 'runway_04L': [1]}),
+                                      'lane_status', ['runway_04L'], 'status_time') == \
+           ['lane_status runway_04L=1i 1679691600']
+
+
+def test_push_demand_batches(influx_stub, tmp_path):
+    handler = InfluxDBHandler(influx_stub.write_config(tmp_path / 'config.json', write_batch_size=4))
+    valid_time = pd.date_range('2023-03-24 21:00', periods=10, freq='h', tz='UTC')
+    demand = pd.DataFrame({'valid_time': valid_time, 'demand': range(10)})
+
+    handler.push_demand(demand, 'EWR')
+
+    writes = influx_stub.requests
+    assert [len(request['body'].split(b'\n')) for request in writes] == [4, 4, 2]
+    assert all(request['headers'].get('Content-Encoding') == 'gzip' for request in writes)
+    assert writes[0]['query'] == {'org': ['aerology'], 'bucket': ['aerology.test'], 'precision': ['s']}
+    assert influx_stub.lines[0] == 'demand demand=0i 1679691600'
+    assert handler.write_stats['points'] == 10
+    assert handler.write_stats['requests'] == 3
+
+
+def test_push_demands_one_write_per_bucket(influx_stub, tmp_path):
+    airports = [{"short_name": name, "influx_bucket": "aerology.test", "lane_names": []} for name in ['EWR', 'JFK']]
+    handler = InfluxDBHandler(influx_stub.write_config(tmp_path / 'config.json', airports=airports,
+                                                      demand_airport_tag=True))
+    demand = pd.DataFrame({'valid_time': ["2023-03-24 21:00:00+00:00", "2023-03-24 22:00:00+00:00"],
+                           'demand': [3, 5]})
+
+    handler.push_demands({'EWR': demand, 'JFK': demand, 'LGA': demand})
+
+    # the airports share the bucket, with demand_airport_tag each one writes its own series
+    assert len(influx_stub.requests) == 1
+    assert influx_stub.lines == ['demand,airport=EWR demand=3i 1679691600', 'demand,airport=EWR demand=5i 1679695200',
+                                 'demand,airport=JFK demand=3i 1679691600', 'demand,airport=JFK demand=5i 1679695200']
+
+
+def test_push_demands_series_key_unchanged_by_default(influx_stub, tmp_path):
+    airports = [{"short_name": name, "influx_bucket": "aerology.test", "lane_names": []} for name in ['EWR', 'JFK']]
+    handler = InfluxDBHandler(influx_stub.write_config(tmp_path / 'config.json', airports=airports))
+    demand = pd.DataFrame({'valid_time': ["2023-03-24 21:00:00+00:00"], 'demand': [3], 'airport': ['EWR']})
+
+    handler.push_demand(demand, 'EWR')
+    with pytest.warns(UserWarning, match='demand_airport_tag'):
+        handler.push_demands({'EWR': demand[['valid_time', 'demand']], 'JFK': demand[['valid_time', 'demand']]})
+
+    # the hourly demand keeps the series key written before the airport tag, an airport column is a tag as before
+    assert influx_stub.lines == ['demand,airport=EWR demand=3i 1679691600',
+                                 'demand demand=3i 1679691600', 'demand demand=3i 1679691600']
+
+
+def test_push_demand_tags(influx_stub, tmp_path):
+    handler = InfluxDBHandler(influx_stub.write_config(tmp_path / 'config.json'))
+    cube = pd.DataFrame({'valid_time': pd.to_datetime([1679691600] * 3, unit='s', utc=True), 'demand': [7, 4, 3],
+                         'landing_time': ['scheduled'] * 3, 'origin': [None, 'ORD', 'unknown']})
+
+    handler.push_demand(cube, 'EWR')
+
+    assert influx_stub.lines == ['demand,landing_time=scheduled demand=7i 1679691600',
+                                 'demand,landing_time=scheduled,origin=ORD demand=4i 1679691600',
+                                 'demand,landing_time=scheduled,origin=unknown demand=3i 1679691600']
+
+
+def test_push_flight_calculations(influx_stub, tmp_path):
+    handler = InfluxDBHandler(influx_stub.write_config(tmp_path / 'config.json', enable_gzip=False))
+    current_time = datetime.datetime(2023, 3, 24, 21)
+    data = [{"_time": current_time, "predicted_delay": 100, "published_delay": 250,
+             "eta_hour": "2022-03-01T00:00:00Z", "slt_hour": "2022-03-01T01:00:00Z", "flight_id": "ABC123"}]
+
+    handler.push_flight_calculations(data, 'EWR')
+
+    assert 'Content-Encoding' not in influx_stub.requests[0]['headers']
+    assert influx_stub.lines == ['delay_calculations,eta_hour=2022-03-01T00:00:00Z,flight_id=ABC123,'
+                                 'slt_hour=2022-03-01T01:00:00Z predicted_delay=100i,published_delay=250i 1679691600']
@@ -0,0 +1,81 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+from aerology_influxdb_api.capacity_vector import encode_capacity_vector, decode_capacity_vector
+from aerology_influxdb_api.testing import InfluxStub
+
+TIMES = pd.date_range('2022-11-09 10:00', periods=9, freq='15min')
+
+
+def _vector_response(points):
+    """annotated CSV response of a query of the capacity_vector field, points of (init_time, message_type, vector)"""
+    lines = ['#datatype,string,long,dateTime:RFC3339,dateTime:RFC3339,dateTime:RFC3339,string,string,string,string',
+             '#group,false,false,true,true,false,false,true,true,true',
+             '#default,_result,,,,,,,,',
+             ',result,table,_start,_stop,_time,_value,_field,_measurement,message_type']
+    for table, (init_time, message_type, vector) in enumerate(points):
+        lines.append(f',,{table},2022-11-09T00:00:00Z,2022-11-10T00:00:00Z,{init_time:%Y-%m-%dT%H:%M:%SZ},'
+                     f'"{vector}",capacity_vector,gdp_apt_capacity,{message_type}')
+    return '\r\n'.join(lines) + '\r\n\r\n'
+
+
+@pytest.mark.parametrize('values', [
+    [100, 150, 200, 250, 300, 350, 400, 450, 500],
+    [40, 38, -3, 2 ** 40, 0, 0, 7, 7, 1],
+    [40.5, 38.25, np.nan, 41, 42, 43, 44, 45, 46],
+])
+def test_round_trip(values):
+    times, decoded = decode_capacity_vector(encode_capacity_vector(TIMES, values))
+
+    assert np.array_equal(times, TIMES.to_numpy().astype('datetime64[s]'))
+    assert np.array_equal(decoded, np.array(values, dtype=decoded.dtype), equal_nan=True)
+    assert decoded.dtype == (np.float64 if np.isnan(values).any() or values[0] == 40.5 else np.int64)
+
+
+def test_compact_and_text_compatible():
+    times = pd.date_range('2022-11-09', periods=24 * 60, freq='min')
+    capacity = 40 + np.arange(24 * 60) // 60
+
+    binary = encode_capacity_vector(times, capacity)
+    text = encode_capacity_vector(times, capacity, encoding='text')
+
+    assert len(binary) * 10 < len(text)
+    assert text.startswith('time: 09/11/22 00:00 - 09/11/22 23:59, values: 40,40,')
+    for encoded in (binary, text):
+        decoded_times, decoded = decode_capacity_vector(encoded)
+        assert np.array_equal(decoded, capacity) and decoded_times[-1] == np.datetime64('2022-11-09T23:59')
+
+    assert decode_capacity_vector(encode_capacity_vector(times[:1], [42]))[1].tolist() == [42]
+    with pytest.raises(ValueError):
+        encode_capacity_vector(times[[0, 1, 3]], [1, 2, 3])
+    with pytest.raises(ValueError):
+        decode_capacity_vector('v9:AAAA')
+
+
+@pytest.mark.parametrize('query_mode', ['records', 'streaming'])
+def test_push_and_query_vectors(tmp_path, query_mode):
+    capacity = pd.DataFrame({'time': TIMES, 'capacity': [100, 150, 200, 250, 300, 350, 400, 450, 500]})
+    init_time = datetime(2022, 11, 9, 9, 30)
+    with InfluxStub() as stub:
+        handler = InfluxDBHandler(stub.write_config(tmp_path / 'config.json', capacity_vector_encoding='binary',
+                                                    query_mode=query_mode))
+        handler.push_vectoral_capacity_measurements(capacity, init_time, 'EWR', 'APTC')
+        line, = stub.lines
+        binary = line.split('"')[1]
+        legacy = encode_capacity_vector(TIMES, capacity['capacity'], encoding='text')
+
+        stub.respond_to_queries(_vector_response([(init_time, 'APTC', binary), (init_time, 'ATCSCC', legacy)]))
+        vectors = handler.querry_vectoral_capacity_measurements('EWR', datetime(2022, 11, 9), datetime(2022, 11, 10))
+        handler.close()
+
+    assert line == f'gdp_apt_capacity,message_type=APTC capacity_vector="{binary}" 1667986200'
+    assert list(vectors.columns) == ['init_time', 'message_type', 'time', 'capacity']
+    assert vectors['init_time'].eq(pd.Timestamp(init_time)).all()
+    for message_type in ['APTC', 'ATCSCC']:
+        vector = vectors[vectors['message_type'] == message_type]
+        assert vector['capacity'].tolist() == capacity['capacity'].tolist()
+        assert np.array_equal(vector['time'].to_numpy().astype('datetime64[s]'), TIMES.to_numpy())
@@ -0,0 +1,106 @@
+import pandas as pd
+import pytest
+
+from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+from aerology_influxdb_api.async_writer import WriteFailedError
+from aerology_influxdb_api.demand_diff import DemandWriteCache
+from aerology_influxdb_api.testing import InfluxStub
+
+AIRPORTS = [{"short_name": name, "influx_bucket": "aerology.test", "lane_names": []} for name in ['EWR', 'JFK']]
+
+
+def _demand(counts, start='2023-03-24 21:00'):
+    return pd.DataFrame({'valid_time': pd.date_range(start, periods=len(counts), freq='h', tz='UTC'),
+                         'demand': counts})
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_demand_write_cache():
+    clock = _Clock()
+    cache = DemandWriteCache(refresh_interval=3600, clock=clock)
+    lines = ['demand demand=3i 100', 'demand,origin=ORD demand=2i 100', 'demand demand=5i 200',
+             'demand,origin=ORD demand=1i 200', 'demand demand=1i']
+
+    diff = cache.diff('aerology.test', 'EWR', lines)
+    assert diff.lines == lines and diff.full and diff.skipped == 0
+    cache.commit('aerology.test', 'EWR', diff)
+
+    # one changed bin, one ORD bin dropped out, the line without timestamp is always written
+    diff = cache.diff('aerology.test', 'EWR', ['demand demand=3i 100', 'demand,origin=ORD demand=2i 100',
+                                               'demand demand=6i 200', 'demand demand=1i'])
+    assert diff.lines == ['demand demand=6i 200', 'demand demand=1i', 'demand,origin=ORD demand=0i 200']
+    assert (diff.skipped, diff.zeroed, diff.full) == (2, 1, False)
+    assert cache.diff('aerology.test', 'JFK', ['demand demand=3i 100']).full
+    cache.commit('aerology.test', 'EWR', diff)
+
+    # an hour later: the bin at 100 left the horizon and is not zeroed, the next diff is a full one
+    diff = cache.diff('aerology.test', 'EWR', ['demand demand=6i 200', 'demand demand=4i 300'])
+    assert diff.lines == ['demand demand=4i 300'] and diff.zeroed == 0
+    clock.now = 3600
+    assert cache.diff('aerology.test', 'EWR', ['demand demand=6i 200']).full
+    cache.clear()
+    assert cache.diff('aerology.test', 'EWR', ['demand demand=6i 200']).full
+
+
+def test_demand_write_cache_horizon_start():
+    cache = DemandWriteCache(refresh_interval=3600, clock=_Clock())
+    cache.commit('aerology.test', 'EWR', cache.diff('aerology.test', 'EWR', [
+        'demand,origin=ORD demand=2i 100', 'demand,origin=ORD demand=1i 200', 'demand,origin=BOS demand=1i 300'],
+        start=100))
+
+    # the early ORD bin lost its flights, it is before the first time of the new demand but not of its horizon
+    diff = cache.diff('aerology.test', 'EWR', ['demand,origin=BOS demand=1i 300'], start=200)
+    assert diff.lines == ['demand,origin=ORD demand=0i 200']
+
+    # an empty demand zeroes every point of the horizon
+    diff = cache.diff('aerology.test', 'EWR', [], start=100)
+    assert diff.lines == ['demand,origin=ORD demand=0i 100', 'demand,origin=ORD demand=0i 200',
+                          'demand,origin=BOS demand=0i 300'] and diff.zeroed == 3
+
+
+def test_push_changed_demand(tmp_path):
+    with InfluxStub() as stub:
+        handler = InfluxDBHandler(stub.write_config(tmp_path / 'config.json', airports=AIRPORTS,
+                                                    demand_write_mode='changes', demand_airport_tag=True))
+        handler.push_demands({'EWR': _demand([3, 5, 0, 2]), 'JFK': _demand([1, 1, 1, 1])})
+        handler.push_demands({'EWR': _demand([5, 0, 4, 0], start='2023-03-24 22:00'),
+                              'JFK': _demand([1, 1, 1, 1])})
+        handler.push_demand(_demand([3, 5, 0, 2]), 'JFK')
+        # the EWR flights of 22:00 left, the demand only holds a later bin (23:00 was written as 0 already)
+        handler.push_demands({'EWR': _demand([1], start='2023-03-25 00:00')},
+                             horizon_start=pd.Timestamp('2023-03-24 22:00', tz='UTC'))
+        handler.close()
+
+    first, second, third, fourth = [request['body'].decode('utf-8').split('\n') for request in stub.requests]
+    assert len(first) == 8
+    assert second == ['demand,airport=EWR demand=4i 1679702400', 'demand,airport=EWR demand=0i 1679706000']
+    assert third == ['demand,airport=JFK demand=3i 1679691600', 'demand,airport=JFK demand=5i 1679695200',
+                     'demand,airport=JFK demand=0i 1679698800', 'demand,airport=JFK demand=2i 1679702400']
+    assert fourth == ['demand,airport=EWR demand=1i 1679702400', 'demand,airport=EWR demand=0i 1679695200']
+    assert handler.write_stats['skipped'] == 2 + 4
+    assert handler.write_stats['points'] == 16
+
+
+def test_failed_async_write_clears_cache(tmp_path):
+    with InfluxStub() as stub:
+        handler = InfluxDBHandler(stub.write_config(tmp_path / 'config.json', demand_write_mode='changes',
+                                                    write_mode='asynchronous', max_retries=0))
+        handler.push_demand(_demand([3, 5]), 'EWR')
+        handler.flush()
+
+        stub.fail_writes(status=400)
+        handler.push_demand(_demand([3, 6]), 'EWR')
+        with pytest.raises(WriteFailedError):
+            handler.flush()
+
+        handler.push_demand(_demand([3, 6]), 'EWR')
+        handler.close()
+
+    assert [len(request['body'].split(b'\n')) for request in stub.requests] == [2, 1, 2]
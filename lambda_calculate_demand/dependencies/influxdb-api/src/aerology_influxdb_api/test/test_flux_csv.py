@@ -0,0 +1,118 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+from aerology_influxdb_api.flux_csv import iter_flux_csv, flux_csv_to_frame, pivot_flux_chunks, FluxQueryError
+from aerology_influxdb_api.testing import InfluxStub, flux_csv_response
+
+MIXED_RESPONSE = '\r\n'.join([
+    '#datatype,string,long,dateTime:RFC3339,double,string,boolean',
+    '#group,false,false,false,false,true,false',
+    '#default,_result,,,,,',
+    ',result,table,_time,_value,_field,ok',
+    ',,0,2023-02-01T05:00:00Z,1.5,predicted_capacity,true',
+    ',,0,2023-02-01T06:00:00Z,,predicted_capacity,false',
+    ',,1,2023-02-01T05:00:00.5Z,3,"quoted, field",true',
+    '',
+    '#datatype,string,long,dateTime:RFC3339,long',
+    '#group,false,false,false,false',
+    '#default,_result,,,',
+    ',result,table,_time,_value',
+    ',,2,2023-02-01T07:00:00Z,7',
+    '', ''])
+
+
+def _lane_status(hours=6):
+    times = pd.date_range('2023-02-01 05:00', periods=hours * 60, freq='min')
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({'_time': times, **{lane: rng.integers(0, 2, len(times))
+                                            for lane in ['runway_04L', 'runway_04R', 'runway_11']}})
+
+
+def test_iter_flux_csv_types():
+    chunks = list(iter_flux_csv(MIXED_RESPONSE))
+
+    assert [len(chunk['table']) for chunk in chunks] == [3, 1]
+    first = chunks[0]
+    assert first['result'].tolist() == ['_result'] * 3
+    assert first['table'].dtype == np.int64
+    assert np.array_equal(first['_time'], np.array(['2023-02-01T05:00:00', '2023-02-01T06:00:00',
+                                                    '2023-02-01T05:00:00.5'], dtype='datetime64[ns]'))
+    assert np.array_equal(first['_value'], [1.5, np.nan, 3.0], equal_nan=True)
+    assert first['_field'].tolist() == ['predicted_capacity', 'predicted_capacity', 'quoted, field']
+    assert first['ok'].tolist() == [True, False, True]
+    assert chunks[1]['_value'].dtype == np.int64
+
+
+def test_iter_flux_csv_chunks_and_columns():
+    response = flux_csv_response(_lane_status(), 'lane_status').encode('utf-8')
+    whole = list(iter_flux_csv(response))
+    chunks = list(iter_flux_csv(response, chunk_rows=100, columns=['_time', '_value']))
+
+    assert len(whole) == 1 and len(chunks) == 11  # 1080 rows
+    assert set(chunks[0]) == {'_time', '_value'}
+    for column in ['_time', '_value']:
+        assert np.array_equal(np.concatenate([chunk[column] for chunk in chunks]), whole[0][column])
+
+
+def test_flux_csv_to_frame():
+    frames = flux_csv_to_frame(iter_flux_csv(MIXED_RESPONSE, chunk_rows=2))
+
+    assert [len(frame) for frame in frames] == [3, 1]
+    assert str(frames[0]['_time'].dt.tz) == 'UTC'
+    assert flux_csv_to_frame(iter_flux_csv('')).empty
+
+
+def test_flux_query_error():
+    response = '#datatype,string,string\r\n#group,true,true\r\n#default,,\r\n,error,reference\r\n' \
+               ',"failed to compile query",897\r\n'
+    with pytest.raises(FluxQueryError, match='failed to compile query'):
+        list(iter_flux_csv(response))
+
+
+def test_pivot_flux_chunks():
+    lanes = _lane_status()
+    response = flux_csv_response(lanes, 'lane_status')
+
+    pivoted = pivot_flux_chunks(iter_flux_csv(response, chunk_rows=250))
+
+    assert list(pivoted.columns) == ['_time', 'runway_04L', 'runway_04R', 'runway_11']
+    assert pivoted['runway_11'].dtype == np.int64
+    pd.testing.assert_frame_equal(pivoted.drop(columns='_time'), lanes.drop(columns='_time'))
+    assert np.array_equal(pivoted['_time'].to_numpy(), lanes['_time'].to_numpy())
+
+    # missing cells
+    lanes.loc[3, 'runway_11'] = None
+    pivoted = pivot_flux_chunks(iter_flux_csv(flux_csv_response(lanes, 'lane_status'), chunk_rows=250))
+    assert np.isnan(pivoted.loc[3, 'runway_11']) and pivoted['runway_04L'].dtype == np.float64
+
+
+@pytest.mark.parametrize('enable_gzip', [True, False])
+def test_handler_streaming_queries(tmp_path, enable_gzip):
+    lanes = _lane_status()
+    with InfluxStub() as stub:
+        stub.respond_to_queries(flux_csv_response(lanes, 'lane_status'))
+        records = InfluxDBHandler(stub.write_config(tmp_path / 'records.json', enable_gzip=enable_gzip))
+        streaming = InfluxDBHandler(stub.write_config(tmp_path / 'streaming.json', enable_gzip=enable_gzip,
+                                                      query_mode='streaming', query_chunk_rows=100))
+
+        start_time, end_time = datetime(2023, 2, 1, 5), datetime(2023, 2, 1, 10)
+        expected = records.query_lane_status('EWR', start_time, end_time)
+        result = streaming.query_lane_status('EWR', start_time, end_time)
+
+        pd.testing.assert_frame_equal(result.drop(columns='valid_time'), expected.drop(columns='valid_time'))
+        assert np.array_equal(result['valid_time'].to_numpy(), expected['valid_time'].to_numpy())
+        assert 'range(start: 2023-02-01T05:00:00Z' in stub.requests[-1]['body'].decode('utf-8')
+
+        expected = records.query_capacity_predictions_for_slotting('EWR')
+        result = streaming.query_capacity_predictions_for_slotting('EWR')
+        assert list(result.columns) == list(expected.columns)
+        assert result['_value'].tolist() == expected['_value'].tolist()
+        assert result['_time'].tolist() == expected['_time'].tolist()
+
+        assert sum(len(chunk['_value']) for chunk in streaming.query_stream('from(bucket:"aerology.test")')) == 1080
+        records.close()
+        streaming.close()
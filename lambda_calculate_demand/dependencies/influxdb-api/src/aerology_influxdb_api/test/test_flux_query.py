@@ -0,0 +1,80 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import pytest
+
+from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+from aerology_influxdb_api.flux_query import build_flux_query, flux_time, flux_duration
+from aerology_influxdb_api.testing import InfluxStub
+
+AIRPORTS = [{"short_name": "EWR", "influx_bucket": "aerology.test", "lane_names": []}]
+
+
+def _sent_queries(stub):
+    return [json.loads(request['body'])['query'] for request in stub.requests if request['path'] == '/api/v2/query']
+
+
+def test_build_flux_query():
+    query = build_flux_query('aerology.test', datetime(2023, 2, 1, 5), 1675256400.0, 'capacity_prediction',
+                             fields=['predicted_capacity', 'prediction_variance'],
+                             tags={'model_id': 'model_a', 'prediction-offset': ['+1', '+2']},
+                             keep=['_time', '_field', '_value'], window=timedelta(minutes=30), pivot_fields=True)
+
+    assert query == '\n  |> '.join([
+        'from(bucket: "aerology.test")',
+        'range(start: 2023-02-01T05:00:00Z, stop: 1675256400)',
+        'filter(fn: (r) => r._measurement == "capacity_prediction" and '
+        '(r._field == "predicted_capacity" or r._field == "prediction_variance") and r.model_id == "model_a" and '
+        '(r["prediction-offset"] == "+1" or r["prediction-offset"] == "+2"))',
+        'keep(columns: ["_time", "_field", "_value", "_start", "_stop"])',
+        'aggregateWindow(every: 30m, fn: mean, createEmpty: false)',
+        'pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")'])
+
+    query = build_flux_query('aerology "test"', '-3h', stages=['last()'], imports=['strings'])
+    assert query == 'import "strings"\nfrom(bucket: "aerology \\"test\\"")\n  |> range(start: -3h)\n  |> last()'
+
+    with pytest.raises(ValueError):
+        build_flux_query('aerology.test', '-3h', window='1h', window_fn='spread')
+
+
+def test_flux_time():
+    assert flux_time(datetime(2023, 2, 1, 5, tzinfo=timezone(timedelta(hours=-5)))) == '2023-02-01T10:00:00Z'
+    assert flux_time(datetime(2023, 2, 1, 5, 0, 0, 500)) == '2023-02-01T05:00:00.000500Z'
+    assert flux_time(-timedelta(hours=3)) == '-3h'
+    assert flux_duration(timedelta(minutes=90)) == '90m' and flux_duration(timedelta(seconds=61)) == '61s'
+    assert flux_time('now()') == 'now()'
+
+
+def test_prediction_queries_push_down(tmp_path):
+    with InfluxStub() as stub:
+        handler = InfluxDBHandler(stub.write_config(tmp_path / 'config.json', airports=AIRPORTS))
+        handler.querry_capacity_predictions('EWR', 1675227600.0, 1675256400.0, '+1', window=timedelta(hours=1))
+        handler.query_capacity_predictions_for_slotting('EWR', horizon=timedelta(hours=6))
+        handler.close()
+
+    predictions, slotting = _sent_queries(stub)
+    assert 'range(start: 1675227600, stop: 1675256400)' in predictions
+    assert 'r.prediction_offset == "+1"' in predictions and 'aggregateWindow(every: 1h' in predictions
+    # the configured bucket, the caller's horizon, and the string functions after the pushed down stages
+    assert slotting.startswith('import "strings"\nfrom(bucket: "aerology.test")\n  |> range(start: -3h, stop: 6h)')
+    assert slotting.index('keep(') < slotting.index('strings.strlen')
+
+
+def test_store_init_timestamp(tmp_path):
+    predictions = pd.DataFrame({'predicted_time': [datetime(2023, 2, 1, 10), datetime(2023, 2, 1, 11)],
+                                'predicted_capacity': [40, 42], 'prediction_variance': [2.5, 3],
+                                'init_time': ['2023-02-01', '2023-02-01 06:00:00+00:00'],
+                                'model_id': ['model_a', 'model_a']})
+    with InfluxStub() as stub:
+        handler = InfluxDBHandler(stub.write_config(tmp_path / 'config.json', airports=AIRPORTS,
+                                                    store_init_timestamp=True))
+        handler.push_capacity_predictions(predictions, 'EWR')
+        handler.query_capacity_predictions_for_slotting('EWR')
+        handler.close()
+
+    assert [line.rsplit(' ', 2)[1] for line in stub.lines] == [
+        'init_timestamp=1675209600i,predicted_capacity=40i,prediction_variance=2.5',
+        'init_timestamp=1675231200i,predicted_capacity=42i,prediction_variance=3']
+    slotting, = _sent_queries(stub)
+    assert 'strings' not in slotting and 'max(column: "init_timestamp")' in slotting
@@ -0,0 +1,183 @@
+from datetime import datetime, timezone
+
+import pandas as pd
+import pytest
+
+from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+from aerology_influxdb_api.query_cache import QueryCache, normalize_time
+from aerology_influxdb_api.testing import InfluxStub
+
+START = datetime(2023, 2, 1, 5)
+END = datetime(2023, 2, 1, 13)
+
+
+class _Record:
+    def __init__(self, time, field, value):
+        self._time, self._field, self._value = time, field, value
+
+    def get_time(self):
+        return self._time
+
+    def get_field(self):
+        return self._field
+
+    def get_value(self):
+        return self._value
+
+
+class _Table:
+    def __init__(self, records):
+        self.records = records
+
+
+class _CountingQueryApi:
+    """stands in for the query api of the client, counts the queries"""
+
+    def __init__(self):
+        self.queries = []
+
+    def query(self, org, query):
+        self.queries.append(query)
+        valid_time = pd.Timestamp('2023-02-01 05:00', tz='UTC')
+        return [_Table([_Record(valid_time, lane, 1) for lane in ['runway_04L', 'runway_04R', 'runway_11']])]
+
+    def query_data_frame(self, org, query):
+        self.queries.append(query)
+        return pd.DataFrame({'_time': [pd.Timestamp('2023-02-01 05:00', tz='UTC')], 'model_a': [40.0]})
+
+
+@pytest.fixture
+def influx_stub():
+    with InfluxStub() as stub:
+        yield stub
+
+
+def _handler(stub, tmp_path, **influx_options):
+    options = dict({'query_cache_ttl_ms': 60000}, **influx_options)
+    handler = InfluxDBHandler(stub.write_config(tmp_path / 'config.json', **options))
+    handler._influx_reader = _CountingQueryApi()
+    return handler
+
+
+def test_query_cache_hits(influx_stub, tmp_path):
+    handler = _handler(influx_stub, tmp_path)
+
+    first = handler.query_lane_status('EWR', START, END)
+    first['runway_11'] = 0  # results are copies, the cache is not modified
+    second = handler.query_lane_status('ewr', START, END)
+
+    assert len(handler._influx_reader.queries) == 1
+    assert list(second['runway_11']) == [1]
+    assert handler.query_cache_stats == {'hits': 1, 'misses': 1, 'expirations': 0, 'evictions': 0,
+                                         'invalidations': 0, 'stale_puts': 0, 'entries': 1}
+
+    handler.query_capacity_predictions_for_slotting('EWR')
+    handler.query_capacity_predictions_for_slotting('EWR')
+    handler.querry_capacity_predictions('EWR', 1675227600.0, 1675256400, '+1')
+    handler.querry_capacity_predictions('EWR', START.replace(tzinfo=timezone.utc), 1675256400.0, '+1')
+    assert len(handler._influx_reader.queries) == 3
+
+
+def test_query_cache_ttl_and_size(influx_stub, tmp_path):
+    handler = _handler(influx_stub, tmp_path, query_cache_size=2)
+    now = [0.0]
+    handler._query_cache._clock = lambda: now[0]
+
+    handler.query_lane_status('EWR', START, END)
+    now[0] = 61
+    handler.query_lane_status('EWR', START, END)
+    assert handler.query_cache_stats['expirations'] == 1
+
+    for hours in range(3):
+        handler.query_lane_status('EWR', START, END.replace(hour=14 + hours))
+    handler.query_lane_status('EWR', START, END)  # least recently used, evicted
+    assert handler.query_cache_stats['evictions'] == 3
+    assert len(handler._influx_reader.queries) == 6
+
+
+def test_query_cache_invalidated_by_push(influx_stub, tmp_path):
+    handler = _handler(influx_stub, tmp_path)
+    handler.query_lane_status('EWR', START, END)
+    handler.querry_capacity_predictions('EWR', 1675227600, 1675256400, '+1')
+
+    lanes = pd.DataFrame({'status_time': [START], 'runway_04L': [0], 'runway_04R': [1], 'runway_11': [1]})
+    handler.push_lane_status(lanes, 'EWR')
+    handler.query_lane_status('EWR', START, END)
+    handler.querry_capacity_predictions('EWR', 1675227600, 1675256400, '+1')
+
+    assert len(handler._influx_reader.queries) == 3  # only the lane status is read again
+    assert handler.query_cache_stats['invalidations'] == 1
+
+
+def test_query_cache_skips_result_read_during_write(influx_stub, tmp_path):
+    handler = _handler(influx_stub, tmp_path)
+    lanes = pd.DataFrame({'status_time': [START], 'runway_04L': [0], 'runway_04R': [1], 'runway_11': [1]})
+    read = handler._influx_reader.query
+
+    def query_during_write(org, query):
+        result = read(org, query)  # read before the points are written
+        handler.push_lane_status(lanes, 'EWR')
+        return result
+
+    handler._influx_reader.query = query_during_write
+    handler.query_lane_status('EWR', START, END)
+    handler._influx_reader.query = read
+    handler.query_lane_status('EWR', START, END)
+
+    assert len(handler._influx_reader.queries) == 2  # the result read before the write was not cached
+    assert handler.query_cache_stats['stale_puts'] == 1
+
+
+def test_query_cache_invalidated_after_async_write(influx_stub, tmp_path):
+    handler = _handler(influx_stub, tmp_path, write_mode='asynchronous', flush_interval_ms=60000)
+    handler.query_lane_status('EWR', START, END)
+
+    lanes = pd.DataFrame({'status_time': [START], 'runway_04L': [0], 'runway_04R': [1], 'runway_11': [1]})
+    handler.push_lane_status(lanes, 'EWR')
+    assert handler.query_cache_stats['entries'] == 1  # queued, not written yet
+    handler.flush()
+    assert handler.query_cache_stats['entries'] == 0
+    handler.close()
+
+
+def test_query_cache_disabled(influx_stub, tmp_path):
+    handler = _handler(influx_stub, tmp_path, query_cache_ttl_ms=0)
+    handler.query_lane_status('EWR', START, END)
+    handler.query_lane_status('EWR', START, END)
+
+    assert handler.query_cache_stats is None
+    assert len(handler._influx_reader.queries) == 2
+
+
+def test_normalize_time():
+    assert normalize_time(START) == normalize_time(START.replace(tzinfo=timezone.utc)) == 1675227600
+    assert normalize_time(1675227600.0) == 1675227600
+    assert normalize_time('-3h') == '-3h'
+
+
+def test_cache_invalidate_filters():
+    cache = QueryCache(ttl=10)
+    cache.put('a', ('bucket', 'lane_status'), 1)
+    cache.put('b', ('bucket', 'demand'), 2)
+    cache.put('c', ('other', 'lane_status'), 3)
+
+    cache.invalidate('bucket', 'lane_status')
+    assert cache.get('a') is QueryCache.MISSING and cache.get('b') == 2 and cache.get('c') == 3
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+def test_cache_generation():
+    cache = QueryCache(ttl=10)
+    generation = cache.generation(('bucket', 'lane_status'))
+    other_generation = cache.generation(('bucket', 'demand'))
+
+    cache.invalidate('bucket', 'lane_status')
+    cache.put('a', ('bucket', 'lane_status'), 1, generation)
+    cache.put('b', ('bucket', 'demand'), 2, other_generation)
+    assert cache.get('a') is QueryCache.MISSING and cache.get('b') == 2
+
+    generation = cache.generation(('bucket', 'demand'))
+    cache.invalidate()
+    cache.put('b', ('bucket', 'demand'), 3, generation)
+    assert cache.get('b') is QueryCache.MISSING and cache.stats['stale_puts'] == 2
@@ -0,0 +1,104 @@
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+import urllib3
+
+from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+from aerology_influxdb_api.range_read import time_shards, read_shards, stitch_results, ShardReadError
+from aerology_influxdb_api.testing import InfluxStub, flux_csv_response
+
+UTC = timezone.utc
+
+
+def _measurements(days=3):
+    times = pd.date_range('2023-02-01 05:30', periods=days * 24 * 4, freq='15min')
+    return pd.DataFrame({'_time': times, 'measured_capacity': np.arange(len(times)) % 60})
+
+
+def _range_response(data):
+    """answers a query with the rows of `data` in the range of the query"""
+
+    def respond(query):
+        start, stop = re.search(r'range\(start: (\S+), stop: (\S+)\)', query).groups()
+        in_range = data[(data['_time'] >= pd.Timestamp(start).tz_localize(None)) &
+                        (data['_time'] < pd.Timestamp(stop).tz_localize(None))]
+        return flux_csv_response(in_range, 'actual_capacity', start=pd.Timestamp(start), stop=pd.Timestamp(stop))
+
+    return respond
+
+
+def test_time_shards():
+    shards = time_shards(datetime(2023, 2, 1, 5, 30), datetime(2023, 2, 3, 1), timedelta(days=1))
+
+    assert shards == [(datetime(2023, 2, 1, 5, 30, tzinfo=UTC), datetime(2023, 2, 2, tzinfo=UTC)),
+                      (datetime(2023, 2, 2, tzinfo=UTC), datetime(2023, 2, 3, tzinfo=UTC)),
+                      (datetime(2023, 2, 3, tzinfo=UTC), datetime(2023, 2, 3, 1, tzinfo=UTC))]
+    assert time_shards(1675209600, 1675213200.0, timedelta(hours=2)) == [
+        (datetime(2023, 2, 1, tzinfo=UTC), datetime(2023, 2, 1, 1, tzinfo=UTC))]
+    assert time_shards(datetime(2023, 2, 2), datetime(2023, 2, 1), timedelta(days=1)) == []
+    with pytest.raises(ValueError):
+        time_shards('-3h', 'now()', timedelta(hours=1))
+
+
+def test_read_shards_in_order_with_retries():
+    shards = time_shards(datetime(2023, 2, 1), datetime(2023, 2, 1, 8), timedelta(hours=1))
+    attempts = {}
+    lock = threading.Lock()
+    progress = []
+
+    def read_shard(start, stop):
+        with lock:
+            attempts[start] = attempts.get(start, 0) + 1
+            first_attempt = attempts[start] == 1
+        if start.hour == 3 and first_attempt:
+            raise urllib3.exceptions.ReadTimeoutError(None, '/api/v2/query', 'read timed out')
+        time.sleep(0.01 * (8 - start.hour))  # the first shards finish last
+        return pd.DataFrame({'hour': [start.hour]})
+
+    frames = read_shards(read_shard, shards, max_workers=3, retry_interval=0.01,
+                         progress=lambda done, total, shard: progress.append((done, total)))
+
+    assert stitch_results(frames)['hour'].tolist() == list(range(8))
+    assert attempts[shards[3][0]] == 2 and sum(attempts.values()) == 9
+    assert progress == [(done, 8) for done in range(1, 9)]
+
+    def fail(start, stop):
+        raise ValueError('bad query')
+
+    with pytest.raises(ShardReadError) as error:
+        read_shards(fail, shards, max_workers=2)
+    assert isinstance(error.value.__cause__, ValueError)
+
+
+@pytest.mark.parametrize('query_mode', ['records', 'streaming'])
+def test_sharded_capacity_measurements(tmp_path, query_mode):
+    data = _measurements()
+    with InfluxStub() as stub:
+        stub.respond_to_queries(_range_response(data))
+        handler = InfluxDBHandler(stub.write_config(tmp_path / 'config.json', query_mode=query_mode,
+                                                    range_shard_ms=24 * 3600 * 1000, range_workers=2))
+        measurements = handler.querry_capacity_measurements('EWR', datetime(2023, 2, 1), datetime(2023, 2, 4, 12))
+        handler.close()
+
+    assert len(stub.requests) == 4
+    assert list(measurements.columns) == ['time', 'capacity']
+    assert measurements['time'].tolist() == data['_time'].tolist()
+    assert measurements['capacity'].tolist() == data['measured_capacity'].tolist()
+
+
+def test_unsharded_lane_status(tmp_path):
+    with InfluxStub() as stub:
+        stub.respond_to_queries(_range_response(_measurements(days=1)))
+        handler = InfluxDBHandler(stub.write_config(tmp_path / 'config.json'))
+        handler.querry_capacity_measurements('EWR', datetime(2023, 2, 1), datetime(2023, 2, 4))
+        handler.query_lane_status('EWR', datetime(2023, 2, 1, 5), datetime(2023, 2, 1, 10))
+        handler.close()
+
+    measurements, lanes = [request['body'].decode('utf-8') for request in stub.requests]
+    assert 'range(start: 2023-02-01T00:00:00Z, stop: 2023-02-04T00:00:00Z)' in measurements
+    assert 'range(start: 2023-02-01T05:00:00Z, stop: 2023-02-01T11:00:00Z)' in lanes
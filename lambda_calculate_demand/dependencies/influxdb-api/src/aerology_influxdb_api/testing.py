@@ -0,0 +1,192 @@
+"""
+Local stand-in of the InfluxDB HTTP API, to test and benchmark the handler without an InfluxDB server.
+"""
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pandas
+
+
+class InfluxStub:
+    """
+    Serves /api/v2/write and /api/v2/query on a local port and records every request, writes can be made to fail
+    with `fail_writes` to test the retries of the handler. Queries are answered with the annotated CSV set by
+    `respond_to_queries`, e.g. a recorded response or one built by `flux_csv_response`.
+
+    usage:
+        with InfluxStub() as stub:
+            handler = InfluxDBHandler(stub.write_config('config.json'))
+            handler.push_demand(demand, 'EWR')
+            stub.lines  # the line protocol received
+            stub.respond_to_queries(flux_csv_response(lanes, 'lane_status'))
+            handler.query_lane_status('EWR', start_time, end_time)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        """
+        Parameters
+        ----------
+        host: str
+        port: int, 0 picks a free port
+        latency: float, seconds every request is delayed by, to simulate a remote host
+        """
+        self.latency = latency
+        self.requests = []  # dicts with the path, query, headers, body (decompressed), size on the wire and status
+        self._failures = []  # (status, retry_after) of the next write requests
+        self._query_response = b''
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._request_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def lines(self):
+        """all line protocol lines written so far"""
+        with self._lock:
+            return [line for request in self.requests if request['path'] == '/api/v2/write' and request['status'] == 204
+                    for line in request['body'].decode('utf-8').split('\n') if line]
+
+    def fail_writes(self, status=503, times=1, retry_after=None):
+        """the next `times` write requests are answered with `status` (and a Retry-After header if given)"""
+        with self._lock:
+            self._failures.extend([(status, retry_after)] * times)
+
+    def respond_to_queries(self, response):
+        """every following query request is answered with `response`, the annotated CSV body (str or bytes), or a
+        function of the Flux query returning it"""
+        with self._lock:
+            self._query_response = response.encode('utf-8') if isinstance(response, str) else response
+
+    def _next_status(self):
+        with self._lock:
+            return self._failures.pop(0) if self._failures else (204, None)
+
+    def config(self, airports=None, **influx_options):
+        """a handler configuration pointing to the stub"""
+        airports = airports or [{"short_name": "EWR", "influx_bucket": "aerology.test",
+                                 "lane_names": ["runway_04L", "runway_04R", "runway_11"]}]
+        return {"influx": dict({"url": self.url, "token": "token", "org": "aerology"}, **influx_options),
+                "airports": airports}
+
+    def write_config(self, path, airports=None, **influx_options):
+        """writes `config` to a json file and returns its path"""
+        with open(path, "w") as json_file:
+            json.dump(self.config(airports, **influx_options), json_file)
+        return str(path)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _record(self, request):
+        with self._lock:
+            self.requests.append(request)
+
+    def _request_handler(self):
+        stub = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                body = gzip.decompress(payload) if self.headers.get('Content-Encoding') == 'gzip' else payload
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                if url.path == '/api/v2/query':
+                    self._respond_to_query(url, payload, body)
+                    return
+                if url.path != '/api/v2/write':
+                    self.send_error(404)
+                    return
+
+                status, retry_after = stub._next_status()
+                stub._record({'path': url.path, 'query': parse_qs(url.query), 'headers': dict(self.headers),
+                              'body': body, 'wire_size': len(payload), 'status': status})
+                self.send_response(status)
+                if retry_after is not None:
+                    self.send_header('Retry-After', str(retry_after))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def _respond_to_query(self, url, payload, body):
+                with stub._lock:
+                    response = stub._query_response
+                if callable(response):
+                    response = response(json.loads(body)['query'])
+                    response = response.encode('utf-8') if isinstance(response, str) else response
+                stub._record({'path': url.path, 'query': parse_qs(url.query), 'headers': dict(self.headers),
+                              'body': body, 'wire_size': len(payload), 'status': 200})
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/csv; charset=utf-8')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    response = gzip.compress(response, compresslevel=1)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                pass
+
+        return _Handler
+
+
+def flux_csv_response(data, measurement, start=None, stop=None):
+    """
+    Annotated CSV response of a Flux query reading the fields of a measurement, as InfluxDB sends it: one table per
+    field with the result, table, _start, _stop, _time, _value, _field and _measurement columns.
+
+    Parameters
+    ----------
+    data: pandas.DataFrame with a '_time' column (naive times are UTC) and one column per field, integer columns are
+        written as long values, the others as double, missing values are left out
+    measurement: str
+    start, stop: datetime, optional, the range of the query, defaults to the first time and after the last time
+
+    Returns
+    -------
+    str
+    """
+    times = pandas.to_datetime(data['_time'], utc=True)
+    start = pandas.Timestamp(start if start is not None else times.min())
+    stop = pandas.Timestamp(stop if stop is not None else times.max() + pandas.Timedelta(seconds=1))
+    start, stop = [(value.tz_localize('UTC') if value.tzinfo is None else value).strftime('%Y-%m-%dT%H:%M:%SZ')
+                   for value in (start, stop)]
+    time_strings = times.dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    fields = [column for column in data.columns if column != '_time']
+    integer = all(pandas.api.types.is_integer_dtype(data[field]) for field in fields)
+    lines = ['#datatype,string,long,dateTime:RFC3339,dateTime:RFC3339,dateTime:RFC3339,{},string,string'
+             .format('long' if integer else 'double'),
+             '#group,false,false,true,true,false,false,true,true',
+             '#default,_result,,,,,,,',
+             ',result,table,_start,_stop,_time,_value,_field,_measurement']
+    for table, field in enumerate(fields):
+        present = data[field].notna().to_numpy()
+        prefix = f",,{table},{start},{stop},"
+        suffix = f",{field},{measurement}"
+        lines.extend(prefix + time_strings[present] + ',' + data[field][present].astype(str) + suffix)
+    return '\r\n'.join(lines) + '\r\n\r\n'
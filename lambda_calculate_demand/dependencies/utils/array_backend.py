@@ -0,0 +1,167 @@
+"""
+Pandas-free version of the demand calculation, working on the numpy columns of an `ActiveFlightBatch`.
+
+The functions mirror the pandas ones of `dynamodb_utils` and `flight_msg_utils` and give the same demand. The flights
+are an `ActiveFlightBatch` (or a dict of decoded columns), with the timestamps as int64 epoch seconds and the
+categorical columns as (codes, categories) tuples. The demand is a dict with the 'valid_time' (int64 epoch seconds
+of the bin starts) and 'demand' arrays, which the InfluxDBHandler writes like the demand frames.
+
+The Lambda runs on this backend with DEMAND_BACKEND=numpy.
+"""
+import logging
+from datetime import datetime, timezone
+
+import numpy as np
+
+from .demand_histogram import CALC_HORIZON_HOURS, demand_histograms, horizon_start, _n_bins
+from .dynamodb_reader import cancel_triggers, stale_etd_types, PIPELINE_COLUMNS, MISSING_TIMESTAMP, \
+    flight_page_sources, iter_pages_concurrently, read_items
+from .flight_batch import ActiveFlightBatch, as_flight_batch
+from .flight_capture import write_flight_capture
+
+
+def query_active_flights(table_name='ActiveFlights', airport='EWR', total_segments=1,
+                         max_workers=None, index_name=None, columns=None, capture_path=None, run_time=None):
+    """
+    `dynamodb_utils.query_active_flights` returning the decoded columns instead of a DataFrame.
+
+    Returns
+    -------
+    ActiveFlightBatch
+    """
+    run_time = run_time or datetime.now(timezone.utc)
+    page_sources, read_mode = flight_page_sources(table_name, airport, total_segments, index_name, columns)
+    flights = ActiveFlightBatch.from_items(read_items(page_sources, max_workers), columns)
+    if capture_path is not None:
+        write_flight_capture(flights, capture_path, table_name, airport, run_time)
+
+    logging.info(f"Retrieved {len(flights)} active flights for {airport} from DynamoDB table {table_name} "
+                 f"({read_mode}).")
+    return flights
+
+
+def iter_active_flight_pages(table_name='ActiveFlights', airport='EWR', total_segments=1,
+                             max_workers=None, index_name=None, columns=None):
+    """
+    `dynamodb_utils.iter_active_flight_pages` yielding the decoded columns of every page.
+    """
+    page_sources, read_mode = flight_page_sources(table_name, airport, total_segments, index_name, columns)
+    logging.info(f"Streaming active flights for {airport} from DynamoDB table {table_name} ({read_mode}).")
+
+    pages = page_sources[0] if len(page_sources) == 1 else iter_pages_concurrently(page_sources, max_workers)
+    for items in pages:
+        yield ActiveFlightBatch.from_items(items, columns)
+
+
+def query_active_flights_by_airport(table_name='ActiveFlights', airports=('EWR',), total_segments=1,
+                                    max_workers=None, index_name=None, columns=None, capture_path=None,
+                                    run_time=None):
+    """
+    `dynamodb_utils.query_active_flights_by_airport` on decoded columns.
+
+    Returns
+    -------
+    dict of airport name to the ActiveFlightBatch of its active flights
+    """
+    airports = list(airports)
+    if columns is not None and 'airport' not in columns:
+        columns = list(columns) + ['airport']
+
+    flights = query_active_flights(table_name, airports, total_segments, max_workers, index_name, columns,
+                                   capture_path, run_time)
+    if 'airport' not in flights:
+        return {airport: flights for airport in airports}
+
+    return {airport: flights.filter(flights.isin('airport', [airport])) for airport in airports}
+
+
+def clean_active_flights(flights, now=None):
+    """
+    `dynamodb_utils.clean_active_flights` on decoded columns: drops the cancelled and the stale flights with one mask.
+
+    Parameters
+    ----------
+    flights: ActiveFlightBatch or dict of decoded columns, with at least msg_trigger, est_dept_time_type and
+        est_arrival_time
+    now: datetime, optional, the run time the stale flights are checked against, defaults to the current time
+
+    Returns
+    -------
+    ActiveFlightBatch
+    """
+    now = now or datetime.now(timezone.utc)  # one stale cutoff for all the flights
+    flights = as_flight_batch(flights)
+
+    est_arrival_time = flights['est_arrival_time']
+    cancel_mask = flights.isin('msg_trigger', cancel_triggers)
+    stale_mask = (flights.isin('est_dept_time_type', stale_etd_types) &
+                  (est_arrival_time != MISSING_TIMESTAMP) & (est_arrival_time < now.timestamp()))
+    keep = ~(cancel_mask | stale_mask)
+
+    logging.info(f"{cancel_mask.sum()} canceled flight(s) dropped..")
+    logging.info(f"{(stale_mask & ~cancel_mask).sum()} stale flight(s) dropped..")
+    return flights.filter(keep)
+
+
+def calculate_demand_from_flights(flights, now=None, horizon_hours=CALC_HORIZON_HOURS, bin_minutes=60):
+    """
+    `flight_msg_utils.calculate_demand_from_flights` on decoded columns.
+
+    Returns
+    -------
+    dict with the 'valid_time' (int64 epoch seconds) and 'demand' (int64) arrays
+    """
+    return calculate_demands_from_flights(flights, now, horizon_hours, (bin_minutes,))[bin_minutes]
+
+
+def calculate_demands_from_flights(flights, now=None, horizon_hours=CALC_HORIZON_HOURS, bin_minutes=(15, 30, 60)):
+    """
+    `calculate_demand_from_flights` at several bin widths, from one pass over the flights.
+
+    Returns
+    -------
+    dict of bin width (minutes) to the demand dict
+    """
+    start = horizon_start(now)
+    histograms = demand_histograms(flights['sched_landing_time'], start, horizon_hours, bin_minutes)
+    return {width: demand_columns(counts, start, width) for width, counts in histograms.items()}
+
+
+def calculate_demand_from_flight_pages(flight_pages, now=None, horizon_hours=CALC_HORIZON_HOURS, bin_minutes=60):
+    """
+    `flight_msg_utils.calculate_demand_from_flight_pages` on decoded columns.
+    """
+    start = horizon_start(now)
+    counts = np.zeros(_n_bins(horizon_hours, bin_minutes), dtype=np.int64)
+    for flights in flight_pages:
+        counts += demand_histograms(flights['sched_landing_time'], start, horizon_hours, (bin_minutes,))[bin_minutes]
+    return demand_columns(counts, start, bin_minutes)
+
+
+def calculate_demand_by_airport_from_flight_pages(flight_pages, airports, now=None, horizon_hours=CALC_HORIZON_HOURS,
+                                                  bin_minutes=60):
+    """
+    `flight_msg_utils.calculate_demand_by_airport_from_flight_pages` on decoded columns.
+    """
+    start = horizon_start(now)
+    counts = {airport: np.zeros(_n_bins(horizon_hours, bin_minutes), dtype=np.int64) for airport in airports}
+    for flights in flight_pages:
+        for airport in airports:
+            landing_times = flights['sched_landing_time'][flights.isin('airport', [airport])]
+            counts[airport] += demand_histograms(landing_times, start, horizon_hours, (bin_minutes,))[bin_minutes]
+    return {airport: demand_columns(airport_counts, start, bin_minutes) for airport, airport_counts in counts.items()}
+
+
+def from_flight_batch(flights):
+    """
+    The flights of an ActiveFlightBatch as this backend takes them, the batch itself.
+    """
+    return flights
+
+
+def demand_columns(counts, start, bin_minutes):
+    """
+    The demand dict of a histogram of `demand_histograms`.
+    """
+    return {'valid_time': start + np.arange(len(counts), dtype=np.int64) * bin_minutes * 60,
+            'demand': counts.astype(np.int64)}
@@ -0,0 +1,237 @@
+"""
+Backfill of the demand of past runs, from the flight captures of the runs (see `flight_capture`).
+
+Every capture of the date range is a run to recalculate: the demand of every airport is calculated from the flights
+of the capture at its run time, as the Lambda did (a capture holds every active flight read by its run, also in the
+snapshot read mode), but with the current cleaning and demand of the backend. So recomputing after a change of the
+cleaning (e.g. of the cancel triggers) only takes the captures of the period, and every run writes the hourly bins of
+its own horizon again, from its own flights, to the `demand` series production reads.
+
+The captures are spread over a process pool, each task reads one capture (memory mapped). The demands are written
+in the order of the run times, so that the bins written by several runs end up with the demand of the latest one as
+in the live Influx data, and rewriting a run writes the same points again (the points are timed by their
+valid_time). The runs written are recorded in a checkpoint file, a backfill of the same airports and date range
+started again with the checkpoint skips them:
+
+    summary = backfill_demand(InfluxDBHandler('./res/config.json'), ['EWR', 'JFK'], datetime(2023, 3, 1),
+                              datetime(2023, 4, 1), 'captures/ActiveFlights', checkpoint_path='backfill.json')
+
+or from the lambda_calculate_demand directory:
+
+    python -m dependencies.utils.demand_backfill captures/ActiveFlights 2023-03-01 2023-04-01 --airports EWR JFK \
+        --checkpoint backfill.json
+"""
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from .demand_histogram import horizon_start
+from .flight_capture import iter_flight_captures, read_capture_meta, read_flight_capture
+
+MAX_RUN_GAP = timedelta(minutes=90)  # captures further apart are reported, the runs in between are missing
+BACKENDS = ('pandas', 'numpy')
+CHECKPOINT_VERSION = 3
+
+_logger = logging.getLogger(__name__)
+
+
+def capture_index(capture_directory):
+    """
+    The captures under `capture_directory`, as a list of (run time, path, airports of the capture) ordered by run
+    time.
+    """
+    captures = []
+    for path in iter_flight_captures(capture_directory):
+        meta = read_capture_meta(path)
+        captures.append((meta['run_time'], path, meta['airports']))
+    captures.sort(key=lambda capture: capture[0])
+    return captures
+
+
+def capture_gaps(captures, start, end, max_gap=MAX_RUN_GAP):
+    """
+    The periods of [start, end) longer than `max_gap` without a capture, as a list of (start, end).
+    """
+    run_times = [_as_utc(start)] + [capture[0] for capture in captures] + [_as_utc(end)]
+    return [(previous, following) for previous, following in zip(run_times, run_times[1:])
+            if following - previous > max_gap]
+
+
+def backfill_demand(influxdb_client, airports, start, end, capture_directory, backend='pandas', max_workers=None,
+                    checkpoint_path=None, progress=None):
+    """
+    Recalculates and writes the demand of the airports of every run captured in [start, end), at its run time.
+
+    Parameters
+    ----------
+    influxdb_client: InfluxDBHandler, the demands are written with `push_demands`
+    airports: list of str, airports without a configuration are skipped
+    start, end: datetime, naive datetimes are UTC
+    capture_directory: str, directory of the flight captures, e.g. <CAPTURE_DIRECTORY>/<table name>
+    backend: str, 'pandas' or 'numpy', see DEMAND_BACKEND of the Lambda
+    max_workers: int, processes calculating the demands, defaults to the number of CPUs
+    checkpoint_path: str, optional, file recording the runs written. A backfill with the same airports, start and
+        end skips the runs it has written, another one raises a ValueError.
+    progress: function (runs written, number of runs, run time), optional, called after every write
+
+    Returns
+    -------
+    dict with the number of runs 'written', 'resumed' (written by a previous backfill), of 'gaps' (periods longer
+    than MAX_RUN_GAP without a capture) and the 'seconds' taken
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown backend {backend}, expected one of {', '.join(BACKENDS)}")
+    started = time.perf_counter()
+    configured_airports = influxdb_client.get_airport_names()
+    unknown_airports = sorted(set(airports) - set(configured_airports))
+    if unknown_airports:
+        _logger.warning(f"skipping airport(s) without configuration: {', '.join(unknown_airports)}")
+    airports = [airport for airport in airports if airport not in unknown_airports]
+
+    start, end = _as_utc(start), _as_utc(end)
+    captures = [capture for capture in capture_index(capture_directory) if start <= capture[0] < end]
+    checkpoint = _Checkpoint(checkpoint_path, airports, start, end)
+    to_write = [capture for capture in captures if not checkpoint.done(capture[0])]
+    gaps = capture_gaps(captures, start, end)
+    for gap_start, gap_end in gaps:
+        _logger.warning(f"no capture from {gap_start.isoformat()} to {gap_end.isoformat()}, the runs in between are "
+                        f"not backfilled")
+    _logger.info(f"backfilling {len(to_write)} run(s) of {', '.join(airports)}, "
+                 f"{len(captures) - len(to_write)} already written")
+
+    written = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for run_time, demands in _ordered_results(executor, to_write, airports, backend,
+                                                  max_workers or os.cpu_count() or 1):
+            if demands:
+                start_of_horizon = datetime.fromtimestamp(horizon_start(run_time), timezone.utc)
+                influxdb_client.push_demands(demands, horizon_start=start_of_horizon)
+                influxdb_client.flush()
+            checkpoint.record(run_time)
+            written += 1
+            if progress is not None:
+                progress(written, len(to_write), run_time)
+
+    seconds = time.perf_counter() - started
+    _logger.info(f"backfilled {written} run(s) in {seconds:.1f}s")
+    return {'written': written, 'resumed': len(captures) - len(to_write), 'gaps': len(gaps), 'seconds': seconds}
+
+
+def _ordered_results(executor, captures, airports, backend, max_workers):
+    """
+    Yields (run time, demands) in the order of the captures, with at most two captures per worker submitted ahead, so
+    the demands waiting for an earlier one to be written stay few.
+    """
+    pending = deque()
+    captures = iter(captures)
+    try:
+        while True:
+            while len(pending) < 2 * max_workers:
+                capture = next(captures, None)
+                if capture is None:
+                    break
+                run_time, path, capture_airports = capture
+                capture_airports = [airport for airport in airports
+                                    if capture_airports is None or airport in capture_airports]
+                pending.append(executor.submit(_calculate_run, path, run_time, capture_airports, backend))
+            if not pending:
+                return
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _calculate_run(path, run_time, airports, backend):
+    """
+    (run time, the demands of the airports) of the run of a capture. Runs in a worker process.
+    """
+    if backend == 'numpy':
+        from . import array_backend as backend_module
+    else:
+        from . import pandas_backend as backend_module
+
+    flights, _ = read_flight_capture(path)
+    demands = {}
+    for airport in airports:
+        airport_flights = backend_module.from_flight_batch(
+            flights.filter(flights.isin('airport', [airport])) if 'airport' in flights else flights)
+        demands[airport] = backend_module.calculate_demand_from_flights(
+            backend_module.clean_active_flights(airport_flights, run_time), run_time)
+    return run_time, demands
+
+
+class _Checkpoint:
+    """
+    The run times written by a backfill, kept in a JSON file replaced after every run. Without a path nothing is
+    recorded.
+    """
+
+    def __init__(self, path, airports, start, end):
+        self._path = path
+        self._state = {'version': CHECKPOINT_VERSION,
+                       'airports': sorted(airports),
+                       'start': start.isoformat(),
+                       'end': end.isoformat(),
+                       'written': []}
+        self._written = set()
+        if path is None or not os.path.exists(path):
+            return
+        with open(path) as checkpoint_file:
+            state = json.load(checkpoint_file)
+        if {key: value for key, value in state.items() if key != 'written'} != \
+                {key: value for key, value in self._state.items() if key != 'written'}:
+            raise ValueError(f"checkpoint {path} is of another backfill, remove it to start again")
+        self._state['written'] = state['written']
+        self._written = set(state['written'])
+
+    def done(self, run_time):
+        return run_time.isoformat() in self._written
+
+    def record(self, run_time):
+        if self._path is None:
+            return
+        self._state['written'].append(run_time.isoformat())
+        temporary_path = f"{self._path}.tmp-{os.getpid()}"
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump(self._state, checkpoint_file)
+        os.replace(temporary_path, self._path)
+
+
+def _as_utc(value):
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('captures', help='directory of the flight captures')
+    parser.add_argument('start', type=datetime.fromisoformat, help='start of the backfill, UTC')
+    parser.add_argument('end', type=datetime.fromisoformat, help='end of the backfill (excluded), UTC')
+    parser.add_argument('--airports', nargs='+', default=None, help='defaults to every configured airport')
+    parser.add_argument('--config', default=os.environ.get('INFLUX_CONFIG_PATH', './res/config.json'))
+    parser.add_argument('--backend', choices=BACKENDS, default=os.environ.get('DEMAND_BACKEND', 'pandas'))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--checkpoint', default=None, help='checkpoint file, to resume an interrupted backfill')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+
+    influxdb_client = InfluxDBHandler(args.config)
+    try:
+        summary = backfill_demand(influxdb_client, args.airports or influxdb_client.get_airport_names(), args.start,
+                                  args.end, args.captures, backend=args.backend, max_workers=args.workers,
+                                  checkpoint_path=args.checkpoint)
+    finally:
+        influxdb_client.close()
+    print(json.dumps(summary))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Dense demand histograms over the calculation horizon, on int64 epoch seconds and without pandas.
+"""
+import math
+from datetime import datetime, timezone
+
+import numpy as np
+
+CALC_HORIZON_HOURS = 20  # this many hours in future to calculate capacity
+RUNTIME_OFFSET_HOURS = 1  # assume validty of the messages for the past hour (since we check past N hour messages)
+
+
+def demand_histograms(landing_times, start, horizon_hours=CALC_HORIZON_HOURS, bin_minutes=(60,)):
+    """
+    Dense flight counts per bin over the horizon, for several bin widths at once.
+
+    The flights are counted once with `np.bincount` at the greatest common divisor of the widths, the wider bins are
+    sums of those counts.
+
+    Parameters
+    ----------
+    landing_times: np.ndarray of int64 epoch seconds, times before `start` (missing ones included) or after the
+        horizon are not counted
+    start: int, epoch seconds of the start of the first bin
+    horizon_hours: int
+    bin_minutes: iterable of int, every width must divide the horizon
+
+    Returns
+    -------
+    dict of bin width (minutes) to np.ndarray of int64 counts
+    """
+    bin_minutes = list(bin_minutes)
+    base_minutes = math.gcd(*bin_minutes)
+    n_base_bins = _n_bins(horizon_hours, base_minutes)
+    for width in bin_minutes:
+        _n_bins(horizon_hours, width)
+
+    offsets = landing_times - start
+    offsets = offsets[(offsets >= 0) & (offsets < n_base_bins * base_minutes * 60)]
+    base_counts = np.bincount(offsets // (base_minutes * 60), minlength=n_base_bins)
+    return {width: base_counts.reshape(-1, width // base_minutes).sum(axis=1) for width in bin_minutes}
+
+
+def horizon_start(now=None):
+    """
+    Epoch seconds of the hour `now` falls in, the start of the demand horizon.
+    """
+    now = int((now or datetime.now(timezone.utc)).timestamp())
+    return now - now % 3600
+
+
+def _n_bins(horizon_hours, bin_minutes):
+    if (horizon_hours * 60) % bin_minutes:
+        raise ValueError(f"bins of {bin_minutes} minutes do not divide the {horizon_hours} hours horizon")
+    return horizon_hours * 60 // bin_minutes
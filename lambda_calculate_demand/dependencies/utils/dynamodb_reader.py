@@ -0,0 +1,361 @@
+"""
+Reads the active flights from DynamoDB with the low-level client and decodes them into numpy columns.
+
+Shared by the pandas functions of `dynamodb_utils`, by the pandas-free `array_backend` and by `flight_snapshot`, this
+module does not import pandas. They read the table with `flight_page_sources` and `read_items` (or
+`iter_pages_concurrently` to stream the pages), and decode the items themselves.
+"""
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import boto3
+import numpy as np
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.config import Config
+
+from . import instrumentation
+
+DYNAMODB_REGION = 'us-east-1'
+# config of the shared client, the connection pool is sized for the parallel scan segments of several airports
+DYNAMODB_CONFIG = Config(connect_timeout=5, read_timeout=10, retries={'max_attempts': 10}, max_pool_connections=32)
+cancel_triggers=  ["FD_FLIGHT_CANCEL_MSG", "UPDATE_CANCEL_TIMEOUT", "UPDATE_INTERNATIONAL_CANCEL_TIMEOUT", "TMI_UPDATE"]
+stale_etd_types = ['SCHEDULED', 'PROPOSED', None]  # departure time types of flights that have not departed yet
+
+TIMESTAMP_COLUMNS = ['sched_dept_time',
+                     'est_dept_time',
+                     'sched_landing_time',
+                     'last_msg_time',
+                     'flight_creation_time',
+                     'est_arrival_time'
+                     ]
+CATEGORICAL_COLUMNS = ['msg_trigger', 'est_dept_time_type', 'airport']
+PIPELINE_COLUMNS = TIMESTAMP_COLUMNS + CATEGORICAL_COLUMNS  # attributes used by the cleaning and demand calculation
+MISSING_TIMESTAMP = np.iinfo(np.int64).min  # missing epoch seconds, read as NaT by pandas
+
+_deserializer = TypeDeserializer()
+
+
+def flight_page_sources(table_name, airport, total_segments=1, index_name=None, columns=None, updated_since=None):
+    """
+    Picks how the flights of the airport are read and returns the page iterators to read (one per scan segment) and
+    a description of the read for the logs.
+
+    With `updated_since` (epoch seconds) only the flights with a last_msg_time at or after it are read, see
+    `_updated_since_request`.
+    """
+    if total_segments < 1:
+        raise ValueError(f"total_segments must be positive, got {total_segments}")
+    airports = [airport] if isinstance(airport, str) else list(airport)
+
+    # low-level clients are thread safe, the scan segments share one
+    client = get_dynamodb_client()
+
+    airport_index = find_airport_index(table_name, index_name)
+    if airport_index is not None:
+        # one query per airport partition
+        requests = [_index_query_request(_build_request(table_name, [airport], columns), airport_index)
+                    for airport in airports]
+        read_mode = f"index {airport_index['IndexName']}"
+        operation = client.query
+    else:
+        request = _build_request(table_name, airports, columns)
+        if total_segments == 1:
+            requests = [_scan_request(request)]
+            read_mode = "scan"
+        else:
+            requests = [_scan_request(request, segment, total_segments) for segment in range(total_segments)]
+            read_mode = f"scan, {total_segments} segments"
+        operation = client.scan
+
+    if updated_since is not None:
+        requests = [_updated_since_request(request, updated_since, airport_index) for request in requests]
+        read_mode += f", updated since {updated_since}"
+    return [_iter_pages(operation, request) for request in requests], read_mode
+
+
+def read_items(page_sources, max_workers=None):
+    """
+    Reads every page of the page sources, concurrently when there are several, and returns the items in one list.
+    Every worker only collects the raw item lists.
+    """
+    if len(page_sources) == 1:
+        return [item for page in page_sources[0] for item in page]
+    with ThreadPoolExecutor(max_workers=max_workers or len(page_sources)) as executor:
+        segments = executor.map(lambda pages: [item for page in pages for item in page], page_sources)
+        return [item for segment_items in segments for item in segment_items]
+
+
+@lru_cache(maxsize=None)
+def get_dynamodb_client():
+    """
+    The low-level DynamoDB client of the module, created on first use and kept for the warm invocations of the
+    Lambda, so the session, the endpoint resolution and the pooled connections are set up only once.
+    """
+    return boto3.session.Session().client("dynamodb", region_name=DYNAMODB_REGION, config=DYNAMODB_CONFIG)
+
+
+@lru_cache(maxsize=None)
+def _describe_table(table_name):
+    return get_dynamodb_client().describe_table(TableName=table_name)['Table']
+
+
+def get_key_attributes(table_name):
+    """
+    Returns the names of the primary key attributes of the table, partition key first.
+    """
+    key_schema = sorted(_describe_table(table_name)['KeySchema'], key=lambda key: key['KeyType'] != 'HASH')
+    return [key['AttributeName'] for key in key_schema]
+
+
+def find_airport_index(table_name, index_name=None):
+    """
+    Looks up a global secondary index of the table that is partitioned on `airport` and projects all attributes.
+
+    The table description is cached per table name for the lifetime of the process.
+
+    Parameters
+    ----------
+    table_name : str
+    index_name : str, optional
+        Only consider the index with this name.
+
+    Returns
+    -------
+    dict or None
+        The index with its 'IndexName', 'SortKey' (None if the index has no sort key) and 'SortKeyType' ('N' or 'S'),
+        None if the table has no usable airport index.
+    """
+    table = _describe_table(table_name)
+    attribute_types = {attribute['AttributeName']: attribute['AttributeType']
+                       for attribute in table['AttributeDefinitions']}
+
+    for index in table.get('GlobalSecondaryIndexes', []):
+        if index_name is not None and index['IndexName'] != index_name:
+            continue
+        keys = {key['KeyType']: key['AttributeName'] for key in index['KeySchema']}
+        if keys['HASH'] != 'airport':
+            continue
+        if index['Projection']['ProjectionType'] != 'ALL':
+            logging.warning(f"index {index['IndexName']} of {table_name} does not project all attributes, ignored.")
+            continue
+        sort_key = keys.get('RANGE')
+        return {'IndexName': index['IndexName'],
+                'SortKey': sort_key,
+                'SortKeyType': attribute_types.get(sort_key)}
+
+    if index_name is not None:
+        logging.warning(f"no airport index {index_name} on {table_name}, falling back to a table scan.")
+    return None
+
+
+def _build_request(table_name, airports, columns=None):
+    """
+    Request arguments shared by the scan and the index query: the table, the airport values (:airport0, :airport1,
+    ...) and the projection.
+    """
+    request = {'TableName': table_name,
+               'ExpressionAttributeNames': {'#airport': 'airport'},
+               'ExpressionAttributeValues': {f":airport{i}": {'S': airport} for i, airport in enumerate(airports)}}
+    if columns is not None:
+        # attribute names are aliased, some of them could be DynamoDB reserved words
+        aliases = [f"#p{i}" for i in range(len(columns))]
+        request['ExpressionAttributeNames'].update(zip(aliases, columns))
+        request['ProjectionExpression'] = ', '.join(aliases)
+    return request
+
+
+def _scan_request(request, segment=None, total_segments=None):
+    airport_values = [value for value in request['ExpressionAttributeValues'] if value.startswith(':airport')]
+    request = dict(request, FilterExpression=f"#airport IN ({', '.join(airport_values)})")
+    if total_segments is not None:
+        request.update(Segment=segment, TotalSegments=total_segments)
+    return request
+
+
+def _index_query_request(request, airport_index):
+    """
+    Query of the airport partition of the index.
+
+    The whole partition is read, like the scan reads every flight of the airport: the demand is binned on the
+    scheduled landing time and the stale flights are dropped on the estimated arrival time, so no range of the sort
+    key (e.g. of `est_arrival_time`) leaves the demand unchanged.
+    """
+    return dict(request, IndexName=airport_index['IndexName'], KeyConditionExpression='#airport = :airport0')
+
+
+def _updated_since_request(request, updated_since, airport_index=None):
+    """
+    Limits a scan or index query request to the flights with a last_msg_time at or after `updated_since`.
+
+    On an airport index sorted by `last_msg_time` the limit is a key condition and only the updated items are read,
+    otherwise it is a filter, which saves the transfer and decoding of the unchanged items but not the read capacity.
+    The filter matches the times stored as numbers and as strings (unix seconds of the same number of digits compare
+    like the numbers).
+    """
+    names = dict(request['ExpressionAttributeNames'], **{'#lmt': 'last_msg_time'})
+    if airport_index is not None and airport_index['SortKey'] == 'last_msg_time':
+        values = dict(request['ExpressionAttributeValues'],
+                      **{':lmt': {airport_index['SortKeyType']: str(updated_since)}})
+        return dict(request, ExpressionAttributeNames=names, ExpressionAttributeValues=values,
+                    KeyConditionExpression=request['KeyConditionExpression'] + ' AND #lmt >= :lmt')
+
+    values = dict(request['ExpressionAttributeValues'],
+                  **{':lmt_n': {'N': str(updated_since)}, ':lmt_s': {'S': str(updated_since)},
+                     ':type_n': {'S': 'N'}, ':type_s': {'S': 'S'}})
+    condition = ('((attribute_type(#lmt, :type_n) AND #lmt >= :lmt_n) OR '
+                 '(attribute_type(#lmt, :type_s) AND #lmt >= :lmt_s))')
+    if 'FilterExpression' in request:
+        condition = f"{request['FilterExpression']} AND {condition}"
+    return dict(request, ExpressionAttributeNames=names, ExpressionAttributeValues=values, FilterExpression=condition)
+
+
+def _iter_pages(operation, request):
+    """
+    Runs a scan or query request and follows LastEvaluatedKey, yields the raw (low-level) items page by page.
+
+    In an instrumented run the consumed capacity is requested and every page is counted in the 'dynamodb' stage.
+    """
+    if instrumentation.enabled():
+        request = dict(request, ReturnConsumedCapacity='TOTAL')
+    response = operation(**request)
+    _count_page(response)
+    yield response['Items']
+
+    # read the remaining items, since scan() and query() only return up to 1 MB of data at a time
+    while 'LastEvaluatedKey' in response:
+        response = operation(ExclusiveStartKey=response['LastEvaluatedKey'], **request)
+        _count_page(response)
+        yield response['Items']
+
+
+def _count_page(response):
+    if not instrumentation.enabled():
+        return
+    headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+    instrumentation.count('dynamodb', pages=1, items=len(response['Items']),
+                          scanned_items=response.get('ScannedCount', len(response['Items'])),
+                          read_capacity_units=response.get('ConsumedCapacity', {}).get('CapacityUnits', 0),
+                          bytes=int(headers.get('content-length', 0)))
+
+
+def iter_pages_concurrently(page_iterators, max_workers=None):
+    """
+    Reads the page iterators on a thread pool and yields their pages as they arrive.
+
+    The hand-over queue holds at most one page per worker: a slow consumer blocks the readers instead of letting
+    them buffer the table. Errors of the readers are raised once the other readers are done.
+    """
+    max_workers = max_workers or len(page_iterators)
+    pages = queue.Queue(maxsize=max_workers)
+    stop = threading.Event()
+    done = object()
+
+    def put(page):
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def read(page_iterator):
+        try:
+            for page in page_iterator:
+                if stop.is_set():
+                    return
+                put(page)
+        finally:
+            put(done)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(read, page_iterator) for page_iterator in page_iterators]
+        try:
+            remaining = len(futures)
+            while remaining:
+                page = pages.get()
+                if page is done:
+                    remaining -= 1
+                    continue
+                yield page
+        finally:
+            # also releases the readers when the consumer stops early
+            stop.set()
+
+    for future in futures:
+        future.result()
+
+
+def decode_flight_items(items, columns=None):
+    """
+    Decodes low-level DynamoDB items into typed columns.
+
+    `TIMESTAMP_COLUMNS` become int64 epoch seconds (`MISSING_TIMESTAMP` where missing or not a number),
+    `CATEGORICAL_COLUMNS` are dictionary encoded into int32 codes (-1 where missing) and their categories,
+    any other attribute is deserialized into an object array as the boto3 resource layer would.
+
+    Parameters
+    ----------
+    items: list of dict, items in the low-level format, e.g. {'est_arrival_time': {'N': '1679698800'}}
+    columns: list of str, optional, the columns to decode, defaults to every attribute found in the items
+
+    Returns
+    -------
+    dict
+        column name to np.ndarray, or to a (codes, categories) tuple of np.ndarray for the categorical columns.
+    """
+    if columns is None:
+        columns = list(dict.fromkeys(name for item in items for name in item))
+
+    decoded = {}
+    for column in columns:
+        values = [item.get(column) for item in items]
+        if column in TIMESTAMP_COLUMNS:
+            decoded[column] = _decode_timestamps(values)
+        elif column in CATEGORICAL_COLUMNS:
+            decoded[column] = _decode_categorical(values)
+        else:
+            decoded[column] = np.array([None if value is None else _deserializer.deserialize(value)
+                                        for value in values], dtype=object)
+    return decoded
+
+
+def _decode_timestamps(values):
+    # unix integers are stored as numbers or as strings
+    raw = [next(iter(value.values())) if value is not None and 'NULL' not in value else 'nan' for value in values]
+    try:
+        seconds = np.array(raw, dtype=np.float64)
+    except ValueError:
+        seconds = np.array([_parse_float(value) for value in raw], dtype=np.float64)
+
+    missing = np.isnan(seconds)
+    seconds[missing] = 0
+    seconds = seconds.astype(np.int64)
+    seconds[missing] = MISSING_TIMESTAMP
+    return seconds
+
+
+def _parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _decode_categorical(values):
+    lookup = {}
+    codes = np.fromiter((lookup.setdefault(value['S'], len(lookup)) if value is not None and 'S' in value else -1
+                         for value in values), dtype=np.int32, count=len(values))
+    categories = np.array(list(lookup), dtype=object)
+    return codes, categories
+
+
+def category_isin(codes, categories, values):
+    """
+    Mask of the dictionary encoded values that are in `values`, evaluated once per category. None in `values`
+    matches the missing values (code -1).
+    """
+    by_category = np.append(np.array([category in values for category in categories], dtype=bool), None in values)
+    return by_category[codes]  # code -1 picks the last element
@@ -1,21 +1,61 @@
-import boto3
-from boto3.dynamodb.conditions import Key
+import numpy as np
 import pandas as pd
 import logging
-from datetime import datetime,timezone,timedelta
-cancel_triggers=  ["FD_FLIGHT_CANCEL_MSG, UPDATE_CANCEL_TIMEOUT, UPDATE_INTERNATIONAL_CANCEL_TIMEOUT, TMI_UPDATE"],
+from datetime import datetime,timezone
 
-def query_active_flights(table_name='ActiveFlights', airport='EWR') -> pd.DataFrame:
+from .dynamodb_reader import DYNAMODB_REGION, DYNAMODB_CONFIG, cancel_triggers, stale_etd_types, TIMESTAMP_COLUMNS, \
+    CATEGORICAL_COLUMNS, PIPELINE_COLUMNS, MISSING_TIMESTAMP, get_dynamodb_client, get_key_attributes, \
+    find_airport_index, decode_flight_items, category_isin, flight_page_sources, iter_pages_concurrently, read_items
+from .flight_batch import ActiveFlightBatch
+from .flight_capture import write_flight_capture
+from . import array_backend
+
+
+def query_active_flights(table_name='ActiveFlights', airport='EWR', total_segments=1,
+                         max_workers=None, index_name=None, columns=None, capture_path=None,
+                         run_time=None) -> pd.DataFrame:
     """
     Queries a DynamoDB table to retrieve current active flights for a specified airport.
 
+    When the table has a global secondary index partitioned on `airport` (see `find_airport_index`), the flights are
+    read with a query on that index, which only reads the items of the airport. The whole airport partition is read,
+    so the index and the scan read the same flights and give the same demand.
+
+    Otherwise the table is read with a parallel scan: the key space is split into `total_segments` segments (DynamoDB
+    Segment/TotalSegments) which are scanned concurrently on a thread pool. Every worker only collects the raw item
+    lists, the dataframe is built once when all segments are read.
+
+    Items are read with the low-level client and decoded column by column (see `decode_flight_items`), the timestamp
+    columns come back as int64 epoch seconds and the enum-like columns as categoricals.
+
     Parameters
     ----------
     table_name : str
         The name of the DynamoDB table to query.
 
-    airport : str
-        The name of the airport for which to retrieve active flights.
+    airport : str or list of str
+        The name of the airport for which to retrieve active flights, or several airports read together.
+
+    total_segments : int
+        Number of scan segments. 1 keeps the sequential scan.
+
+    max_workers : int, optional
+        Size of the thread pool reading the scan segments (or the airport partitions of the index), defaults to one
+        worker each.
+
+    index_name : str, optional
+        The airport index to query, by default any index partitioned on `airport` is used.
+
+    columns : list of str, optional
+        Attributes to read (sent as ProjectionExpression), e.g. `PIPELINE_COLUMNS`. None reads all attributes.
+
+    capture_path : str, optional
+        Also write the flights read to this capture directory (see `flight_capture.write_flight_capture`), to replay
+        the run offline.
+
+    run_time : datetime, optional
+        The run time recorded in the capture, the time the stale flights of the run are checked against. Defaults to
+        the start of the read.
 
     Returns
     -------
@@ -25,53 +65,171 @@ def query_active_flights(table_name='ActiveFlights', airport='EWR') -> pd.DataFr
         If there are no active flights for the specified airport, the dataframe will be empty.
 
     """
+    run_time = run_time or datetime.now(timezone.utc)
+    page_sources, read_mode = flight_page_sources(table_name, airport, total_segments, index_name, columns)
+    decoded = decode_flight_items(read_items(page_sources, max_workers), columns)
+    if capture_path is not None:
+        write_flight_capture(decoded, capture_path, table_name, airport, run_time)
+
+    active_flights_df = pd.DataFrame(_to_frame_columns(decoded), copy=False)
+
+    logging.info(f"Retrieved {len(active_flights_df)} active flights for {airport} from DynamoDB table {table_name} "
+                 f"({read_mode}).")
+    return active_flights_df
 
-    dynamodb = boto3.resource("dynamodb", region_name="us-east-1")
 
-    table = dynamodb.Table(table_name)
+def iter_active_flight_pages(table_name='ActiveFlights', airport='EWR', total_segments=1,
+                             max_workers=None, index_name=None, columns=None):
+    """
+    Streaming version of `query_active_flights`, yields the active flights one DynamoDB page (up to 1 MB) at a time.
 
-    response = table.scan(FilterExpression=Key('airport').eq(airport))
+    The table is read the same way as `query_active_flights`. With several scan segments the pages are yielded in
+    the order they arrive; the segments are read ahead by at most one page per worker, so memory is bound by the page
+    size and not by the size of the table.
 
-    items = response['Items']
-    active_flights_df = pd.DataFrame(items)
+    Parameters
+    ----------
+    See `query_active_flights`.
 
-    # read the remaining items in the table, since the scan() method only returns up to 1 MB of data at a time
-    while 'LastEvaluatedKey' in response:
-        response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
-        items = response['Items']
-        active_flights_df = active_flights_df.append(pd.DataFrame(items))
+    Yields
+    ------
+    pd.DataFrame
+        The decoded active flights of one page.
+    """
+    page_sources, read_mode = flight_page_sources(table_name, airport, total_segments, index_name, columns)
+    logging.info(f"Streaming active flights for {airport} from DynamoDB table {table_name} ({read_mode}).")
 
-    logging.info(f"Retrieved {len(active_flights_df)} active flights for {airport} from DynamoDB table {table_name}.")
-    return active_flights_df
+    pages = page_sources[0] if len(page_sources) == 1 else iter_pages_concurrently(page_sources, max_workers)
+    for items in pages:
+        yield pd.DataFrame(_to_frame_columns(decode_flight_items(items, columns)), copy=False)
 
 
-def clean_active_flights(active_flights_df):
+def query_active_flights_by_airport(table_name='ActiveFlights', airports=('EWR',), total_segments=1,
+                                    max_workers=None, index_name=None, columns=None, capture_path=None,
+                                    run_time=None):
     """
-    Cleans the active flights data for flights that don't represent demand.
-    Drops cancelled and stale flights.
+    Reads the active flights of several airports with one read of the table and splits them by airport.
+
+    Without an airport index a single (segmented) scan filters on all the airports at once instead of one scan per
+    airport, with an index every airport partition is queried, concurrently.
 
     Parameters
     ----------
+    airports : list of str
+    See `query_active_flights` for the other parameters.
+
+    Returns
+    -------
+    dict
+        airport name to a dataframe of its active flights, airports without flights get an empty dataframe.
+    """
+    airports = list(airports)
+    if columns is not None and 'airport' not in columns:
+        columns = list(columns) + ['airport']
+
+    active_flights_df = query_active_flights(table_name, airports, total_segments, max_workers, index_name, columns,
+                                             capture_path, run_time)
+    if active_flights_df.empty:
+        return {airport: active_flights_df for airport in airports}
+
+    flights_by_airport = dict(list(active_flights_df.groupby('airport', observed=True, sort=False)))
+    return {airport: flights_by_airport.get(airport, active_flights_df.iloc[0:0]) for airport in airports}
+
+
+def _to_frame_columns(decoded):
+    """
+    Maps decoded columns to pandas columns, categorical codes become pd.Categorical without re-encoding.
+    """
+    return {column: pd.Categorical.from_codes(*values) if isinstance(values, tuple) else values
+            for column, values in decoded.items()}
+
+
+def clean_active_flights(active_flights_df, now=None, ordered=False):
+    """
+    Cleans the active flights data for flights that don't represent demand.
+    Drops cancelled and stale flights.
+
+    The cancel and stale rules of `drop_cancelled_flights` and `drop_stale_flights` are evaluated together as one
+    mask over the epoch seconds of the flights, and the frame is filtered once. The input frame is not modified.
 
-    config_path
-    active_flights_df: pd.DataFrame
-        The active flights data to be cleaned.
-    activeFlights_lag: int
-    airport:str
-    The airport for which to clean the active flights data.
+    An ActiveFlightBatch is cleaned without building a frame (see `array_backend.clean_active_flights`) and the
+    cleaned batch is returned.
 
+    Parameters
+    ----------
+    active_flights_df: pd.DataFrame or ActiveFlightBatch
+        The active flights data to be cleaned, with the timestamps as epoch seconds (as decoded by
+        `decode_flight_items`, strings and numbers coming from the table resource are converted too) or datetimes.
+    now: datetime, optional
+        The run time the stale flights are checked against, defaults to the current time. Pass the same value when
+        cleaning the flights of one run in several pieces.
+    ordered: bool, optional
+        Sort the flights by estimated arrival time, the demand calculation doesn't need it.
 
     Returns
     -------
     pd.DataFrame
-        The cleaned active flights data.
+        The cleaned active flights data, with the timestamp columns as UTC datetimes. An ActiveFlightBatch for a
+        batch.
     """
+    now = now or datetime.now(timezone.utc)  # one stale cutoff for all the flights
+    if isinstance(active_flights_df, ActiveFlightBatch):
+        return _clean_flight_batch(active_flights_df, now, ordered)
+
+    epochs = {column: _epoch_seconds(active_flights_df[column]) for column in TIMESTAMP_COLUMNS}
+    cancel_mask = _isin(active_flights_df['msg_trigger'], cancel_triggers)
+    est_arrival_time = epochs['est_arrival_time']
+    stale_mask = (_isin(active_flights_df['est_dept_time_type'], stale_etd_types) &
+                  (est_arrival_time != MISSING_TIMESTAMP) & (est_arrival_time < now.timestamp()))
+    keep = ~(cancel_mask | stale_mask)
+
+    logging.info(f"{cancel_mask.sum()} canceled flight(s) dropped..")
+    logging.info(f"{(stale_mask & ~cancel_mask).sum()} stale flight(s) dropped..")
+
+    inbound_flights_df = active_flights_df.loc[keep].copy(deep=False)
+    for column, values in epochs.items():
+        inbound_flights_df[column] = pd.Series(values[keep].view('datetime64[s]'),
+                                               index=inbound_flights_df.index).dt.tz_localize('UTC')
+
+    if ordered:
+        inbound_flights_df = inbound_flights_df.sort_values(by='est_arrival_time')
+    return inbound_flights_df
 
-    active_flights_df = format_time_values(active_flights_df)
-    operating_activeFlights_df = drop_cancelled_flights(active_flights_df, cancel_triggers)
-    inbound_flights_df = drop_stale_flights(operating_activeFlights_df)
 
-    return inbound_flights_df
+def _clean_flight_batch(flights, now, ordered):
+    inbound_flights = array_backend.clean_active_flights(flights, now)
+    if ordered:
+        # missing arrival times last, like sort_values
+        est_arrival_time = inbound_flights['est_arrival_time']
+        inbound_flights = inbound_flights.filter(np.lexsort((est_arrival_time,
+                                                             est_arrival_time == MISSING_TIMESTAMP)))
+    return inbound_flights
+
+
+def _epoch_seconds(column):
+    """
+    int64 epoch seconds of a timestamp column, MISSING_TIMESTAMP where the time is missing or not a number.
+    """
+    if pd.api.types.is_integer_dtype(column.dtype) and not isinstance(column.dtype, pd.api.extensions.ExtensionDtype):
+        return column.to_numpy(dtype=np.int64)
+    if pd.api.types.is_datetime64_any_dtype(column.dtype):
+        # tz-aware columns come out as UTC, NaT is the minimum int64 in any unit
+        return column.to_numpy(dtype='datetime64[s]').view(np.int64)
+
+    # Dynamo Unix integer read as string or Decimal
+    seconds = pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+    missing = ~np.isfinite(seconds)
+    return np.where(missing, MISSING_TIMESTAMP, np.nan_to_num(seconds, nan=0, posinf=0, neginf=0).astype(np.int64))
+
+
+def _isin(column, values):
+    """
+    `column.isin(values)` as a numpy mask, computed per category for categorical columns. None in `values` matches
+    missing values.
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return category_isin(column.cat.codes.to_numpy(), column.cat.categories, values)
+    return column.isin(values).to_numpy()
 
 
 def format_time_values(active_flights_df: pd.DataFrame) -> pd.DataFrame:
@@ -92,14 +250,7 @@ def format_time_values(active_flights_df: pd.DataFrame) -> pd.DataFrame:
         The formatted dataframe of active flights.
     """
 
-    timestamp_cols = ['sched_dept_time',
-                      'est_dept_time',
-                      'sched_landing_time',
-                      'last_msg_time',
-                      'flight_creation_time',
-                      'est_arrival_time'
-                      ]
-    convert_unix_timestamps_to_datetime(active_flights_df, timestamp_cols)
+    convert_unix_timestamps_to_datetime(active_flights_df, TIMESTAMP_COLUMNS)
 
     # sort by estimated arrival time
     active_flights_df = active_flights_df.sort_values(by='est_arrival_time')
@@ -131,7 +282,7 @@ def drop_cancelled_flights(active_flights_df, cancel_triggers):
     return active_flights_df.loc[~cancel_mask]
 
 
-def drop_stale_flights(operating_activeFlights_df: pd.DataFrame):
+def drop_stale_flights(operating_activeFlights_df: pd.DataFrame, now=None):
     """
     Drops non-sensical flights.
 
@@ -141,10 +292,9 @@ def drop_stale_flights(operating_activeFlights_df: pd.DataFrame):
     Returns dataframe of still-inbound flights
     """
     # Define the stale flights mask
-    stale_etd_types = ['SCHEDULED', 'PROPOSED', None]
     stale_mask = (
             (operating_activeFlights_df['est_dept_time_type'].isin(stale_etd_types)) &
-            (operating_activeFlights_df['est_arrival_time'] < datetime.now(timezone.utc)))
+            (operating_activeFlights_df['est_arrival_time'] < (now or datetime.now(timezone.utc))))
 
     stale_flights_ct = stale_mask.sum()
     logging.info(f"{stale_flights_ct} stale flight(s) dropped..")
@@ -155,7 +305,7 @@ def drop_stale_flights(operating_activeFlights_df: pd.DataFrame):
 def convert_unix_timestamps_to_datetime(df, columns):
     for col in columns:
         # Dynamo Unix integer read as string
-        if df[col].dtype == 'O':
+        if df[col].dtype == 'O' or pd.api.types.is_string_dtype(df[col].dtype):
             df[col] = pd.to_numeric(df[col], errors='coerce')
         df[col] = pd.to_datetime(df[col], unit='s', errors='coerce')
         df[col] = df[col].dt.tz_localize('UTC')
@@ -0,0 +1,199 @@
+"""
+Compact columnar store of active flights, the in-memory form of the decoded DynamoDB items.
+
+The timestamps are int64 epoch seconds and the enum-like columns (msg_trigger, est_dept_time_type, airport) are
+dictionary encoded, so a day of flights takes a few bytes per attribute instead of a boxed Python object each. This
+module does not import pandas, `ActiveFlightBatch.to_pandas` imports it when called.
+"""
+import numpy as np
+
+from .dynamodb_reader import TIMESTAMP_COLUMNS, CATEGORICAL_COLUMNS, decode_flight_items, category_isin
+
+
+class ActiveFlightBatch:
+    """
+    Active flights held column by column: the timestamps as int64 epoch seconds (MISSING_TIMESTAMP where missing),
+    the categorical columns as int32 codes (-1 where missing) into an array of categories, and any other attribute as
+    an object array.
+
+    `batch[column]` gives the array of a column, or its (codes, categories) tuple, the same values as
+    `decode_flight_items`. `batch[start:stop]` is a batch of views on the rows, `filter` selects rows by mask and keeps
+    sharing the categories.
+
+    usage:
+        batch = ActiveFlightBatch.from_items(items, PIPELINE_COLUMNS)
+        departed = batch.filter(~batch.isin('est_dept_time_type', stale_etd_types))
+        active_flights_df = departed.to_pandas()
+    """
+    __slots__ = ('_columns', '_length')
+
+    def __init__(self, columns=None):
+        """
+        Parameters
+        ----------
+        columns: dict of column name to np.ndarray, or to a (codes, categories) tuple for the categorical columns, as
+            returned by `decode_flight_items`. The arrays are not copied.
+        """
+        self._columns = {}
+        for column, values in (columns or {}).items():
+            if isinstance(values, tuple):
+                codes, categories = values
+                values = (np.asarray(codes), np.asarray(categories, dtype=object))
+            else:
+                values = np.asarray(values)
+            self._columns[column] = values
+
+        lengths = {len(_rows(values)) for values in self._columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"columns of different lengths: {sorted(lengths)}")
+        self._length = lengths.pop() if lengths else 0
+
+    @classmethod
+    def from_items(cls, items, columns=None):
+        """
+        Decodes DynamoDB items in the low-level format, see `decode_flight_items`.
+        """
+        return cls(decode_flight_items(items, columns))
+
+    @classmethod
+    def from_frame(cls, active_flights_df):
+        """
+        Batch of an active flights frame: categorical columns keep their codes, the timestamp columns (datetimes,
+        epoch seconds, or numbers and strings as read by the table resource) become int64 epoch seconds and the
+        other string columns are dictionary encoded if they are categorical columns.
+        """
+        import pandas as pd
+
+        from .dynamodb_utils import _epoch_seconds
+
+        columns = {}
+        for column, values in active_flights_df.items():
+            if column in CATEGORICAL_COLUMNS and not isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype('category')
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                columns[column] = (values.cat.codes.to_numpy(dtype=np.int32),
+                                   values.cat.categories.to_numpy(dtype=object))
+            elif column in TIMESTAMP_COLUMNS:
+                columns[column] = _epoch_seconds(values)
+            else:
+                columns[column] = values.to_numpy()
+        return cls(columns)
+
+    @classmethod
+    def concat(cls, batches):
+        """
+        Appends the rows of the batches, the categories of every column are merged and the codes re-mapped.
+        """
+        batches = list(batches)
+        if not batches:
+            return cls()
+        columns = {}
+        for column in batches[0].columns:
+            parts = [batch[column] for batch in batches]
+            if isinstance(parts[0], tuple):
+                columns[column] = _concat_categorical(parts)
+            else:
+                columns[column] = np.concatenate(parts)
+        return cls(columns)
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    @property
+    def nbytes(self):
+        """
+        Bytes held by the arrays of the batch, the categories and object columns are counted by their references.
+        """
+        return sum(values[0].nbytes + values[1].nbytes if isinstance(values, tuple) else values.nbytes
+                   for values in self._columns.values())
+
+    def __len__(self):
+        return self._length
+
+    def __contains__(self, column):
+        return column in self._columns
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._select(key)
+        return self._columns[key]
+
+    def __repr__(self):
+        return f"ActiveFlightBatch({self._length} flights, columns={self.columns})"
+
+    def items(self):
+        return self._columns.items()
+
+    def isin(self, column, values):
+        """
+        Mask of the flights whose `column` is in `values`, evaluated once per category for the categorical columns.
+        None in `values` matches the missing values.
+        """
+        column_values = self._columns[column]
+        if isinstance(column_values, tuple):
+            return category_isin(*column_values, values)
+        return np.fromiter((value in values for value in column_values), dtype=bool, count=self._length)
+
+    def filter(self, rows):
+        """
+        Batch of the selected flights.
+
+        Parameters
+        ----------
+        rows: np.ndarray of bool (a mask over the flights) or of int (positions, e.g. from `np.argsort`)
+
+        Returns
+        -------
+        ActiveFlightBatch, the arrays are copies of the selected rows, the categories are shared
+        """
+        return self._select(np.asarray(rows))
+
+    def to_numpy(self):
+        """
+        The columns as numpy arrays without copying: the timestamps as datetime64[s] (NaT where missing), the
+        categorical columns as their (codes, categories) tuple.
+        """
+        return {column: values.view('datetime64[s]') if column in TIMESTAMP_COLUMNS and values.dtype == np.int64
+                else values
+                for column, values in self._columns.items()}
+
+    def to_pandas(self):
+        """
+        The flights as a frame, as returned by `dynamodb_utils.query_active_flights`: int64 epoch seconds and
+        pd.Categorical columns built on the codes without re-encoding. The timestamp arrays are not copied.
+        """
+        import pandas as pd
+
+        return pd.DataFrame({column: pd.Categorical.from_codes(*values) if isinstance(values, tuple) else values
+                             for column, values in self._columns.items()}, copy=False)
+
+    def _select(self, rows):
+        return ActiveFlightBatch({column: (values[0][rows], values[1]) if isinstance(values, tuple) else values[rows]
+                                  for column, values in self._columns.items()})
+
+
+def as_flight_batch(flights):
+    """
+    The flights as an ActiveFlightBatch, dicts of decoded columns are wrapped without copying.
+    """
+    return flights if isinstance(flights, ActiveFlightBatch) else ActiveFlightBatch(flights)
+
+
+def _rows(values):
+    return values[0] if isinstance(values, tuple) else values
+
+
+def _concat_categorical(parts):
+    categories = np.array(list(dict.fromkeys(category for _, part_categories in parts
+                                             for category in part_categories)), dtype=object)
+    positions = {category: code for code, category in enumerate(categories)}
+    codes = []
+    for part_codes, part_categories in parts:
+        # -1 (missing) picks the appended -1
+        mapping = np.append(np.array([positions[category] for category in part_categories], dtype=np.int32), -1)
+        codes.append(mapping[part_codes])
+    return np.concatenate(codes).astype(np.int32, copy=False), categories
@@ -0,0 +1,157 @@
+"""
+Captures of the active flights read by a run, and their replay through the demand calculation without AWS.
+
+A capture is a directory with one .npy file per column (the codes and categories of the categorical columns in two
+files) and a meta.json with the table, the airports and the run time of the read. The columns are read back memory
+mapped, so a capture of any size opens instantly and the cleaning runs on the mapped pages without a copy of the
+input; the same run time gives the same demand as the original run.
+
+    flights, meta = read_flight_capture('captures/ActiveFlights/20230324T213000')
+    demands = replay_flight_capture('captures/ActiveFlights/20230324T213000', array_backend)
+"""
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+
+import numpy as np
+
+from .flight_batch import ActiveFlightBatch, as_flight_batch
+
+CAPTURE_VERSION = 1
+_META_FILE = 'meta.json'
+
+
+def capture_path(directory, table_name, run_time):
+    """
+    Path of the capture of a run: <directory>/<table name>/<run time as YYYYMMDDTHHMMSS>.
+    """
+    return os.path.join(directory, table_name, run_time.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%S'))
+
+
+def write_flight_capture(flights, path, table_name=None, airports=None, run_time=None):
+    """
+    Writes the flights to the capture directory `path`, replacing an existing capture.
+
+    The files are written to a temporary directory that is renamed to `path` once complete.
+
+    Parameters
+    ----------
+    flights: ActiveFlightBatch or dict of decoded columns
+    path: str
+    table_name: str, optional
+    airports: str or list of str, optional, the airports of the read
+    run_time: datetime, optional, the run time of the read, defaults to the current time
+    """
+    flights = as_flight_batch(flights)
+    run_time = run_time or datetime.now(timezone.utc)
+    temporary_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+
+    column_kinds = {}
+    for column, values in flights.items():
+        if isinstance(values, tuple):
+            np.save(os.path.join(temporary_path, f"{column}.codes.npy"), values[0])
+            np.save(os.path.join(temporary_path, f"{column}.categories.npy"), np.array(values[1], dtype=str))
+            column_kinds[column] = 'categorical'
+        elif values.dtype == object and all(isinstance(value, str) for value in values):
+            # fixed width strings can be memory mapped
+            np.save(os.path.join(temporary_path, f"{column}.npy"), values.astype(str))
+            column_kinds[column] = 'string'
+        else:
+            np.save(os.path.join(temporary_path, f"{column}.npy"), values)
+            column_kinds[column] = 'object' if values.dtype == object else 'array'
+
+    meta = {'version': CAPTURE_VERSION,
+            'table_name': table_name,
+            'airports': [airports] if isinstance(airports, str) else airports,
+            'run_time': run_time.timestamp(),
+            'flights': len(flights),
+            'columns': column_kinds}
+    with open(os.path.join(temporary_path, _META_FILE), 'w') as meta_file:
+        json.dump(meta, meta_file, indent=2)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temporary_path, path)
+
+
+def read_flight_capture(path, mmap=True):
+    """
+    Reads a capture written by `write_flight_capture`.
+
+    Parameters
+    ----------
+    path: str
+    mmap: bool, memory map the columns (read-only) instead of reading them into memory. Columns of other objects than
+        strings are always read, they are stored pickled.
+
+    Returns
+    -------
+    (ActiveFlightBatch, dict) the flights and the meta of the capture, with the run time as a datetime
+    """
+    meta = read_capture_meta(path)
+    mmap_mode = 'r' if mmap else None
+    columns = {}
+    for column, kind in meta['columns'].items():
+        if kind == 'categorical':
+            columns[column] = (np.load(os.path.join(path, f"{column}.codes.npy"), mmap_mode=mmap_mode),
+                               np.load(os.path.join(path, f"{column}.categories.npy")).astype(object))
+        elif kind == 'object':
+            columns[column] = np.load(os.path.join(path, f"{column}.npy"), allow_pickle=True)
+        else:
+            columns[column] = np.load(os.path.join(path, f"{column}.npy"), mmap_mode=mmap_mode)
+
+    return ActiveFlightBatch(columns), meta
+
+
+def read_capture_meta(path):
+    """
+    The meta of a capture, with the run time as a datetime, without reading its columns.
+    """
+    with open(os.path.join(path, _META_FILE)) as meta_file:
+        meta = json.load(meta_file)
+    if meta['version'] != CAPTURE_VERSION:
+        raise ValueError(f"capture {path} has version {meta['version']}, expected {CAPTURE_VERSION}")
+    meta['run_time'] = datetime.fromtimestamp(meta['run_time'], timezone.utc)
+    return meta
+
+
+def iter_flight_captures(directory):
+    """
+    Yields the paths of the captures under `directory` (e.g. the captures of a day), ordered by path.
+    """
+    for root, directories, files in os.walk(directory):
+        directories.sort()
+        if _META_FILE in files and '.tmp-' not in os.path.basename(root):
+            yield root
+
+
+def replay_flight_capture(path, backend, airports=None, bin_minutes=60, mmap=True):
+    """
+    Runs the demand calculation of a run on its capture: `clean_active_flights` and `calculate_demand_from_flights`
+    of the backend, at the run time of the capture.
+
+    Parameters
+    ----------
+    path: str
+    backend: module, `array_backend` or `pandas_backend`
+    airports: list of str, optional, defaults to the airports of the capture
+    bin_minutes: int
+    mmap: bool, see `read_flight_capture`
+
+    Returns
+    -------
+    dict of airport name to the demand of the backend
+    """
+    flights, meta = read_flight_capture(path, mmap)
+    airports = airports or meta['airports'] or []
+    run_time = meta['run_time']
+
+    demands = {}
+    for airport in airports:
+        airport_flights = flights.filter(flights.isin('airport', [airport])) if 'airport' in flights else flights
+        airport_flights = backend.from_flight_batch(airport_flights)
+        demands[airport] = backend.calculate_demand_from_flights(
+            backend.clean_active_flights(airport_flights, run_time), run_time, bin_minutes=bin_minutes)
+    return demands
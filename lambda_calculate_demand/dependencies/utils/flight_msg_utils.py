@@ -1,10 +1,17 @@
+import math
 from datetime import datetime, timedelta
+
+import numpy as np
 import pandas as pd
 
+from .demand_histogram import CALC_HORIZON_HOURS, RUNTIME_OFFSET_HOURS, demand_histograms, horizon_start, _n_bins
+
 AIRPORT = 'EWR'
 DEFAULT_TIME_STAMP = '1975-01-01T01:01:00Z'
-CALC_HORIZON_HOURS = 20  # this many hours in future to calculate capacity
-RUNTIME_OFFSET_HOURS = 1  # assume validty of the messages for the past hour (since we check past N hour messages)
+DEMAND_CUBE_DIMENSIONS = ['origin', 'carrier', 'est_dept_time_type']  # flight attributes the demand is broken down by
+LANDING_TIME_COLUMNS = {'scheduled': 'sched_landing_time', 'estimated': 'est_arrival_time'}  # landing_time tag values
+MISSING_DIMENSION = 'unknown'  # label of the flights without a value for a dimension
+_MAX_DENSE_CELLS = 1 << 24  # larger cubes are counted on their non-empty cells only
 
 
 def _string_to_datetime(time_string):
@@ -30,12 +37,284 @@ def _get_current_system_time(runtime_offset_hours):
     return datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=runtime_offset_hours)
 
 
-def calculate_demand_from_flights(active_flights):
+def calculate_demand_from_flights(active_flights, now=None, horizon_hours=CALC_HORIZON_HOURS, bin_minutes=60):
+    """
+    Counts the flights scheduled to land in every time bin of the calculation horizon.
 
-    active_flights['scheduled_landing_hour']=active_flights.sched_landing_time.dt.floor('H')
-    demand_by_hour = active_flights.groupby('scheduled_landing_hour').count()['sched_landing_time'].\
-        reset_index()
+    The bins start at the current hour and cover `horizon_hours`, bins without flights have a demand of 0 and
+    flights landing outside of the horizon are not counted.
 
-    demand_by_hour.columns = ['valid_time', 'demand']
-    return demand_by_hour
+    Parameters
+    ----------
+    active_flights: pd.DataFrame or ActiveFlightBatch, cleaned active flights with the sched_landing_time column
+        (datetimes or epoch seconds), the flights are not modified
+    now: datetime, optional, the run time the horizon starts at (rounded down to the hour), defaults to the current
+        time
+    horizon_hours: int
+    bin_minutes: int, width of the bins, e.g. 15, 30 or 60
 
+    Returns
+    -------
+    pd.DataFrame with the valid_time (start of the bin) and demand columns
+    """
+    return calculate_demands_from_flights(active_flights, now, horizon_hours, (bin_minutes,))[bin_minutes]
+
+
+def calculate_demands_from_flights(active_flights, now=None, horizon_hours=CALC_HORIZON_HOURS,
+                                   bin_minutes=(15, 30, 60)):
+    """
+    `calculate_demand_from_flights` at several bin widths, from one pass over the flights.
+
+    Returns
+    -------
+    dict of bin width (minutes) to pd.DataFrame with the valid_time and demand columns
+    """
+    start = horizon_start(now)
+    histograms = demand_histograms(landing_seconds(active_flights['sched_landing_time']), start, horizon_hours,
+                                   bin_minutes)
+    return {width: demand_frame(counts, start, width) for width, counts in histograms.items()}
+
+
+def calculate_demand_from_flight_pages(flight_pages, now=None, horizon_hours=CALC_HORIZON_HOURS, bin_minutes=60):
+    """
+    Streaming version of `calculate_demand_from_flights`.
+
+    Every page of cleaned flights is reduced to its histogram as soon as it arrives and added to the running total,
+    so only one page of flights is held in memory at a time. Returns the same frame as
+    `calculate_demand_from_flights` over all the pages.
+
+    Parameters
+    ----------
+    flight_pages: iterable of pd.DataFrame or ActiveFlightBatch, cleaned active flights, e.g. `clean_active_flights`
+        over `iter_active_flight_pages`
+    now, horizon_hours, bin_minutes: see `calculate_demand_from_flights`
+
+    Returns
+    -------
+    pd.DataFrame with the valid_time and demand columns
+    """
+    start = horizon_start(now)
+    counts = np.zeros(_n_bins(horizon_hours, bin_minutes), dtype=np.int64)
+    for active_flights in flight_pages:
+        counts += demand_histograms(landing_seconds(active_flights['sched_landing_time']), start, horizon_hours,
+                                    (bin_minutes,))[bin_minutes]
+    return demand_frame(counts, start, bin_minutes)
+
+
+def calculate_demand_by_airport_from_flight_pages(flight_pages, airports, now=None, horizon_hours=CALC_HORIZON_HOURS,
+                                                  bin_minutes=60):
+    """
+    `calculate_demand_from_flight_pages` of several airports, from one stream of pages: every page is split by its
+    airport column, so the table is read once for all the airports.
+
+    Parameters
+    ----------
+    flight_pages: iterable of pd.DataFrame or ActiveFlightBatch, cleaned active flights with the airport column
+    airports: list of str
+    now, horizon_hours, bin_minutes: see `calculate_demand_from_flights`
+
+    Returns
+    -------
+    dict of airport name to pd.DataFrame with the valid_time and demand columns
+    """
+    start = horizon_start(now)
+    counts = {airport: np.zeros(_n_bins(horizon_hours, bin_minutes), dtype=np.int64) for airport in airports}
+    for active_flights in flight_pages:
+        landing_times = landing_seconds(active_flights['sched_landing_time'])
+        for airport in airports:
+            counts[airport] += demand_histograms(landing_times[_airport_mask(active_flights, airport)], start,
+                                                 horizon_hours, (bin_minutes,))[bin_minutes]
+    return {airport: demand_frame(airport_counts, start, bin_minutes) for airport, airport_counts in counts.items()}
+
+
+def _airport_mask(active_flights, airport):
+    if isinstance(active_flights, pd.DataFrame):
+        return (active_flights['airport'] == airport).to_numpy(dtype=bool, na_value=False)
+    return active_flights.isin('airport', [airport])
+
+
+def calculate_demand_cube(active_flights, breakdowns=None, now=None, horizon_hours=CALC_HORIZON_HOURS, bin_minutes=60,
+                          landing_times=LANDING_TIME_COLUMNS, previous=None):
+    """
+    The demand broken down by flight attributes, every breakdown from one pass over the flights.
+
+    The dimension columns are encoded once as integer codes. Every flight is counted at each of its `landing_times`
+    (by default at its scheduled and at its estimated landing time) with one `np.bincount` over the combined key of
+    the landing time, the time bin and the codes. The breakdowns are sums over the cells of that count, their cost
+    depends on the number of non-empty cells and not on the number of flights.
+
+    Parameters
+    ----------
+    active_flights: pd.DataFrame or ActiveFlightBatch, cleaned active flights with the landing time columns and the
+        dimension columns of the breakdowns, the flights are not modified
+    breakdowns: list of tuples of column names, the dimensions of every breakdown, () is the total demand. Defaults
+        to the total and to every column of DEMAND_CUBE_DIMENSIONS on its own.
+    now, horizon_hours, bin_minutes: see `calculate_demand_from_flights`
+    landing_times: dict of landing_time value to the column of the landing times the flights are counted at
+    previous: pd.DataFrame, optional, the cube of the previous run. Its series without any flight in the horizon now
+        are returned with a demand of 0 in every bin, so pushing the cube overwrites their former demand.
+
+    Returns
+    -------
+    pd.DataFrame with the valid_time, demand and landing_time columns and a column per dimension, None in the rows of
+    the breakdowns without that dimension, and MISSING_DIMENSION for the flights without a value. Like the hourly
+    demand, every series (a landing time and the labels of a breakdown) has a row for every bin of the horizon, bins
+    without flights with a demand of 0: the series with a flight in the horizon, the total of every landing time, and
+    the series of `previous`. The scheduled total is `calculate_demand_from_flights`. A series that lost its last
+    flight is only zeroed when the previous cube is passed (or by the 'changes' demand_write_mode of the
+    InfluxDBHandler, which writes 0 to the dropped points).
+    """
+    if breakdowns is None:
+        breakdowns = [()] + [(dimension,) for dimension in DEMAND_CUBE_DIMENSIONS]
+    breakdowns = [tuple(breakdown) for breakdown in breakdowns]
+    dimensions = list(dict.fromkeys(dimension for breakdown in breakdowns for dimension in breakdown))
+    start = horizon_start(now)
+    n_bins = _n_bins(horizon_hours, bin_minutes)
+
+    labels = []
+    dimension_key = np.zeros(len(active_flights), dtype=np.int64)  # the mixed radix key of the dimension codes
+    for dimension in dimensions:
+        dimension_codes, dimension_labels = _dimension_codes(active_flights[dimension])
+        dimension_key *= len(dimension_labels)
+        dimension_key += dimension_codes
+        labels.append(dimension_labels)
+    sizes = [len(landing_times), n_bins] + [len(dimension_labels) for dimension_labels in labels]
+    n_dimension_cells = math.prod(sizes[2:])
+
+    # one key per flight and landing time: the landing time, the time bin, then the dimension codes
+    keys = []
+    for landing_time, column in enumerate(landing_times.values()):
+        bins = (landing_seconds(active_flights[column]) - start) // (bin_minutes * 60)
+        in_horizon = (bins >= 0) & (bins < n_bins)
+        keys.append((landing_time * n_bins + bins[in_horizon]) * n_dimension_cells + dimension_key[in_horizon])
+    marginals = _cube_marginals(np.concatenate(keys), sizes, [[2 + dimensions.index(dimension)
+                                                               for dimension in breakdown] for breakdown in breakdowns])
+
+    landing_time_values = np.array(list(landing_times), dtype=object)
+    frames = []
+    for breakdown, (codes, counts) in zip(breakdowns, marginals):
+        codes, counts = _dense_series(codes, counts, n_bins, len(landing_times) if not breakdown else 0)
+        frame = {'valid_time': pd.to_datetime(start + codes[1] * bin_minutes * 60, unit='s', utc=True),
+                 'demand': counts.astype(np.int64),
+                 'landing_time': landing_time_values[codes[0]]}
+        # the codes of the breakdown come in the order of the dimensions
+        breakdown_codes = iter(codes[2:])
+        for dimension, dimension_labels in zip(dimensions, labels):
+            frame[dimension] = (dimension_labels[next(breakdown_codes)] if dimension in breakdown
+                                else np.full(len(counts), None, dtype=object))
+        frames.append(pd.DataFrame(frame))
+    cube = pd.concat(frames, ignore_index=True)
+    if previous is not None and len(previous):
+        cube = _zero_dropped_series(cube, previous, ['landing_time'] + dimensions,
+                                    pd.to_datetime(start + np.arange(n_bins) * bin_minutes * 60, unit='s', utc=True))
+    return cube
+
+
+def _dense_series(codes, counts, n_bins, n_landing_times=0):
+    """
+    The codes and counts of the non-empty cells of a breakdown (see `_cube_marginals`) with every bin of the series
+    they belong to, the bins without flights counted 0. With `n_landing_times` every landing time is a series, also
+    without flights (the total breakdown). The cells stay in ascending order.
+    """
+    series = np.stack([codes[0]] + list(codes[2:]))
+    if n_landing_times:
+        series = np.concatenate([series, np.arange(n_landing_times, dtype=series.dtype)[None, :]], axis=1)
+    series, inverse = np.unique(series, axis=1, return_inverse=True)
+    dense = np.zeros((series.shape[1], n_bins), dtype=np.int64)
+    dense[inverse.ravel()[:len(counts)], codes[1]] = counts
+
+    series_index, bins = np.divmod(np.arange(dense.size), n_bins)
+    dense_codes = [series[0][series_index], bins] + [axis_codes[series_index] for axis_codes in series[1:]]
+    order = np.lexsort(dense_codes[::-1])
+    return tuple(axis_codes[order] for axis_codes in dense_codes), dense.ravel()[order]
+
+
+def _zero_dropped_series(cube, previous, series_columns, valid_times):
+    """
+    The cube with a row of demand 0 at every valid time for each series of `previous` that is not in the cube.
+    """
+    previous_series = previous.reindex(columns=series_columns).astype(object)
+    previous_series = previous_series.where(previous_series.notna(), None).drop_duplicates()
+    current_series = cube[series_columns].astype(object).drop_duplicates()
+    dropped = previous_series.merge(current_series, how='left', on=series_columns, indicator=True)
+    dropped = dropped.loc[dropped['_merge'] == 'left_only', series_columns]
+    if dropped.empty:
+        return cube
+    zeros = dropped.merge(pd.DataFrame({'valid_time': valid_times}), how='cross').assign(demand=0)
+    return pd.concat([cube, zeros[cube.columns]], ignore_index=True)
+
+
+def _cube_marginals(keys, sizes, breakdown_axes):
+    """
+    Counts the keys of a cube of shape `sizes` (row-major), and sums the counts over the axes after the first two that
+    are not in the axes of each breakdown.
+
+    Returns
+    -------
+    list of (codes, counts) per breakdown, the codes of the non-empty cells along the first two and the breakdown axes
+    (in ascending order) and their counts
+    """
+    n_cells = math.prod(sizes)
+    if n_cells <= _MAX_DENSE_CELLS:
+        cube = np.bincount(keys, minlength=n_cells).reshape(sizes)
+        marginals = []
+        for axes in breakdown_axes:
+            marginal = cube.sum(axis=tuple(axis for axis in range(2, len(sizes)) if axis not in axes))
+            codes = np.nonzero(marginal)
+            marginals.append((codes, marginal[codes]))
+        return marginals
+
+    # too large to be dense, only the non-empty cells are counted and summed
+    cells, counts = np.unique(keys, return_counts=True)
+    cell_codes = np.unravel_index(cells, sizes)
+    marginals = []
+    for axes in breakdown_axes:
+        kept = [0, 1] + sorted(axes)
+        marginal_cells, inverse = np.unique(np.ravel_multi_index([cell_codes[axis] for axis in kept],
+                                                                 [sizes[axis] for axis in kept]),
+                                            return_inverse=True)
+        marginals.append((np.unravel_index(marginal_cells, [sizes[axis] for axis in kept]),
+                          np.bincount(inverse, counts)))
+    return marginals
+
+
+def _dimension_codes(column):
+    """
+    int64 codes of a dimension column (a pd.Series, np.ndarray or the (codes, categories) tuple of an
+    ActiveFlightBatch) and the labels they index. The labels are sorted, so the cube does not depend on the encoding
+    of the column, the missing values get the last label, MISSING_DIMENSION.
+    """
+    if isinstance(column, tuple):
+        codes, categories = column
+    elif isinstance(column.dtype, pd.CategoricalDtype):
+        codes, categories = column.cat.codes.to_numpy(), column.cat.categories
+    else:
+        codes, categories = pd.factorize(column)
+    categories = np.array([str(category) for category in categories], dtype=object)
+    order = np.argsort(categories, kind='stable')
+    # code -1 (missing) picks the appended position of MISSING_DIMENSION
+    positions = np.append(np.argsort(order), len(categories))
+    return positions[codes], np.append(categories[order], MISSING_DIMENSION)
+
+
+def demand_frame(counts, start, bin_minutes):
+    """
+    The demand frame of a histogram of `demand_histograms`.
+    """
+    valid_time = start + np.arange(len(counts), dtype=np.int64) * bin_minutes * 60
+    return pd.DataFrame({'valid_time': pd.to_datetime(valid_time, unit='s', utc=True),
+                         'demand': counts.astype(np.int64)})
+
+
+def landing_seconds(column):
+    """
+    int64 epoch seconds of a timestamp column (datetimes or epoch seconds, as pd.Series or np.ndarray), missing times
+    become the minimum int64.
+    """
+    if isinstance(column, np.ndarray):
+        if np.issubdtype(column.dtype, np.datetime64):
+            return column.astype('datetime64[s]').view(np.int64)
+        return column.astype(np.int64, copy=False)
+    if pd.api.types.is_datetime64_any_dtype(column.dtype):
+        return column.to_numpy(dtype='datetime64[s]').view(np.int64)
+    return column.to_numpy(dtype=np.int64)
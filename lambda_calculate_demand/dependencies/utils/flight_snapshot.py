@@ -0,0 +1,256 @@
+"""
+On-disk snapshot cache of the active flights, refreshed with the flights updated since the previous read.
+
+A full read of the table returns every active flight of the airports, although most of them have not changed since the
+last run. The cache keeps the flights of every (table, airport) in a snapshot file together with the high-water mark
+of their `last_msg_time`; the next read only asks DynamoDB for the flights with a newer `last_msg_time` (see
+`dynamodb_reader._updated_since_request`) and merges them into the snapshot on the primary key.
+
+Flights deleted from the table are not seen by the delta reads. Landed flights and flights without a message for
+`expire_hours` are evicted from the snapshot, and a full read replaces the snapshot every `full_refresh_hours`. Flights
+without a last_msg_time are only updated by the full reads.
+
+The snapshots are uncompressed numpy .npz files (one per table and airport), written to a temporary file and renamed
+so a failed write leaves the previous snapshot. The default directory is under /tmp, which is kept across the warm
+invocations of the Lambda.
+"""
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timezone
+
+import numpy as np
+
+from .demand_histogram import RUNTIME_OFFSET_HOURS, horizon_start
+from .dynamodb_reader import PIPELINE_COLUMNS, MISSING_TIMESTAMP, get_key_attributes, flight_page_sources, read_items
+from .flight_batch import ActiveFlightBatch
+from .flight_capture import write_flight_capture
+
+DEFAULT_SNAPSHOT_DIRECTORY = '/tmp/active_flight_snapshots'
+FULL_REFRESH_HOURS = 6  # a full read every this many hours drops the flights deleted from the table
+EXPIRE_HOURS = 24  # flights without a message for this long are evicted
+OVERLAP_SECONDS = 300  # the delta read starts this long before the high-water mark, for messages written late
+SNAPSHOT_VERSION = 1
+
+_META = '__meta__'
+
+
+class FlightSnapshotCache:
+    """
+    Snapshots of the active flights per (table, airport), refreshed with delta reads.
+
+    usage:
+        cache = FlightSnapshotCache()
+        flights_by_airport = cache.query_active_flights_by_airport('ActiveFlights', ['EWR', 'JFK'])
+        # dict of airport to ActiveFlightBatch, the next call only reads the flights updated in the meantime
+    """
+
+    def __init__(self, directory=DEFAULT_SNAPSHOT_DIRECTORY, full_refresh_hours=FULL_REFRESH_HOURS,
+                 expire_hours=EXPIRE_HOURS, overlap_seconds=OVERLAP_SECONDS):
+        """
+        Parameters
+        ----------
+        directory: str, where the snapshot files are kept, e.g. a path under /tmp or on a mounted volume
+        full_refresh_hours: float, age of a snapshot after which it is replaced by a full read
+        expire_hours: float, flights whose last message is older are evicted, None keeps them until the next full
+            read
+        overlap_seconds: int, seconds before the high-water mark the delta read starts at, updates are merged on the
+            primary key so flights read twice are counted once
+        """
+        self.directory = directory
+        self.full_refresh_hours = full_refresh_hours
+        self.expire_hours = expire_hours
+        self.overlap_seconds = overlap_seconds
+
+    def path(self, table_name, airport):
+        return os.path.join(self.directory, table_name, f"{airport}.npz")
+
+    def load(self, table_name, airport):
+        """
+        Returns the (flights, meta) of the snapshot, None when there is no usable snapshot.
+        """
+        path = self.path(table_name, airport)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=True) as arrays:  # the files are only written by `save`
+                meta = json.loads(str(arrays[_META]))
+                if meta.get('version') != SNAPSHOT_VERSION:
+                    return None
+                columns = {}
+                for column in meta['columns']:
+                    if f"{column}/codes" in arrays:
+                        columns[column] = (arrays[f"{column}/codes"], arrays[f"{column}/categories"].astype(object))
+                    else:
+                        columns[column] = arrays[column]
+        except (OSError, EOFError, ValueError, KeyError, pickle.UnpicklingError, zipfile.BadZipFile) as error:
+            logging.warning(f"snapshot {path} could not be read ({error}), it is replaced by a full read.")
+            return None
+        return ActiveFlightBatch(columns), meta
+
+    def save(self, table_name, airport, flights, meta):
+        """
+        Writes the snapshot of the flights, `meta` is kept with it (the columns and version are added).
+        """
+        path = self.path(table_name, airport)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        arrays = {}
+        for column, values in flights.items():
+            if isinstance(values, tuple):
+                arrays[f"{column}/codes"] = values[0]
+                arrays[f"{column}/categories"] = np.array(values[1], dtype=str)
+            else:
+                arrays[column] = values
+        arrays[_META] = np.array(json.dumps(dict(meta, version=SNAPSHOT_VERSION, columns=flights.columns)))
+
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as snapshot_file:
+                np.savez(snapshot_file, **arrays)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    def clear(self, table_name=None):
+        """
+        Removes the snapshots of the table, or all the snapshots.
+        """
+        shutil.rmtree(self.directory if table_name is None else os.path.join(self.directory, table_name),
+                      ignore_errors=True)
+
+    def query_active_flights_by_airport(self, table_name='ActiveFlights', airports=('EWR',), total_segments=1,
+                                        max_workers=None, index_name=None, columns=PIPELINE_COLUMNS, now=None,
+                                        capture_path=None):
+        """
+        `dynamodb_utils.query_active_flights_by_airport` served from the snapshots.
+
+        The airports without a current snapshot are read in full, the others with one delta read from the lowest of
+        their high-water marks (less `overlap_seconds`), so one call reads the table at most twice. The whole airport
+        is read, not only the calculation horizon: a flight moving out of the horizon has to reach the snapshot too.
+
+        Parameters
+        ----------
+        columns: list of str, attributes to keep, the primary key, airport and last_msg_time are always kept
+        now: datetime, optional, the run time the snapshots are aged and the flights evicted at
+        capture_path: str, optional, also write the flights of all the airports to this capture directory, see
+            `flight_capture.write_flight_capture`
+        See `query_active_flights` for the other parameters.
+
+        Returns
+        -------
+        dict of airport name to the ActiveFlightBatch of its active flights
+        """
+        now = now or datetime.now(timezone.utc)
+        now_seconds = int(now.timestamp())
+        airports = list(airports)
+        key_columns = get_key_attributes(table_name)
+        columns = list(dict.fromkeys([*key_columns, *columns, 'airport', 'last_msg_time']))
+
+        snapshots = {airport: self.load(table_name, airport) for airport in airports}
+        full_airports = [airport for airport in airports
+                         if not self._is_current(snapshots[airport], columns, now_seconds)]
+        delta_airports = [airport for airport in airports if airport not in full_airports]
+
+        flights_by_airport = {}
+        if full_airports:
+            read_flights = self._read(table_name, full_airports, total_segments, max_workers, index_name, columns)
+            for airport in full_airports:
+                flights = _airport_flights(read_flights, airport)
+                meta = {'full_refresh_time': now_seconds,
+                        'high_water_mark': _high_water_mark(flights, now_seconds)}
+                flights_by_airport[airport] = self._store(table_name, airport, flights, meta, now)
+
+        if delta_airports:
+            updated_since = min(snapshots[airport][1]['high_water_mark'] for airport in delta_airports)
+            updated_flights = self._read(table_name, delta_airports, total_segments, max_workers, index_name, columns,
+                                         updated_since - self.overlap_seconds)
+            for airport in delta_airports:
+                snapshot, meta = snapshots[airport]
+                # merged with all the updates, a flight diverted to another airport leaves this snapshot
+                flights = _airport_flights(merge_flights(snapshot, updated_flights, key_columns), airport)
+                high_water_mark = max(meta['high_water_mark'],
+                                      _high_water_mark(updated_flights, meta['high_water_mark']))
+                meta = dict(meta, high_water_mark=high_water_mark)
+                flights_by_airport[airport] = self._store(table_name, airport, flights, meta, now)
+
+        if capture_path is not None:
+            write_flight_capture(ActiveFlightBatch.concat(flights_by_airport[airport] for airport in airports),
+                                 capture_path, table_name, airports, now)
+        return {airport: flights_by_airport[airport] for airport in airports}
+
+    def _is_current(self, snapshot, columns, now_seconds):
+        if snapshot is None:
+            return False
+        _, meta = snapshot
+        return (meta['columns'] == columns and
+                now_seconds - meta['full_refresh_time'] < self.full_refresh_hours * 3600)
+
+    @staticmethod
+    def _read(table_name, airports, total_segments, max_workers, index_name, columns, updated_since=None):
+        page_sources, read_mode = flight_page_sources(table_name, airports, total_segments, index_name, columns,
+                                                updated_since)
+        flights = ActiveFlightBatch.from_items(read_items(page_sources, max_workers), columns)
+        logging.info(f"Retrieved {len(flights)} active flights for {airports} from DynamoDB table {table_name} "
+                     f"({read_mode}).")
+        return flights
+
+    def _store(self, table_name, airport, flights, meta, now):
+        flights = evict_flights(flights, now, self.expire_hours)
+        self.save(table_name, airport, flights, dict(meta, refresh_time=int(time.time())))
+        return flights
+
+
+def merge_flights(snapshot, updated_flights, key_columns):
+    """
+    The flights of the snapshot with the updated flights, flights with the key of an updated flight are replaced.
+    """
+    updated_keys = set(_flight_keys(updated_flights, key_columns))
+    unchanged = np.fromiter((key not in updated_keys for key in _flight_keys(snapshot, key_columns)), dtype=bool,
+                            count=len(snapshot))
+    return ActiveFlightBatch.concat([snapshot.filter(unchanged), updated_flights])
+
+
+def evict_flights(flights, now, expire_hours=EXPIRE_HOURS):
+    """
+    Drops the flights that landed before the calculation horizon (the scheduled landing and the estimated arrival
+    more than RUNTIME_OFFSET_HOURS before the current hour, they cannot count towards a demand anymore), and the
+    flights without a message for `expire_hours`.
+    """
+    cutoff = horizon_start(now) - RUNTIME_OFFSET_HOURS * 3600
+    keep = np.ones(len(flights), dtype=bool)
+    if 'sched_landing_time' in flights and 'est_arrival_time' in flights:
+        keep &= (flights['sched_landing_time'] >= cutoff) | (flights['est_arrival_time'] >= cutoff)
+    if expire_hours is not None:
+        last_msg_time = flights['last_msg_time']
+        keep &= (last_msg_time == MISSING_TIMESTAMP) | (last_msg_time >= now.timestamp() - expire_hours * 3600)
+
+    if not keep.all():
+        logging.info(f"{len(flights) - keep.sum()} landed or expired flight(s) evicted from the snapshot.")
+        return flights.filter(keep)
+    return flights
+
+
+def _flight_keys(flights, key_columns):
+    if len(key_columns) == 1:
+        return flights[key_columns[0]]
+    return zip(*(flights[column] for column in key_columns))
+
+
+def _airport_flights(flights, airport):
+    return flights.filter(flights.isin('airport', [airport]))
+
+
+def _high_water_mark(flights, default):
+    """
+    The latest last_msg_time of the flights, `default` when none of them has one.
+    """
+    last_msg_time = flights['last_msg_time']
+    last_msg_time = last_msg_time[last_msg_time != MISSING_TIMESTAMP]
+    return int(last_msg_time.max()) if len(last_msg_time) else int(default)
@@ -0,0 +1,357 @@
+import gzip
+import heapq
+import json
+import logging
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from .dynamodb_reader import cancel_triggers, stale_etd_types, MISSING_TIMESTAMP, _decode_timestamps
+from .flight_msg_utils import CALC_HORIZON_HOURS, demand_frame, horizon_start
+
+SECONDS_PER_HOUR = 3600
+STATE_VERSION = 1
+DEFAULT_STATE_PREFIX = 'demand_state/'  # key prefix of the states in the S3 bucket
+
+
+class IncrementalDemand:
+    """
+    Hourly demand of one airport kept up to date from DynamoDB Streams change records.
+
+    The state is the per-hour demand histogram plus, for every known flight, the landing hour it contributes to.
+    INSERT/MODIFY/REMOVE records take the old contribution of the flight back (-1) and add the new one (+1), with the
+    cancel and stale rules of `drop_cancelled_flights`/`drop_stale_flights` applied to the new image. A flight that
+    has not departed becomes stale once its estimated arrival passes without any change record, those flights are
+    kept on a heap by estimated arrival and dropped when the demand is read.
+
+    The result of `demand` is the same as the hourly `calculate_demand_from_flights(clean_active_flights(flights))`
+    over the current images of the flights.
+    """
+
+    def __init__(self, airport, key_attributes):
+        """
+        Parameters
+        ----------
+        airport: str, the airport the demand is calculated for, records of other airports are ignored
+        key_attributes: list of str, the primary key attributes of the flights table
+        """
+        self.airport = airport
+        self.key_attributes = list(key_attributes)
+        self._demand_by_hour = {}  # landing hour (epoch seconds) -> number of flights
+        self._flights = {}  # flight key -> [landing hour, est. arrival time if the flight can become stale, version]
+        self._stale_heap = []  # (est. arrival time, version, flight key) of the counted flights that can become stale
+        self._version = 0
+        self.seeded_time = None  # epoch seconds of the full read the state was seeded from
+
+    @classmethod
+    def from_flights(cls, active_flights_df, airport, key_attributes, now=None):
+        """
+        Seeds the state from the active flights of the airport, e.g. the result of `query_active_flights`.
+
+        Parameters
+        ----------
+        active_flights_df: pd.DataFrame, raw active flights with the key attributes and `PIPELINE_COLUMNS`
+        airport: str
+        key_attributes: list of str
+        now: datetime, optional, the run time the stale flights are checked against
+
+        Returns
+        -------
+        IncrementalDemand
+        """
+        state = cls(airport, key_attributes)
+        state.seeded_time = _epoch_seconds(now)
+        if 'airport' in active_flights_df:
+            active_flights_df = active_flights_df.loc[active_flights_df['airport'] == airport]
+        if active_flights_df.empty:
+            return state
+
+        now = _epoch_seconds(now)
+        keys = zip(*(active_flights_df[attribute].astype(str) for attribute in state.key_attributes))
+        landing_hours = _hours(_timestamps(active_flights_df['sched_landing_time']))
+        est_arrival_times = _timestamps(active_flights_df['est_arrival_time'])
+        msg_triggers = _strings(active_flights_df['msg_trigger'])
+        etd_types = _strings(active_flights_df['est_dept_time_type'])
+
+        for key, landing_hour, est_arrival_time, msg_trigger, etd_type in zip(
+                keys, landing_hours, est_arrival_times, msg_triggers, etd_types):
+            state._add(key, landing_hour, est_arrival_time, msg_trigger, etd_type, now)
+        return state
+
+    def apply_record(self, record, now=None):
+        """
+        Applies one DynamoDB Streams record (INSERT, MODIFY or REMOVE) to the demand.
+
+        Parameters
+        ----------
+        record: dict, a stream record as delivered to Lambda, with 'eventName' and 'dynamodb' ('Keys', 'NewImage')
+        now: datetime, optional, the run time the stale flights are checked against
+        """
+        change = record['dynamodb']
+        key = tuple(str(next(iter(change['Keys'][attribute].values()))) for attribute in self.key_attributes)
+        self._remove(key)
+
+        if record['eventName'] == 'REMOVE':
+            return
+        image = change.get('NewImage')
+        if image is None:
+            raise ValueError("stream records must carry new images, set the StreamViewType to NEW_IMAGE "
+                             "or NEW_AND_OLD_IMAGES")
+        if _string(image.get('airport')) != self.airport:
+            return
+
+        landing_hour = _hours(_decode_timestamps([image.get('sched_landing_time')]))[0]
+        est_arrival_time = _decode_timestamps([image.get('est_arrival_time')])[0]
+        self._add(key, landing_hour, est_arrival_time, _string(image.get('msg_trigger')),
+                  _string(image.get('est_dept_time_type')), _epoch_seconds(now))
+
+    def apply_records(self, records, now=None):
+        """
+        Applies the stream records in order, returns the number of records applied.
+        """
+        now = now or datetime.now(timezone.utc)
+        count = 0
+        for record in records:
+            self.apply_record(record, now)
+            count += 1
+        logging.info(f"applied {count} change record(s) to the {self.airport} demand.")
+        return count
+
+    def demand(self, now=None, horizon_hours=CALC_HORIZON_HOURS):
+        """
+        Drops the flights that became stale since the last call and returns the hourly demand over the horizon.
+
+        Returns
+        -------
+        pd.DataFrame with the valid_time and demand columns, as `calculate_demand_from_flights`
+        """
+        now = now or datetime.now(timezone.utc)
+        self._expire(_epoch_seconds(now))
+
+        start = horizon_start(now)
+        counts = np.array([self._demand_by_hour.get(start + hour * SECONDS_PER_HOUR, 0)
+                           for hour in range(horizon_hours)], dtype=np.int64)
+        return demand_frame(counts, start, 60)
+
+    def to_dict(self):
+        return {'version': STATE_VERSION,
+                'airport': self.airport,
+                'key_attributes': self.key_attributes,
+                'seeded_time': self.seeded_time,
+                'flights': [[list(key), hour, est_arrival_time]
+                            for key, (hour, est_arrival_time, _) in self._flights.items()]}
+
+    @classmethod
+    def from_dict(cls, state_dict):
+        if state_dict.get('version') != STATE_VERSION:
+            raise ValueError(f"unsupported demand state version {state_dict.get('version')}")
+
+        state = cls(state_dict['airport'], state_dict['key_attributes'])
+        state.seeded_time = state_dict.get('seeded_time')
+        for key, hour, est_arrival_time in state_dict['flights']:
+            state._count(tuple(key), hour, est_arrival_time)
+        return state
+
+    def save(self, path):
+        """
+        Writes the state to a json file, the file is replaced atomically.
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as json_file:
+            json.dump(self.to_dict(), json_file)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as json_file:
+            return cls.from_dict(json.load(json_file))
+
+    def _add(self, key, landing_hour, est_arrival_time, msg_trigger, etd_type, now):
+        if msg_trigger in cancel_triggers:
+            return
+        can_become_stale = etd_type in stale_etd_types and est_arrival_time != MISSING_TIMESTAMP
+        if can_become_stale and est_arrival_time < now:
+            return
+        if landing_hour == MISSING_TIMESTAMP:
+            # flights without a scheduled landing time are not counted by calculate_demand_from_flights either
+            return
+        self._count(key, int(landing_hour), int(est_arrival_time) if can_become_stale else None)
+
+    def _count(self, key, hour, est_arrival_time):
+        self._version += 1
+        self._flights[key] = [hour, est_arrival_time, self._version]
+        self._demand_by_hour[hour] = self._demand_by_hour.get(hour, 0) + 1
+        if est_arrival_time is not None:
+            heapq.heappush(self._stale_heap, (est_arrival_time, self._version, key))
+
+    def _remove(self, key):
+        flight = self._flights.pop(key, None)
+        if flight is None:
+            return
+        hour = flight[0]
+        self._demand_by_hour[hour] -= 1
+        if not self._demand_by_hour[hour]:
+            del self._demand_by_hour[hour]
+
+    def _expire(self, now):
+        stale_flights_ct = 0
+        while self._stale_heap and self._stale_heap[0][0] < now:
+            _, version, key = heapq.heappop(self._stale_heap)
+            flight = self._flights.get(key)
+            # the heap is not updated when a flight changes, entries of older versions are skipped here
+            if flight is not None and flight[2] == version:
+                self._remove(key)
+                stale_flights_ct += 1
+        if stale_flights_ct:
+            logging.info(f"{stale_flights_ct} stale flight(s) dropped..")
+
+
+class S3StateStore:
+    """
+    The demand states of the airports, shared by all the invocations of the stream Lambda in one S3 object per
+    airport (gzipped json). Saves are conditional on the object not having changed since it was loaded, so two
+    invocations applying their records to the same state at the same time can not lose the records of one another:
+    the second save fails, and the records are applied again on the state saved by the first one.
+    """
+
+    def __init__(self, bucket, prefix=DEFAULT_STATE_PREFIX, client=None):
+        """
+        Parameters
+        ----------
+        bucket: str
+        prefix: str, key prefix of the state objects
+        client: boto3 S3 client, optional, created on first use by default
+        """
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('s3')
+        return self._client
+
+    def load(self, airport):
+        """
+        The state of the airport and the token to save it with, (None, None) when there is no state yet.
+        """
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(airport))
+        except self.client.exceptions.NoSuchKey:
+            return None, None
+        state_dict = json.loads(gzip.decompress(response['Body'].read()))
+        return IncrementalDemand.from_dict(state_dict), response['ETag']
+
+    def save(self, airport, state, token):
+        """
+        Writes the state of the airport if the stored one is still the one loaded with `token` (None: if there is
+        none). Returns False when another invocation saved the state in between.
+        """
+        condition = {'IfMatch': token} if token is not None else {'IfNoneMatch': '*'}
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=self._key(airport),
+                                   Body=gzip.compress(json.dumps(state.to_dict()).encode('utf-8')), **condition)
+        except self.client.exceptions.ClientError as error:
+            if error.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+        return True
+
+    def _key(self, airport):
+        return f"{self.prefix}{airport}.json.gz"
+
+
+class FileStateStore:
+    """
+    `S3StateStore` on the local file system, for local runs: the states of a directory are only shared by the
+    processes of one host (e.g. not by the containers of a Lambda).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def load(self, airport):
+        path = self._path(airport)
+        try:
+            token = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None, None
+        return IncrementalDemand.load(path), token
+
+    def save(self, airport, state, token):
+        path = self._path(airport)
+        current = os.stat(path).st_mtime_ns if os.path.exists(path) else None
+        if current != token:
+            return False
+        os.makedirs(self.directory, exist_ok=True)
+        state.save(path)
+        return True
+
+    def _path(self, airport):
+        return os.path.join(self.directory, f"{airport}.json")
+
+
+def replay_stream_file(path, airport, key_attributes, state=None, now=None):
+    """
+    Replays recorded DynamoDB Streams records from a file.
+
+    Parameters
+    ----------
+    path: str, either a json file holding a Lambda stream event ({"Records": [...]}) or a json-lines file with one
+        record per line
+    airport: str
+    key_attributes: list of str
+    state: IncrementalDemand, optional, the state to apply the records to, a new one is started by default
+    now: datetime, optional, the run time the stale flights are checked against
+
+    Returns
+    -------
+    IncrementalDemand
+    """
+    state = state or IncrementalDemand(airport, key_attributes)
+    with open(path, "r") as stream_file:
+        content = stream_file.read()
+
+    try:
+        records = json.loads(content)['Records']
+    except (ValueError, KeyError, TypeError):
+        records = [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    state.apply_records(records, now)
+    return state
+
+
+def _string(attribute):
+    if attribute is None or 'S' not in attribute:
+        return None
+    return attribute['S']
+
+
+def _strings(column):
+    # missing values as None, the way they are listed in stale_etd_types
+    return column.astype(object).where(column.notna(), None)
+
+
+def _epoch_seconds(now=None):
+    return int((now or datetime.now(timezone.utc)).timestamp())
+
+
+def _timestamps(column):
+    """
+    Epoch seconds of a raw or cleaned timestamp column, `MISSING_TIMESTAMP` where missing.
+    """
+    if pd.api.types.is_datetime64_any_dtype(column):
+        seconds = column.dt.tz_localize(None) if column.dt.tz is not None else column
+        return seconds.astype('datetime64[s]').to_numpy().view(np.int64)
+    if column.dtype == np.int64:
+        return column.to_numpy()
+    return _decode_timestamps([None if pd.isna(value) else {'N': str(value)} for value in column])
+
+
+def _hours(seconds):
+    hours = seconds // SECONDS_PER_HOUR * SECONDS_PER_HOUR
+    return np.where(seconds == MISSING_TIMESTAMP, MISSING_TIMESTAMP, hours)
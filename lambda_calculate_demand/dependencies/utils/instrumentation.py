@@ -0,0 +1,168 @@
+"""
+Per-stage timing and resource metrics of a demand calculation run.
+
+A run is instrumented between `start_run` and `finish_run`. Meanwhile `stage` times the stages of the run (wall time,
+calls, peak RSS of the process at the end of the stage) and takes their counters (rows in and out, DynamoDB pages,
+consumed read capacity, bytes, Influx points and requests), and `count` adds counters to a stage from the helpers of
+the pipeline, e.g. every DynamoDB page read. Stages may run on several threads, their times and counters add up.
+
+Without a running instrumentation `stage` returns a shared no-op context manager and `count` returns at once, the
+helpers can call them unconditionally.
+
+    metrics = start_run(Function='lambda_demand_calculator')
+    with stage('clean') as clean:
+        cleaned = clean_active_flights(flights, now)
+        clean.add(rows_in=len(flights), rows_out=len(cleaned))
+    finish_run()
+    print(json.dumps(metrics.emf_record()))
+
+This module does not import pandas.
+"""
+import resource
+import sys
+import threading
+import time
+
+DEFAULT_NAMESPACE = 'Aerology/Demand'
+# CloudWatch units of the counters, the other counters are sent as Count
+UNITS = {'seconds': 'Seconds', 'bytes': 'Bytes', 'peak_rss_bytes': 'Bytes'}
+_MAXIMUM_COUNTERS = {'peak_rss_bytes'}  # counters merged with max instead of summed
+
+_active = None
+
+
+class RunMetrics:
+    """
+    Times and counters of the stages of one run, keyed by stage name.
+    """
+
+    def __init__(self, **dimensions):
+        """
+        Parameters
+        ----------
+        dimensions: str values, the CloudWatch dimensions of the metrics, e.g. Function='lambda_demand_calculator'
+        """
+        self.dimensions = dimensions
+        self.started = time.time()
+        self.stages = {}  # stage name to a dict of counter name to value, in the order the stages started
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """context manager timing one call of the stage, its `add` adds counters to the stage"""
+        return _Stage(self, name)
+
+    def add(self, stage, **counters):
+        """adds the counters to the stage, `peak_rss_bytes` keeps the maximum"""
+        with self._lock:
+            totals = self.stages.setdefault(stage, {})
+            for counter, value in counters.items():
+                if counter in _MAXIMUM_COUNTERS:
+                    totals[counter] = max(totals.get(counter, 0), value)
+                else:
+                    totals[counter] = totals.get(counter, 0) + value
+
+    def emf_record(self, namespace=DEFAULT_NAMESPACE, **properties):
+        """
+        The metrics of the run as one CloudWatch Embedded Metric Format record, to be written as a single line of
+        JSON to stdout. Every counter of every stage becomes a metric named '<stage>.<counter>', the stages and the
+        `properties` are also kept as properties for Logs Insights.
+
+        Returns
+        -------
+        dict
+        """
+        metrics = {f"{stage}.{counter}": value for stage, counters in self.stages.items()
+                   for counter, value in counters.items()}
+        record = dict(properties, **self.dimensions, **metrics, stages=self.stages)
+        record['_aws'] = {
+            'Timestamp': int(self.started * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [sorted(self.dimensions)],
+                'Metrics': [{'Name': name, 'Unit': UNITS.get(name.split('.', 1)[1], 'Count')} for name in metrics],
+            }],
+        }
+        return record
+
+
+class _Stage:
+    __slots__ = ('_metrics', '_name', '_start', '_counters')
+
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+        self._counters = {}
+
+    def add(self, **counters):
+        for counter, value in counters.items():
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._metrics.add(self._name, seconds=time.perf_counter() - self._start, calls=1,
+                          peak_rss_bytes=peak_rss_bytes(), **self._counters)
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def add(self, **counters):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def start_run(**dimensions):
+    """
+    Starts instrumenting a run, returns its RunMetrics. The metrics of `stage` and `count` go to this run until
+    `finish_run`.
+    """
+    global _active
+    _active = RunMetrics(**dimensions)
+    return _active
+
+
+def finish_run():
+    """
+    Stops instrumenting, returns the RunMetrics of the run, None if no run was instrumented.
+    """
+    global _active
+    metrics, _active = _active, None
+    return metrics
+
+
+def enabled():
+    """True while a run is instrumented"""
+    return _active is not None
+
+
+def stage(name):
+    """
+    Context manager timing a stage of the instrumented run, a no-op without a run. Counters of the call are added
+    with the `add` method of the context.
+    """
+    if _active is None:
+        return _NULL_STAGE
+    return _active.stage(name)
+
+
+def count(stage_name, **counters):
+    """adds counters to a stage of the instrumented run, a no-op without a run"""
+    if _active is not None:
+        _active.add(stage_name, **counters)
+
+
+def peak_rss_bytes():
+    """peak resident set size of the process so far"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # kilobytes on Linux
@@ -0,0 +1,15 @@
+"""
+The pandas functions of the demand calculation, under the same names as `array_backend`.
+"""
+from .dynamodb_reader import PIPELINE_COLUMNS
+from .dynamodb_utils import query_active_flights, iter_active_flight_pages, query_active_flights_by_airport, \
+    clean_active_flights
+from .flight_msg_utils import calculate_demand_from_flights, calculate_demands_from_flights, \
+    calculate_demand_from_flight_pages, calculate_demand_by_airport_from_flight_pages
+
+
+def from_flight_batch(flights):
+    """
+    The frame of an ActiveFlightBatch, as read by `query_active_flights`.
+    """
+    return flights.to_pandas()
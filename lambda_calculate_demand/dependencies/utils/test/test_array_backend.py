@@ -0,0 +1,116 @@
+import os
+import subprocess
+import sys
+
+import boto3
+import numpy as np
+import pandas as pd
+import pytest
+
+from dependencies.utils import array_backend, pandas_backend
+from dependencies.utils.dynamodb_reader import decode_flight_items, PIPELINE_COLUMNS, DYNAMODB_REGION, \
+    _describe_table, get_dynamodb_client
+from dependencies.utils.dynamodb_utils import _to_frame_columns
+
+NOW = pd.Timestamp('2023-03-24 21:30', tz='UTC')
+
+
+def _items(n_flights, seed=0):
+    rng = np.random.default_rng(seed)
+    now = int(NOW.timestamp())
+    items = []
+    for i in range(n_flights):
+        sched_landing_time = now + int(rng.integers(-3 * 3600, 22 * 3600))
+        item = {'flight_id': {'S': f"FL{i}"},
+                'airport': {'S': ['EWR', 'JFK'][i % 2]},
+                'msg_trigger': {'S': str(rng.choice(['HCS_TRACK_MSG', 'FD_FLIGHT_CANCEL_MSG', 'TMI_UPDATE']))},
+                'est_dept_time_type': {'S': str(rng.choice(['ACTUAL', 'SCHEDULED', 'PROPOSED']))},
+                'sched_landing_time': {'N': str(sched_landing_time)},
+                'est_arrival_time': {'N': str(sched_landing_time + int(rng.integers(-1200, 5400)))}}
+        if i % 17 == 0:
+            del item['est_dept_time_type']
+        if i % 23 == 0:
+            item['sched_landing_time'] = {'NULL': True}
+        items.append(item)
+    return items
+
+
+def _pandas_demand(decoded, bin_minutes=60):
+    frame = pd.DataFrame(_to_frame_columns(decoded), copy=False)
+    return pandas_backend.calculate_demand_from_flights(pandas_backend.clean_active_flights(frame, NOW), NOW,
+                                                        bin_minutes=bin_minutes)
+
+
+def _assert_same_demand(array_demand, pandas_demand):
+    assert np.array_equal(array_demand['valid_time'],
+                          pandas_demand.valid_time.to_numpy(dtype='datetime64[s]').view(np.int64))
+    assert np.array_equal(array_demand['demand'], pandas_demand.demand.to_numpy())
+
+
+@pytest.mark.parametrize('bin_minutes', [15, 30, 60])
+def test_array_demand_matches_pandas(bin_minutes):
+    decoded = decode_flight_items(_items(3000), PIPELINE_COLUMNS)
+
+    array_demand = array_backend.calculate_demand_from_flights(array_backend.clean_active_flights(decoded, NOW), NOW,
+                                                               bin_minutes=bin_minutes)
+
+    _assert_same_demand(array_demand, _pandas_demand(decoded, bin_minutes))
+    assert array_demand['demand'].sum() > 0
+
+
+def test_array_demand_from_pages_matches_pandas():
+    items = _items(1000)
+    pages = (decode_flight_items(items[start:start + 97], PIPELINE_COLUMNS) for start in range(0, len(items), 97))
+
+    array_demand = array_backend.calculate_demand_from_flight_pages(
+        (array_backend.clean_active_flights(page, NOW) for page in pages), NOW)
+
+    _assert_same_demand(array_demand, _pandas_demand(decode_flight_items(items, PIPELINE_COLUMNS)))
+
+
+def test_array_demand_writes_same_lines():
+    from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+    decoded = decode_flight_items(_items(500), PIPELINE_COLUMNS)
+
+    array_demand = array_backend.calculate_demand_from_flights(array_backend.clean_active_flights(decoded, NOW), NOW)
+
+    assert InfluxDBHandler._demand_lines(array_demand, 'EWR') == \
+           InfluxDBHandler._demand_lines(_pandas_demand(decoded), 'EWR')
+
+
+def test_array_backend_does_not_import_pandas():
+    code = "import sys, dependencies.utils.array_backend; print('pandas' in sys.modules)"
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__)))))
+    assert result.stdout.strip() == 'False'
+
+
+def test_array_query_by_airport_matches_pandas():
+    moto = pytest.importorskip('moto')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        client = boto3.client('dynamodb', region_name=DYNAMODB_REGION)
+        client.create_table(TableName='ActiveFlightsTest',
+                            KeySchema=[{'AttributeName': 'flight_id', 'KeyType': 'HASH'}],
+                            AttributeDefinitions=[{'AttributeName': 'flight_id', 'AttributeType': 'S'}],
+                            BillingMode='PAY_PER_REQUEST')
+        for item in _items(200):
+            client.put_item(TableName='ActiveFlightsTest', Item=item)
+        try:
+            array_flights = array_backend.query_active_flights_by_airport('ActiveFlightsTest', ['EWR', 'LGA'],
+                                                                          columns=PIPELINE_COLUMNS)
+            pandas_flights = pandas_backend.query_active_flights_by_airport('ActiveFlightsTest', ['EWR', 'LGA'],
+                                                                            columns=PIPELINE_COLUMNS)
+        finally:
+            _describe_table.cache_clear()
+            get_dynamodb_client.cache_clear()
+
+    assert len(array_flights['EWR']) == len(pandas_flights['EWR']) == 100
+    assert len(array_flights['LGA']) == len(pandas_flights['LGA']) == 0
+    for airport in ['EWR', 'LGA']:
+        array_demand = array_backend.calculate_demand_from_flights(
+            array_backend.clean_active_flights(array_flights[airport], NOW), NOW)
+        pandas_demand = pandas_backend.calculate_demand_from_flights(
+            pandas_backend.clean_active_flights(pandas_flights[airport], NOW), NOW)
+        _assert_same_demand(array_demand, pandas_demand)
@@ -0,0 +1,98 @@
+import json
+from datetime import timedelta
+
+import pandas as pd
+import pytest
+
+from aerology_influxdb_api.aerology_influxdb_client import InfluxDBHandler
+from aerology_influxdb_api.testing import InfluxStub
+from dependencies.utils import pandas_backend
+from dependencies.utils.demand_backfill import backfill_demand, capture_gaps, capture_index
+from dependencies.utils.dynamodb_reader import PIPELINE_COLUMNS
+from dependencies.utils.flight_batch import ActiveFlightBatch
+from dependencies.utils.flight_capture import write_flight_capture, capture_path
+
+START = pd.Timestamp('2023-03-24 18:00', tz='UTC').to_pydatetime()
+AIRPORTS = [{"short_name": name, "influx_bucket": "aerology.test", "lane_names": []} for name in ['EWR', 'JFK']]
+
+
+def _items(now, n_flights=40):
+    now = int(now.timestamp())
+    return [{'flight_id': {'S': f"FL{i}"},
+             'airport': {'S': ['EWR', 'JFK'][i % 2]},
+             'msg_trigger': {'S': ['HCS_TRACK_MSG', 'FD_FLIGHT_CANCEL_MSG'][i % 7 == 0]},
+             'est_dept_time_type': {'S': ['ACTUAL', 'PROPOSED'][i % 3 == 0]},
+             'sched_landing_time': {'N': str(now + (i - 5) * 1200)},
+             'est_arrival_time': {'N': str(now + (i - 6) * 1200)}}
+            for i in range(n_flights)]
+
+
+@pytest.fixture
+def captures(tmp_path):
+    """captures of the runs at 18:00, 19:00 and 21:00 (none at 20:00), shortly after the hour"""
+    directory = str(tmp_path / 'captures')
+    for hour in [0, 1, 3]:
+        run_time = START + timedelta(hours=hour, minutes=1)
+        flights = ActiveFlightBatch.from_items(_items(run_time, 40 + hour), PIPELINE_COLUMNS + ['flight_id'])
+        write_flight_capture(flights, capture_path(directory, 'ActiveFlightsTest', run_time), 'ActiveFlightsTest',
+                             ['EWR', 'JFK'], run_time)
+    return directory
+
+
+def _lines(stub):
+    return [request['body'].decode('utf-8').split('\n') for request in stub.requests]
+
+
+def test_capture_gaps(captures):
+    index = capture_index(captures)
+
+    assert [capture[0] for capture in index] == [START + timedelta(hours=hour, minutes=1) for hour in [0, 1, 3]]
+    # no capture of the 20:00 run
+    assert capture_gaps(index, START, START + timedelta(hours=4)) == [
+        (START + timedelta(hours=1, minutes=1), START + timedelta(hours=3, minutes=1))]
+    assert capture_gaps([], START, START + timedelta(hours=1)) == []
+
+
+def test_backfill_in_order_and_resume(captures, tmp_path):
+    start, end = START, START + timedelta(hours=4)
+    checkpoint = str(tmp_path / 'backfill.json')
+
+    def interrupt(done, total, run_time):
+        if done == 2:
+            raise KeyboardInterrupt
+
+    with InfluxStub() as stub:
+        handler = InfluxDBHandler(stub.write_config(tmp_path / 'config.json', airports=AIRPORTS,
+                                                    demand_airport_tag=True))
+        with pytest.raises(KeyboardInterrupt):
+            backfill_demand(handler, ['EWR', 'JFK', 'LGA'], start, end, captures, max_workers=2,
+                            checkpoint_path=checkpoint, progress=interrupt)
+        summary = backfill_demand(handler, ['EWR', 'JFK', 'LGA'], start, end, captures, max_workers=2,
+                                  checkpoint_path=checkpoint)
+        # the checkpoint is of another backfill: other airports, or another end
+        with pytest.raises(ValueError):
+            backfill_demand(handler, ['EWR'], start, end, captures, checkpoint_path=checkpoint)
+        with pytest.raises(ValueError):
+            backfill_demand(handler, ['EWR', 'JFK', 'LGA'], start, end + timedelta(hours=1), captures,
+                            checkpoint_path=checkpoint)
+        handler.close()
+
+    # the runs of 18:01, 19:01 and 21:01 are backfilled at their run times, the 20:00 one was not captured
+    assert (summary['written'], summary['resumed'], summary['gaps']) == (1, 2, 1)
+    assert json.load(open(checkpoint))['written'] == [(START + timedelta(hours=hour, minutes=1)).isoformat()
+                                                      for hour in [0, 1, 3]]
+
+    # one write per run, in order, with the demand the run calculated
+    assert len(stub.requests) == 3
+    for lines, hour in zip(_lines(stub), [0, 1, 3]):
+        run_time = START + timedelta(hours=hour, minutes=1)
+        flights = pandas_backend.from_flight_batch(ActiveFlightBatch.from_items(
+            _items(run_time, 40 + hour), PIPELINE_COLUMNS + ['flight_id']))
+        expected = []
+        for airport in ['EWR', 'JFK']:
+            airport_flights = flights[flights['airport'] == airport]
+            demand = pandas_backend.calculate_demand_from_flights(
+                pandas_backend.clean_active_flights(airport_flights, run_time), run_time)
+            expected += [f"demand,airport={airport} demand={count}i {int(valid_time.timestamp())}"
+                         for valid_time, count in zip(demand['valid_time'], demand['demand'])]
+        assert lines == expected
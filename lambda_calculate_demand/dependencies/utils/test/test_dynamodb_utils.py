@@ -0,0 +1,212 @@
+import os
+import time
+from datetime import datetime, timezone
+
+import boto3
+import pytest
+
+import numpy as np
+import pandas as pd
+
+from dependencies.utils.dynamodb_utils import query_active_flights, iter_active_flight_pages, find_airport_index, \
+    query_active_flights_by_airport, \
+    decode_flight_items, clean_active_flights, DYNAMODB_REGION, PIPELINE_COLUMNS, MISSING_TIMESTAMP, \
+    TIMESTAMP_COLUMNS, format_time_values, drop_cancelled_flights, drop_stale_flights, cancel_triggers
+from dependencies.utils.dynamodb_reader import _describe_table, get_dynamodb_client
+from dependencies.utils.flight_msg_utils import calculate_demand_from_flights
+
+moto = pytest.importorskip('moto')
+
+TABLE_NAME = 'ActiveFlightsTest'
+
+
+def _item(flight_id, airport, est_arrival_time=1679698800, sched_landing_time=None):
+    return {'flight_id': flight_id, 'airport': airport, 'msg_trigger': 'HCS_TRACK_MSG',
+            'est_dept_time_type': 'ACTUAL', 'sched_landing_time': sched_landing_time or est_arrival_time,
+            'est_arrival_time': est_arrival_time}
+
+
+@pytest.fixture
+def dynamodb():
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        yield boto3.resource('dynamodb', region_name=DYNAMODB_REGION)
+    _describe_table.cache_clear()
+    get_dynamodb_client.cache_clear()
+
+
+@pytest.fixture
+def flights_table(dynamodb):
+    table = dynamodb.create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[{'AttributeName': 'flight_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'flight_id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    with table.batch_writer() as batch:
+        for i in range(300):
+            batch.put_item(Item=_item(f"FL{i:04d}", 'EWR' if i % 3 else 'JFK'))
+    return table
+
+
+@pytest.mark.parametrize('total_segments', [1, 4, 16])
+def test_query_active_flights_segments(flights_table, total_segments):
+    flights = query_active_flights(TABLE_NAME, 'EWR', total_segments=total_segments)
+
+    assert len(flights) == 200
+    assert set(flights.airport) == {'EWR'}
+    assert flights.flight_id.is_unique
+
+
+def test_query_active_flights_no_match(flights_table):
+    flights = query_active_flights(TABLE_NAME, 'LGA', total_segments=4)
+
+    assert flights.empty
+
+
+@pytest.mark.parametrize('table_fixture', ['flights_table', 'indexed_flights_table'])
+def test_query_active_flights_by_airport(request, table_fixture):
+    request.getfixturevalue(table_fixture)
+
+    flights_by_airport = query_active_flights_by_airport(TABLE_NAME, ['EWR', 'JFK', 'LGA'], total_segments=4,
+                                                         columns=PIPELINE_COLUMNS[:-1])
+
+    assert {airport: len(flights) for airport, flights in flights_by_airport.items()} == \
+           {'EWR': 200, 'JFK': 100, 'LGA': 0}
+    assert set(flights_by_airport['JFK'].airport) == {'JFK'}
+
+
+def test_query_active_flights_projection(flights_table):
+    flights = query_active_flights(TABLE_NAME, 'EWR', total_segments=4, columns=PIPELINE_COLUMNS)
+
+    assert list(flights.columns) == PIPELINE_COLUMNS
+    assert flights.sched_landing_time.dtype == np.int64
+    assert isinstance(flights.msg_trigger.dtype, pd.CategoricalDtype)
+    # attributes missing from the items are read as missing timestamps
+    assert (flights.last_msg_time == MISSING_TIMESTAMP).all()
+    assert len(clean_active_flights(flights)) == 200
+
+
+@pytest.mark.parametrize('total_segments', [1, 4])
+def test_iter_active_flight_pages(flights_table, total_segments):
+    pages = list(iter_active_flight_pages(TABLE_NAME, 'EWR', total_segments=total_segments,
+                                          columns=PIPELINE_COLUMNS))
+
+    assert len(pages) >= total_segments
+    assert sum(len(page) for page in pages) == 200
+    assert all(list(page.columns) == PIPELINE_COLUMNS for page in pages)
+
+
+def test_iter_active_flight_pages_stop_early(flights_table):
+    pages = iter_active_flight_pages(TABLE_NAME, 'EWR', total_segments=16)
+    next(pages)
+    # closing the generator must release the segment readers
+    pages.close()
+
+
+def test_decode_flight_items():
+    items = [{'flight_id': {'S': 'FL1'}, 'est_arrival_time': {'N': '1679698800'}, 'airport': {'S': 'EWR'}},
+             {'flight_id': {'S': 'FL2'}, 'est_arrival_time': {'S': '1679702400'}, 'airport': {'S': 'JFK'}},
+             {'flight_id': {'S': 'FL3'}, 'est_arrival_time': {'S': 'n/a'}, 'airport': {'NULL': True}}]
+
+    decoded = decode_flight_items(items)
+    codes, categories = decoded['airport']
+
+    assert decoded['flight_id'].tolist() == ['FL1', 'FL2', 'FL3']
+    assert decoded['est_arrival_time'].tolist() == [1679698800, 1679702400, MISSING_TIMESTAMP]
+    assert codes.tolist() == [0, 1, -1]
+    assert categories.tolist() == ['EWR', 'JFK']
+
+
+@pytest.fixture
+def indexed_flights_table(dynamodb):
+    table = dynamodb.create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[{'AttributeName': 'flight_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'flight_id', 'AttributeType': 'S'},
+                              {'AttributeName': 'airport', 'AttributeType': 'S'},
+                              {'AttributeName': 'est_arrival_time', 'AttributeType': 'N'}],
+        GlobalSecondaryIndexes=[{
+            'IndexName': 'airport-est_arrival_time-index',
+            'KeySchema': [{'AttributeName': 'airport', 'KeyType': 'HASH'},
+                          {'AttributeName': 'est_arrival_time', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'ALL'},
+        }],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    now = int(time.time())
+    with table.batch_writer() as batch:
+        for i in range(300):
+            # scheduled within the calculation horizon, one in five flights is estimated two days later and one in
+            # seven three hours earlier
+            sched_landing_time = now + (i % 20) * 3600
+            est_arrival_time = sched_landing_time + (48 * 3600 if i % 5 == 0 else -3 * 3600 if i % 7 == 0 else 600)
+            batch.put_item(Item=_item(f"FL{i:04d}", 'EWR' if i % 3 else 'JFK', est_arrival_time, sched_landing_time))
+    return table
+
+
+def test_find_airport_index(indexed_flights_table):
+    airport_index = find_airport_index(TABLE_NAME)
+
+    assert airport_index == {'IndexName': 'airport-est_arrival_time-index',
+                             'SortKey': 'est_arrival_time',
+                             'SortKeyType': 'N'}
+    assert find_airport_index(TABLE_NAME, 'missing-index') is None
+
+
+def test_find_airport_index_without_index(flights_table):
+    assert find_airport_index(TABLE_NAME) is None
+
+
+def test_query_active_flights_index(indexed_flights_table):
+    flights = query_active_flights(TABLE_NAME, 'EWR')
+
+    # the whole airport partition, whatever the estimated arrival times
+    assert len(flights) == 200
+    assert set(flights.airport) == {'EWR'}
+
+
+def test_index_and_scan_same_demand(indexed_flights_table):
+    now = datetime.now(timezone.utc)
+    index_flights = query_active_flights(TABLE_NAME, 'EWR', columns=PIPELINE_COLUMNS)
+    scan_flights = query_active_flights(TABLE_NAME, 'EWR', index_name='missing-index', columns=PIPELINE_COLUMNS)
+
+    index_demand = calculate_demand_from_flights(clean_active_flights(index_flights, now), now)
+    scan_demand = calculate_demand_from_flights(clean_active_flights(scan_flights, now), now)
+    assert index_demand['demand'].sum() == 200
+    pd.testing.assert_frame_equal(index_demand, scan_demand)
+
+
+def _legacy_clean(active_flights_df, now):
+    active_flights_df = format_time_values(active_flights_df.copy())
+    return drop_stale_flights(drop_cancelled_flights(active_flights_df, cancel_triggers), now)
+
+
+@pytest.mark.parametrize('decoded', [True, False])
+def test_clean_active_flights_matches_legacy(decoded):
+    rng = np.random.default_rng(0)
+    n_flights = 1000
+    now = pd.Timestamp('2023-03-24 21:30', tz='UTC')
+    est_arrival_time = int(now.timestamp()) + rng.integers(-3 * 3600, 20 * 3600, n_flights)
+    est_arrival_time[::50] = MISSING_TIMESTAMP
+    flights = pd.DataFrame({column: est_arrival_time for column in TIMESTAMP_COLUMNS})
+    flights['msg_trigger'] = rng.choice(['HCS_TRACK_MSG', 'FD_FLIGHT_CANCEL_MSG', 'TMI_UPDATE', None], n_flights)
+    flights['est_dept_time_type'] = rng.choice(['ACTUAL', 'SCHEDULED', 'PROPOSED', None], n_flights)
+    if decoded:
+        flights = flights.astype({column: 'category' for column in ['msg_trigger', 'est_dept_time_type']})
+    else:
+        # table resource items: numbers as strings, missing as None
+        flights[TIMESTAMP_COLUMNS] = flights[TIMESTAMP_COLUMNS].astype(str).replace(str(MISSING_TIMESTAMP), None)
+    original = flights.copy()
+
+    cleaned = clean_active_flights(flights, now, ordered=True)
+
+    # ties of the arrival time can be sorted either way
+    expected = _legacy_clean(flights, now).sort_index()
+    assert cleaned.est_arrival_time.dropna().is_monotonic_increasing
+    assert cleaned.sort_index().index.tolist() == expected.index.tolist()
+    for column in TIMESTAMP_COLUMNS:
+        assert cleaned.sort_index()[column].tolist() == expected[column].tolist()
+    pd.testing.assert_frame_equal(flights, original)
+    assert set(clean_active_flights(flights, now).index) == set(cleaned.index)
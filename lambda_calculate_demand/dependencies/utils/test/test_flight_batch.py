@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from dependencies.utils.dynamodb_reader import PIPELINE_COLUMNS, MISSING_TIMESTAMP, stale_etd_types, \
+    decode_flight_items
+from dependencies.utils.dynamodb_utils import clean_active_flights, _to_frame_columns
+from dependencies.utils.flight_batch import ActiveFlightBatch
+from dependencies.utils.flight_msg_utils import calculate_demands_from_flights, calculate_demand_from_flight_pages
+
+NOW = pd.Timestamp('2023-03-24 21:30', tz='UTC')
+
+
+def _items():
+    now = int(NOW.timestamp())
+    items = []
+    for i in range(12):
+        items.append({'flight_id': {'S': f"FL{i}"},
+                      'airport': {'S': ['EWR', 'JFK', 'LGA'][i % 3]},
+                      'msg_trigger': {'S': ['HCS_TRACK_MSG', 'FD_FLIGHT_CANCEL_MSG'][i % 5 == 0]},
+                      'est_dept_time_type': {'S': ['ACTUAL', 'SCHEDULED'][i % 2]},
+                      'sched_landing_time': {'N': str(now + (i - 2) * 1800)},
+                      'est_arrival_time': {'N': str(now + (i - 3) * 1800)}})
+    del items[4]['est_dept_time_type']
+    items[7]['est_arrival_time'] = {'NULL': True}
+    return items
+
+
+@pytest.fixture
+def batch():
+    return ActiveFlightBatch.from_items(_items(), PIPELINE_COLUMNS)
+
+
+def test_batch_columns(batch):
+    assert len(batch) == 12
+    assert batch['est_arrival_time'].dtype == np.int64
+    assert batch['est_arrival_time'][7] == MISSING_TIMESTAMP
+    codes, categories = batch['est_dept_time_type']
+    assert codes.dtype == np.int32 and codes[4] == -1
+    assert list(categories) == ['ACTUAL', 'SCHEDULED']
+    assert batch.nbytes < 12 * len(PIPELINE_COLUMNS) * 8
+
+
+def test_batch_views(batch):
+    head = batch[2:6]
+    assert len(head) == 4
+    assert np.shares_memory(head['sched_landing_time'], batch['sched_landing_time'])
+
+    departed = batch.filter(~batch.isin('est_dept_time_type', stale_etd_types))
+    assert len(departed) == 5  # odd flights are SCHEDULED, flight 4 has no departure time type
+    assert departed['est_dept_time_type'][1] is batch['est_dept_time_type'][1]  # shared categories
+
+    ordered = batch.filter(np.argsort(batch['sched_landing_time'])[::-1])
+    assert np.all(np.diff(ordered['sched_landing_time']) < 0)
+
+
+def test_batch_to_pandas_and_numpy(batch):
+    frame = batch.to_pandas()
+    expected = pd.DataFrame(_to_frame_columns(decode_flight_items(_items(), PIPELINE_COLUMNS)))
+    pd.testing.assert_frame_equal(frame, expected)
+    assert np.shares_memory(frame['est_arrival_time'].to_numpy(), batch['est_arrival_time'])
+
+    arrays = batch.to_numpy()
+    assert arrays['est_arrival_time'].dtype == 'datetime64[s]'
+    assert np.isnat(arrays['est_arrival_time'][7])
+    assert np.shares_memory(arrays['est_arrival_time'], batch['est_arrival_time'])
+
+
+def test_batch_from_frame_roundtrip(batch):
+    frame = batch.to_pandas()
+    frame['airport'] = frame['airport'].astype(str)  # categorical columns read as strings are encoded
+
+    roundtrip = ActiveFlightBatch.from_frame(frame)
+    pd.testing.assert_frame_equal(roundtrip.to_pandas(), batch.to_pandas())
+
+
+def test_batch_concat_merges_categories(batch):
+    first = ActiveFlightBatch.from_items(_items()[:3], PIPELINE_COLUMNS)
+    second = ActiveFlightBatch.from_items(_items()[3:], PIPELINE_COLUMNS)
+    assert list(first['est_dept_time_type'][1]) != list(second['est_dept_time_type'][1])
+
+    concatenated = ActiveFlightBatch.concat([first, second])
+    pd.testing.assert_frame_equal(concatenated.to_pandas().astype({'airport': str, 'msg_trigger': str,
+                                                                   'est_dept_time_type': object}),
+                                  batch.to_pandas().astype({'airport': str, 'msg_trigger': str,
+                                                            'est_dept_time_type': object}))
+
+
+def test_batch_cleaning_and_demand_match_frame(batch):
+    frame = batch.to_pandas()
+
+    cleaned_batch = clean_active_flights(batch, NOW, ordered=True)
+    cleaned_frame = clean_active_flights(frame, NOW, ordered=True)
+
+    assert isinstance(cleaned_batch, ActiveFlightBatch)
+    assert np.array_equal(cleaned_batch['est_arrival_time'],
+                          cleaned_frame.est_arrival_time.to_numpy(dtype='datetime64[s]').view(np.int64))
+    for width, demand in calculate_demands_from_flights(cleaned_batch, NOW).items():
+        pd.testing.assert_frame_equal(demand, calculate_demands_from_flights(cleaned_frame, NOW)[width])
+
+    pages = [clean_active_flights(batch[start:start + 5], NOW) for start in range(0, len(batch), 5)]
+    pd.testing.assert_frame_equal(calculate_demand_from_flight_pages(pages, NOW),
+                                  calculate_demands_from_flights(cleaned_frame, NOW)[60])
+
+
+def test_batch_columns_must_have_same_length():
+    with pytest.raises(ValueError):
+        ActiveFlightBatch({'est_arrival_time': np.zeros(3, dtype=np.int64),
+                           'airport': (np.zeros(2, dtype=np.int32), np.array(['EWR'], dtype=object))})
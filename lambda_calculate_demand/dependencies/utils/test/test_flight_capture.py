@@ -0,0 +1,109 @@
+import os
+
+import boto3
+import numpy as np
+import pandas as pd
+import pytest
+
+from dependencies.utils import array_backend, pandas_backend
+from dependencies.utils.dynamodb_reader import DYNAMODB_REGION, PIPELINE_COLUMNS, _describe_table, get_dynamodb_client
+from dependencies.utils.flight_batch import ActiveFlightBatch
+from dependencies.utils.flight_capture import write_flight_capture, read_flight_capture, replay_flight_capture, \
+    iter_flight_captures, capture_path
+
+NOW = pd.Timestamp('2023-03-24 21:30', tz='UTC')
+
+
+def _items(n_flights=40):
+    now = int(NOW.timestamp())
+    return [{'flight_id': {'S': f"FL{i}"},
+             'airport': {'S': ['EWR', 'JFK'][i % 2]},
+             'msg_trigger': {'S': ['HCS_TRACK_MSG', 'FD_FLIGHT_CANCEL_MSG'][i % 7 == 0]},
+             'est_dept_time_type': {'S': ['ACTUAL', 'PROPOSED'][i % 3 == 0]},
+             'sched_landing_time': {'N': str(now + (i - 5) * 1200)},
+             'est_arrival_time': {'N': str(now + (i - 6) * 1200)}}
+            for i in range(n_flights)]
+
+
+@pytest.fixture
+def flights():
+    return ActiveFlightBatch.from_items(_items(), PIPELINE_COLUMNS + ['flight_id'])
+
+
+def test_capture_roundtrip(flights, tmp_path):
+    path = str(tmp_path / 'capture')
+    write_flight_capture(flights, path, 'ActiveFlightsTest', ['EWR', 'JFK'], NOW)
+
+    captured, meta = read_flight_capture(path)
+
+    pd.testing.assert_frame_equal(captured.to_pandas(), flights.to_pandas())
+    assert meta['run_time'] == NOW and meta['airports'] == ['EWR', 'JFK'] and meta['flights'] == 40
+    assert not captured['est_arrival_time'].flags.writeable  # memory mapped read-only
+    assert read_flight_capture(path, mmap=False)[0]['est_arrival_time'].flags.writeable
+
+
+def test_capture_replaces_existing(flights, tmp_path):
+    path = str(tmp_path / 'capture')
+    write_flight_capture(flights, path)
+    write_flight_capture(flights[:3], path)
+
+    assert len(read_flight_capture(path)[0]) == 3
+    assert os.listdir(tmp_path) == ['capture']
+
+
+@pytest.mark.parametrize('backend', [array_backend, pandas_backend])
+def test_replay_matches_run(flights, tmp_path, backend):
+    path = str(tmp_path / 'capture')
+    write_flight_capture(flights, path, 'ActiveFlightsTest', ['EWR', 'JFK'], NOW)
+
+    demands = replay_flight_capture(path, backend, bin_minutes=30)
+
+    for airport in ['EWR', 'JFK']:
+        airport_flights = backend.from_flight_batch(flights.filter(flights.isin('airport', [airport])))
+        expected = backend.calculate_demand_from_flights(backend.clean_active_flights(airport_flights, NOW), NOW,
+                                                         bin_minutes=30)
+        assert np.array_equal(demands[airport]['demand'], expected['demand'])
+        assert np.array_equal(demands[airport]['valid_time'], expected['valid_time'])
+
+
+def test_iter_captures(flights, tmp_path):
+    paths = [capture_path(str(tmp_path), 'ActiveFlightsTest', NOW + pd.Timedelta(hours=hours)) for hours in [2, 0, 1]]
+    for path in paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_flight_capture(flights, path)
+    os.makedirs(paths[0] + '.tmp-1')
+
+    assert list(iter_flight_captures(str(tmp_path))) == sorted(paths)
+    assert paths[1].endswith(os.path.join('ActiveFlightsTest', '20230324T213000'))
+
+
+@pytest.mark.parametrize('backend', [array_backend, pandas_backend])
+def test_query_writes_capture(tmp_path, backend):
+    moto = pytest.importorskip('moto')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    path = str(tmp_path / 'capture')
+    with moto.mock_aws():
+        client = boto3.client('dynamodb', region_name=DYNAMODB_REGION)
+        client.create_table(TableName='ActiveFlightsTest',
+                            KeySchema=[{'AttributeName': 'flight_id', 'KeyType': 'HASH'}],
+                            AttributeDefinitions=[{'AttributeName': 'flight_id', 'AttributeType': 'S'}],
+                            BillingMode='PAY_PER_REQUEST')
+        for item in _items():
+            client.put_item(TableName='ActiveFlightsTest', Item=item)
+        try:
+            flights_by_airport = backend.query_active_flights_by_airport('ActiveFlightsTest', ['EWR', 'JFK'],
+                                                                         columns=PIPELINE_COLUMNS, capture_path=path,
+                                                                         run_time=NOW.to_pydatetime())
+        finally:
+            _describe_table.cache_clear()
+            get_dynamodb_client.cache_clear()
+
+    captured, meta = read_flight_capture(path)
+    assert len(captured) == 40 and meta['table_name'] == 'ActiveFlightsTest'
+    assert meta['run_time'] == NOW  # the run time of the Lambda, not the time of the read
+    demands = replay_flight_capture(path, backend)
+    for airport, flights in flights_by_airport.items():
+        expected = backend.calculate_demand_from_flights(backend.clean_active_flights(flights, meta['run_time']),
+                                                         meta['run_time'])
+        assert np.array_equal(demands[airport]['demand'], expected['demand'])
@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from dependencies.utils.dynamodb_utils import clean_active_flights
+from dependencies.utils import flight_msg_utils
+from dependencies.utils.flight_batch import ActiveFlightBatch
+from dependencies.utils.flight_msg_utils import calculate_demand_from_flights, calculate_demand_from_flight_pages, \
+    calculate_demands_from_flights, calculate_demand_cube, CALC_HORIZON_HOURS, MISSING_DIMENSION
+
+
+def _active_flights(n_flights, seed=0):
+    rng = np.random.default_rng(seed)
+    now = int(pd.Timestamp.now(tz='UTC').timestamp())
+    sched_landing_time = now + rng.integers(-2 * 3600, 24 * 3600, n_flights)
+    est_arrival_time = sched_landing_time + rng.integers(-1200, 5400, n_flights)
+    return pd.DataFrame({
+        'sched_dept_time': sched_landing_time - 7200,
+        'est_dept_time': est_arrival_time - 7200,
+        'sched_landing_time': sched_landing_time,
+        'last_msg_time': np.full(n_flights, now),
+        'flight_creation_time': np.full(n_flights, now - 86400),
+        'est_arrival_time': est_arrival_time,
+        'msg_trigger': rng.choice(['HCS_TRACK_MSG', 'FD_FLIGHT_CANCEL_MSG', 'TMI_UPDATE'], n_flights),
+        'est_dept_time_type': rng.choice(['ACTUAL', 'SCHEDULED', 'PROPOSED', None], n_flights),
+        'airport': 'EWR',
+    })
+
+
+@pytest.mark.parametrize('page_size', [1, 97, 5000])
+def test_streaming_demand_matches_batch(page_size):
+    active_flights = _active_flights(2000)
+    now = pd.Timestamp.now(tz='UTC')
+    pages = (active_flights.iloc[start:start + page_size].copy()
+             for start in range(0, len(active_flights), page_size))
+
+    streamed = calculate_demand_from_flight_pages((clean_active_flights(page, now) for page in pages), now)
+    batch = calculate_demand_from_flights(clean_active_flights(active_flights.copy(), now), now)
+
+    pd.testing.assert_frame_equal(streamed, batch, check_dtype=False)
+
+
+def test_streaming_demand_no_pages():
+    demand = calculate_demand_from_flight_pages([])
+
+    assert list(demand.columns) == ['valid_time', 'demand']
+    assert len(demand) == CALC_HORIZON_HOURS
+    assert not demand.demand.any()
+
+
+def test_demand_matches_groupby():
+    now = pd.Timestamp('2023-03-24 21:30', tz='UTC')
+    active_flights = pd.DataFrame({'sched_landing_time': now + pd.to_timedelta(np.arange(2000) * 61 - 7200, unit='s')})
+    original = active_flights.copy()
+
+    demands = calculate_demands_from_flights(active_flights, now)
+
+    pd.testing.assert_frame_equal(active_flights, original)
+    for bin_minutes, demand in demands.items():
+        pd.testing.assert_frame_equal(demand, calculate_demand_from_flights(active_flights, now,
+                                                                            bin_minutes=bin_minutes))
+        assert len(demand) == CALC_HORIZON_HOURS * 60 // bin_minutes
+        assert demand.valid_time.iloc[0] == pd.Timestamp('2023-03-24 21:00', tz='UTC')
+
+        in_horizon = active_flights.sched_landing_time[
+            (active_flights.sched_landing_time >= demand.valid_time.iloc[0]) &
+            (active_flights.sched_landing_time < now.floor('h') + pd.Timedelta(hours=CALC_HORIZON_HOURS))]
+        expected = in_horizon.dt.floor(f'{bin_minutes}min').value_counts()
+        counted = demand.set_index('valid_time').demand
+        assert counted[expected.index].tolist() == expected.tolist()
+        assert counted.sum() == len(in_horizon)
+
+
+def test_demand_bins_must_divide_horizon():
+    with pytest.raises(ValueError):
+        calculate_demand_from_flights(_active_flights(10), bin_minutes=45, horizon_hours=1)
+
+
+def test_demand_cube_matches_groupby(monkeypatch):
+    now = pd.Timestamp('2023-03-24 21:30', tz='UTC')
+    rng = np.random.default_rng(1)
+    active_flights = _active_flights(3000).assign(origin=rng.choice(['ORD', 'ATL', 'BOS', None], 3000),
+                                                  carrier=rng.choice(['UAL', 'DAL', 'JBU'], 3000))
+    for column in ['sched_landing_time', 'est_arrival_time']:
+        active_flights[column] = int(now.timestamp()) + rng.integers(-2 * 3600, 24 * 3600, 3000)
+    breakdowns = [(), ('origin',), ('carrier', 'est_dept_time_type')]
+
+    cube = calculate_demand_cube(active_flights, breakdowns, now)
+
+    assert list(cube.columns) == ['valid_time', 'demand', 'landing_time', 'origin', 'carrier', 'est_dept_time_type']
+    total = cube[cube.origin.isna() & cube.carrier.isna() & (cube.landing_time == 'scheduled')]
+    demand = calculate_demand_from_flights(active_flights, now)
+    assert total.demand.tolist() == demand.demand.tolist()
+
+    horizon = (now.floor('h'), now.floor('h') + pd.Timedelta(hours=CALC_HORIZON_HOURS))
+    for landing_time, column in [('scheduled', 'sched_landing_time'), ('estimated', 'est_arrival_time')]:
+        times = pd.to_datetime(active_flights[column], unit='s', utc=True)
+        flights = active_flights.assign(valid_time=times.dt.floor('h'))[(times >= horizon[0]) & (times < horizon[1])]
+        flights = flights.fillna({'origin': MISSING_DIMENSION, 'est_dept_time_type': MISSING_DIMENSION})
+        for breakdown in breakdowns[1:]:
+            expected = flights.groupby(['valid_time', *breakdown]).size()
+            rows = cube[(cube.landing_time == landing_time) & cube[breakdown[0]].notna()]
+            counted = rows.set_index(['valid_time', *breakdown]).demand
+            counted = counted[counted > 0]
+            assert counted.sort_index().to_dict() == expected.sort_index().to_dict()
+
+    batch_cube = calculate_demand_cube(ActiveFlightBatch.from_frame(active_flights), breakdowns, now)
+    pd.testing.assert_frame_equal(batch_cube, cube)
+    monkeypatch.setattr(flight_msg_utils, '_MAX_DENSE_CELLS', 0)
+    pd.testing.assert_frame_equal(calculate_demand_cube(active_flights, breakdowns, now), cube)
+
+
+def test_demand_cube_dense_series():
+    now = pd.Timestamp('2023-03-24 21:30', tz='UTC')
+    start = int(now.floor('h').timestamp())
+    active_flights = pd.DataFrame({'sched_landing_time': [start + 600, start + 3 * 3600],
+                                   'est_arrival_time': [start + 700, start - 7200],
+                                   'origin': ['ORD', 'ATL']})
+
+    cube = calculate_demand_cube(active_flights, [(), ('origin',)], now)
+
+    # every series has all the bins of the horizon, the estimated total too although its only flight is before it
+    series = cube.groupby(['landing_time', cube.origin.fillna('')]).demand
+    assert series.size().to_dict() == {('estimated', ''): 20, ('estimated', 'ORD'): 20, ('scheduled', ''): 20,
+                                       ('scheduled', 'ATL'): 20, ('scheduled', 'ORD'): 20}
+    assert series.sum().to_dict() == {('estimated', ''): 1, ('estimated', 'ORD'): 1, ('scheduled', ''): 2,
+                                      ('scheduled', 'ATL'): 1, ('scheduled', 'ORD'): 1}
+    atl = cube[(cube.origin == 'ATL')]
+    assert atl.demand.tolist() == [0, 0, 0, 1] + [0] * 16
+
+    # an hour later both flights landed before the horizon: the series of the previous cube are written again with
+    # zeros
+    later = calculate_demand_cube(active_flights.iloc[:1], [(), ('origin',)], now + pd.Timedelta(hours=1),
+                                  previous=cube)
+    assert later[later.origin == 'ATL'].demand.tolist() == [0] * 20
+    assert later[later.origin == 'ATL'].valid_time.min() == now.floor('h') + pd.Timedelta(hours=1)
+    assert len(later) == 5 * 20 and later.demand.sum() == 0
@@ -0,0 +1,140 @@
+import os
+
+import boto3
+import numpy as np
+import pandas as pd
+import pytest
+
+from dependencies.utils.dynamodb_reader import DYNAMODB_REGION, PIPELINE_COLUMNS, _describe_table, get_dynamodb_client
+from dependencies.utils.array_backend import query_active_flights_by_airport
+from dependencies.utils.flight_msg_utils import calculate_demand_from_flights
+from dependencies.utils.flight_snapshot import FlightSnapshotCache, evict_flights
+
+moto = pytest.importorskip('moto')
+
+TABLE_NAME = 'ActiveFlightsTest'
+NOW = pd.Timestamp('2023-03-24 21:30', tz='UTC')
+
+
+def _item(flight_id, airport, landing_hours, last_msg_hours=-1.0):
+    now = int(NOW.timestamp())
+    return {'flight_id': flight_id, 'airport': airport, 'msg_trigger': 'HCS_TRACK_MSG',
+            'est_dept_time_type': 'ACTUAL', 'sched_landing_time': now + int(landing_hours * 3600),
+            'est_arrival_time': now + int(landing_hours * 3600), 'last_msg_time': now + int(last_msg_hours * 3600)}
+
+
+@pytest.fixture
+def flights_table():
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        table = boto3.resource('dynamodb', region_name=DYNAMODB_REGION).create_table(
+            TableName=TABLE_NAME,
+            KeySchema=[{'AttributeName': 'flight_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'flight_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        for i in range(20):
+            table.put_item(Item=_item(f"FL{i}", ['EWR', 'JFK'][i % 2], i - 2))
+        yield table
+    _describe_table.cache_clear()
+    get_dynamodb_client.cache_clear()
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = FlightSnapshotCache(str(tmp_path / 'snapshots'))
+    reads = []
+    read = cache._read
+
+    def recording_read(*args, **kwargs):
+        flights = read(*args, **kwargs)
+        reads.append((args[-1] if len(args) == 7 else None, len(flights)))
+        return flights
+
+    monkeypatch.setattr(cache, '_read', recording_read)
+    cache.reads = reads
+    return cache
+
+
+def _demand(flights):
+    return calculate_demand_from_flights(flights, NOW)
+
+
+def _assert_same_flights(cached, airports):
+    expected = query_active_flights_by_airport(TABLE_NAME, airports, columns=PIPELINE_COLUMNS + ['flight_id'])
+    for airport in airports:
+        assert sorted(cached[airport]['flight_id']) == sorted(evict_flights(expected[airport], NOW)['flight_id'])
+        pd.testing.assert_frame_equal(_demand(cached[airport]), _demand(expected[airport]))
+
+
+def test_snapshot_delta_refresh(flights_table, cache):
+    first = cache.query_active_flights_by_airport(TABLE_NAME, ['EWR', 'JFK'], now=NOW)
+    # FL0 landed more than an hour before the current hour
+    assert len(first['EWR']) == 9 and len(first['JFK']) == 10
+    assert os.path.exists(cache.path(TABLE_NAME, 'EWR'))
+
+    flights_table.put_item(Item=_item('FL4', 'EWR', 12, last_msg_hours=0))  # moved
+    flights_table.put_item(Item=_item('FL100', 'JFK', 3, last_msg_hours=0))  # new
+    second = cache.query_active_flights_by_airport(TABLE_NAME, ['EWR', 'JFK'], now=NOW)
+
+    updated_since = int(NOW.timestamp()) - 3600 - cache.overlap_seconds
+    # the flights of the first read are all at the high-water mark, they are read again with the two updates
+    assert cache.reads == [(None, 20), (updated_since, 21)]
+    _assert_same_flights(second, ['EWR', 'JFK'])
+
+    flights_table.put_item(Item=_item('FL6', 'JFK', 5, last_msg_hours=0.5))  # diverted
+    third = cache.query_active_flights_by_airport(TABLE_NAME, ['EWR', 'JFK'], now=NOW)
+    assert cache.reads[-1] == (int(NOW.timestamp()) - cache.overlap_seconds, 3)
+    _assert_same_flights(third, ['EWR', 'JFK'])
+
+
+def test_snapshot_full_refresh(flights_table, cache):
+    cache.query_active_flights_by_airport(TABLE_NAME, ['EWR'], now=NOW)
+    flights_table.delete_item(Key={'flight_id': 'FL10'})
+
+    assert 'FL10' in cache.query_active_flights_by_airport(TABLE_NAME, ['EWR'], now=NOW)['EWR']['flight_id']
+
+    later = NOW + pd.Timedelta(hours=cache.full_refresh_hours)
+    refreshed = cache.query_active_flights_by_airport(TABLE_NAME, ['EWR'], now=later)['EWR']
+    assert cache.reads[-1][0] is None
+    assert 'FL10' not in refreshed['flight_id']
+
+
+def test_snapshot_eviction(flights_table, cache):
+    cache.query_active_flights_by_airport(TABLE_NAME, ['EWR'], now=NOW)
+
+    later = NOW + pd.Timedelta(hours=4)
+    flights = cache.query_active_flights_by_airport(TABLE_NAME, ['EWR'], now=later)['EWR']
+    # landed: sched_landing_time more than an hour before 01:00
+    assert sorted(flights['flight_id']) == sorted(f"FL{i}" for i in range(6, 20, 2))
+
+    cache.expire_hours = 2
+    assert len(cache.query_active_flights_by_airport(TABLE_NAME, ['EWR'], now=later)['EWR']) == 0
+
+
+def test_snapshot_string_timestamps(flights_table, cache):
+    cache.query_active_flights_by_airport(TABLE_NAME, ['EWR'], now=NOW)
+    item = _item('FL200', 'EWR', 2, last_msg_hours=0)
+    item['last_msg_time'] = str(item['last_msg_time'])  # unix times are also stored as strings
+    flights_table.put_item(Item=item)
+
+    flights = cache.query_active_flights_by_airport(TABLE_NAME, ['EWR'], now=NOW)['EWR']
+    assert 'FL200' in flights['flight_id']
+
+
+def test_snapshot_unreadable_file(flights_table, cache):
+    cache.query_active_flights_by_airport(TABLE_NAME, ['EWR'], now=NOW)
+    with open(cache.path(TABLE_NAME, 'EWR'), 'wb') as snapshot_file:
+        snapshot_file.write(b'not a snapshot')
+
+    flights = cache.query_active_flights_by_airport(TABLE_NAME, ['EWR'], now=NOW)['EWR']
+    assert cache.reads[-1][0] is None and len(flights) == 9
+
+
+def test_snapshot_roundtrip(flights_table, cache):
+    flights = cache.query_active_flights_by_airport(TABLE_NAME, ['JFK'], now=NOW)['JFK']
+    loaded, meta = cache.load(TABLE_NAME, 'JFK')
+
+    pd.testing.assert_frame_equal(loaded.to_pandas(), flights.to_pandas())
+    assert meta['high_water_mark'] == int(NOW.timestamp()) - 3600
+    assert np.array_equal(loaded['airport'][1], ['JFK'])
@@ -0,0 +1,280 @@
+import json
+import os
+from datetime import datetime, timezone, timedelta
+
+import boto3
+import numpy as np
+import pandas as pd
+import pytest
+
+from dependencies.utils.dynamodb_utils import clean_active_flights, decode_flight_items, PIPELINE_COLUMNS, \
+    _to_frame_columns
+from dependencies.utils.flight_msg_utils import calculate_demand_from_flights
+from dependencies.utils.dynamodb_reader import DYNAMODB_REGION, _describe_table, get_dynamodb_client
+from dependencies.utils.incremental_demand import IncrementalDemand, replay_stream_file, S3StateStore
+
+NOW = datetime(2023, 3, 24, 21, 30, tzinfo=timezone.utc)
+
+
+def _image(flight_id, sched_landing_hours, est_arrival_hours=None, etd_type='ACTUAL', msg_trigger='HCS_TRACK_MSG',
+           airport='EWR'):
+    sched_landing_time = int((NOW + timedelta(hours=sched_landing_hours)).timestamp())
+    est_arrival_hours = sched_landing_hours if est_arrival_hours is None else est_arrival_hours
+    est_arrival_time = int((NOW + timedelta(hours=est_arrival_hours)).timestamp())
+    return {'flight_id': {'S': flight_id}, 'airport': {'S': airport}, 'msg_trigger': {'S': msg_trigger},
+            'est_dept_time_type': {'S': etd_type}, 'sched_landing_time': {'N': str(sched_landing_time)},
+            'est_arrival_time': {'N': str(est_arrival_time)}}
+
+
+def _record(event_name, image):
+    change = {'Keys': {'flight_id': image['flight_id']}}
+    if event_name != 'REMOVE':
+        change['NewImage'] = image
+    return {'eventName': event_name, 'dynamodb': change}
+
+
+def _batch_demand(images, now):
+    # the airport filter is applied by query_active_flights
+    images = [image for image in images if image['airport']['S'] == 'EWR']
+    frame = pd.DataFrame(_to_frame_columns(decode_flight_items(images, PIPELINE_COLUMNS)), copy=False)
+    return calculate_demand_from_flights(clean_active_flights(frame, now), now)
+
+
+def _records():
+    return [
+        _record('INSERT', _image('FL1', 1)),
+        _record('INSERT', _image('FL2', 2)),
+        _record('INSERT', _image('FL3', 2, etd_type='SCHEDULED')),
+        _record('INSERT', _image('FL4', 3, airport='JFK')),
+        _record('INSERT', _image('FL5', 5)),
+        # delayed by two hours
+        _record('MODIFY', _image('FL1', 1, est_arrival_hours=3)),
+        # cancelled
+        _record('MODIFY', _image('FL2', 2, msg_trigger='FD_FLIGHT_CANCEL_MSG')),
+        # not departed, estimated to arrive in the past
+        _record('INSERT', _image('FL6', 0, est_arrival_hours=-1, etd_type='PROPOSED')),
+        _record('REMOVE', _image('FL5', 5)),
+        _record('INSERT', _image('FL7', 4)),
+    ]
+
+
+def _final_images(records):
+    images = {}
+    for record in records:
+        key = record['dynamodb']['Keys']['flight_id']['S']
+        if record['eventName'] == 'REMOVE':
+            images.pop(key, None)
+        else:
+            images[key] = record['dynamodb']['NewImage']
+    return list(images.values())
+
+
+def test_incremental_demand_matches_batch():
+    records = _records()
+    state = IncrementalDemand('EWR', ['flight_id'])
+    state.apply_records(records, NOW)
+
+    expected = _batch_demand(_final_images(records), NOW)
+    pd.testing.assert_frame_equal(state.demand(NOW), expected, check_dtype=False)
+    # FL1 delayed but still scheduled at 22:30, FL3 at 23:30 and FL7 at 01:30
+    assert state.demand(NOW).demand.tolist()[:5] == [0, 1, 1, 0, 1]
+
+
+def test_incremental_demand_expires_stale_flights():
+    records = _records()
+    state = IncrementalDemand('EWR', ['flight_id'])
+    state.apply_records(records, NOW)
+
+    later = NOW + timedelta(hours=2, minutes=45)
+    expected = _batch_demand(_final_images(records), later)
+    pd.testing.assert_frame_equal(state.demand(later), expected, check_dtype=False)
+    # FL3 has not departed and was estimated to arrive 2 hours from NOW, FL1 is before the horizon
+    assert state.demand(later).demand.sum() == 1
+
+
+def test_incremental_demand_seeded_from_flights():
+    images = _final_images(_records())
+    frame = pd.DataFrame(_to_frame_columns(decode_flight_items(images)), copy=False)
+
+    state = IncrementalDemand.from_flights(frame, 'EWR', ['flight_id'], NOW)
+    state.apply_record(_record('MODIFY', _image('FL7', 6)), NOW)
+
+    images[-1] = _image('FL7', 6)
+    pd.testing.assert_frame_equal(state.demand(NOW), _batch_demand(images, NOW), check_dtype=False)
+
+
+def test_replay_stream_file_and_state_round_trip(tmp_path):
+    records = _records()
+    stream_path = tmp_path / 'stream.json'
+    stream_path.write_text('\n'.join(json.dumps(record) for record in records))
+    state_path = tmp_path / 'state.json'
+
+    state = replay_stream_file(str(stream_path), 'EWR', ['flight_id'], now=NOW)
+    state.save(str(state_path))
+    restored = IncrementalDemand.load(str(state_path))
+
+    later = NOW + timedelta(hours=3)
+    pd.testing.assert_frame_equal(restored.demand(later), state.demand(later))
+    assert np.array_equal(restored.demand(NOW).demand[:5], [0, 1, 0, 0, 1])
+
+
+@pytest.fixture
+def stream_aws():
+    """the active flights table holding the final images of `_records` (relative to the current time), and the
+    bucket of the demand states"""
+    moto = pytest.importorskip('moto')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        dynamodb = boto3.client('dynamodb', region_name=DYNAMODB_REGION)
+        dynamodb.create_table(TableName='ActiveFlightsTest',
+                              KeySchema=[{'AttributeName': 'flight_id', 'KeyType': 'HASH'}],
+                              AttributeDefinitions=[{'AttributeName': 'flight_id', 'AttributeType': 'S'}],
+                              BillingMode='PAY_PER_REQUEST')
+        s3 = boto3.client('s3', region_name=DYNAMODB_REGION)
+        s3.create_bucket(Bucket='demand-state')
+        yield dynamodb, s3
+    _describe_table.cache_clear()
+    get_dynamodb_client.cache_clear()
+
+
+def _shifted(image, now):
+    # the images of `_image` moved from NOW to `now`
+    shift = int(now.timestamp()) - int(NOW.timestamp())
+    return dict(image, **{column: {'N': str(int(image[column]['N']) + shift)}
+                          for column in ['sched_landing_time', 'est_arrival_time']})
+
+
+def test_s3_state_store_conditional_save(stream_aws):
+    _, s3 = stream_aws
+    store = S3StateStore('demand-state', client=s3)
+    state = IncrementalDemand('EWR', ['flight_id'])
+    state.apply_records(_records(), NOW)
+
+    assert store.load('EWR') == (None, None)
+    assert store.save('EWR', state, None)
+    assert not store.save('EWR', state, None)
+    loaded, token = store.load('EWR')
+    loaded.apply_record(_record('REMOVE', _image('FL7', 4)), NOW)
+    assert store.save('EWR', loaded, token)
+    # saved by another invocation since it was loaded
+    assert not store.save('EWR', state, token)
+    pd.testing.assert_frame_equal(store.load('EWR')[0].demand(NOW), loaded.demand(NOW))
+
+
+def test_stream_handler_shared_state(stream_aws, tmp_path, monkeypatch):
+    import calculate_demand
+    from aerology_influxdb_api.testing import InfluxStub
+
+    dynamodb, s3 = stream_aws
+    now = datetime.now(timezone.utc)
+    images = [_shifted(image, now) for image in _final_images(_records())]
+    for image in images:
+        dynamodb.put_item(TableName='ActiveFlightsTest', Item=image)
+    update = _record('MODIFY', _shifted(_image('FL7', 6), now))
+
+    def demand_lines(stub, airport):
+        return [line for line in stub.lines if line.startswith(f"demand,airport={airport} ")]
+
+    with InfluxStub() as stub:
+        config = stub.write_config(tmp_path / 'config.json', airports=[
+            {"short_name": airport, "influx_bucket": "aerology.test", "lane_names": []} for airport in ['EWR', 'JFK']],
+            demand_airport_tag=True)
+        monkeypatch.setattr(calculate_demand, 'INFLUX_CONFIG_PATH', config)
+        monkeypatch.setattr(calculate_demand, '_influxdb_client', None)
+        monkeypatch.setattr(calculate_demand, 'DB_TABLE', 'ActiveFlightsTest')
+        monkeypatch.setattr(calculate_demand, 'DEMAND_STATE_BUCKET', 'demand-state')
+
+        # the first batch seeds the states of both airports from the table
+        calculate_demand.lambda_demand_stream_handler({'Records': []}, None)
+        seeded, _ = S3StateStore('demand-state', client=s3).load('EWR')
+        first = demand_lines(stub, 'EWR')
+
+        # the next batch applies its records to the stored state, whichever container it runs in
+        monkeypatch.setattr(calculate_demand, '_influxdb_client', None)
+        dynamodb.put_item(TableName='ActiveFlightsTest', Item=update['dynamodb']['NewImage'])
+        calculate_demand.lambda_demand_stream_handler({'Records': [update]}, None)
+        second = demand_lines(stub, 'EWR')[len(first):]
+        calculate_demand._get_influxdb_client().close()
+
+    assert seeded.seeded_time == pytest.approx(now.timestamp(), abs=60)
+    expected = _batch_demand(images, now)
+    assert [int(line.split('=')[2].split('i')[0]) for line in first] == expected['demand'].tolist()
+    images[-1] = update['dynamodb']['NewImage']
+    assert [int(line.split('=')[2].split('i')[0]) for line in second] == _batch_demand(images, now)['demand'].tolist()
+    assert len(demand_lines(stub, 'JFK')) == 2 * len(first)
+
+
+def test_stream_handler_reseeds_old_state(stream_aws, tmp_path, monkeypatch):
+    import calculate_demand
+    from aerology_influxdb_api.testing import InfluxStub
+
+    dynamodb, s3 = stream_aws
+    store = S3StateStore('demand-state', client=s3)
+    stale = IncrementalDemand('EWR', ['flight_id'])
+    stale.seeded_time = int(datetime.now(timezone.utc).timestamp()) - 7 * 3600
+    stale.apply_records([_record('INSERT', _shifted(_image('FL9', 2), datetime.now(timezone.utc)))])
+    store.save('EWR', stale, None)
+
+    with InfluxStub() as stub:
+        monkeypatch.setattr(calculate_demand, 'INFLUX_CONFIG_PATH', stub.write_config(tmp_path / 'config.json'))
+        monkeypatch.setattr(calculate_demand, '_influxdb_client', None)
+        monkeypatch.setattr(calculate_demand, 'DB_TABLE', 'ActiveFlightsTest')
+        monkeypatch.setattr(calculate_demand, 'DEMAND_STATE_BUCKET', 'demand-state')
+        calculate_demand.lambda_demand_stream_handler({'Records': [], 'airports': ['ewr']}, None)
+        calculate_demand._get_influxdb_client().close()
+
+    # the state was older than DEMAND_STATE_MAX_AGE_HOURS, it is seeded again from the (empty) table
+    assert all(line.startswith('demand demand=0i ') for line in stub.lines)
+    assert store.load('EWR')[0].seeded_time > stale.seeded_time
+
+
+def test_update_demand_state_retries_on_conflict(stream_aws):
+    import calculate_demand
+
+    _, s3 = stream_aws
+    store = S3StateStore('demand-state', client=s3)
+    now = datetime.now(timezone.utc)
+    state = IncrementalDemand.from_flights(pd.DataFrame(columns=PIPELINE_COLUMNS + ['flight_id']), 'EWR',
+                                           ['flight_id'], now)
+    store.save('EWR', state, None)
+    ours = _record('INSERT', _shifted(_image('FL1', 1), now))
+    theirs = _record('INSERT', _shifted(_image('FL2', 3), now))
+
+    class ConcurrentStore:
+        """another invocation saves its batch between our load and our first save"""
+
+        def __init__(self):
+            self.saves = 0
+
+        def load(self, airport):
+            return store.load(airport)
+
+        def save(self, airport, demand_state, token):
+            self.saves += 1
+            if self.saves == 1:
+                other, other_token = store.load(airport)
+                other.apply_records([theirs], now)
+                assert store.save(airport, other, other_token)
+            return store.save(airport, demand_state, token)
+
+    concurrent_store = ConcurrentStore()
+    demand = calculate_demand._update_demand_state(concurrent_store, 'EWR', [ours], ['flight_id'], None, now)
+
+    # the records of both invocations are in the saved state
+    assert concurrent_store.saves == 2
+    assert demand['demand'].sum() == 2
+    pd.testing.assert_frame_equal(store.load('EWR')[0].demand(now), demand)
+
+
+def test_seed_flights_projection_without_repeated_paths(monkeypatch):
+    import calculate_demand
+    from dependencies.utils import dynamodb_utils
+
+    projections = []
+    monkeypatch.setattr(dynamodb_utils, 'query_active_flights',
+                        lambda *args, **kwargs: projections.append(kwargs['columns']) or pd.DataFrame())
+    # a table keyed by airport and flight_id, airport is also a pipeline column
+    calculate_demand._SeedFlights(['EWR'], ['airport', 'flight_id']).flights()
+
+    assert projections == [['airport', 'flight_id'] + [column for column in PIPELINE_COLUMNS if column != 'airport']]
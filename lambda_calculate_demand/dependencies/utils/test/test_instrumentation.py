@@ -0,0 +1,145 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import boto3
+import pytest
+
+from dependencies.utils import instrumentation
+from dependencies.utils.dynamodb_reader import DYNAMODB_REGION, _describe_table, get_dynamodb_client
+
+moto = pytest.importorskip('moto')
+
+TABLE_NAME = 'ActiveFlightsTest'
+
+
+@pytest.fixture
+def flights_table():
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    now = int(datetime.now(timezone.utc).timestamp())
+    with moto.mock_aws():
+        table = boto3.resource('dynamodb', region_name=DYNAMODB_REGION).create_table(
+            TableName=TABLE_NAME,
+            KeySchema=[{'AttributeName': 'flight_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'flight_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        for i in range(30):
+            table.put_item(Item={'flight_id': f"FL{i}", 'airport': ['EWR', 'JFK'][i % 2],
+                                 'msg_trigger': ['HCS_TRACK_MSG', 'FD_FLIGHT_CANCEL_MSG'][i % 10 == 0],
+                                 'est_dept_time_type': 'ACTUAL', 'sched_landing_time': now + i * 600,
+                                 'est_arrival_time': now + i * 600, 'last_msg_time': now})
+        yield table
+    _describe_table.cache_clear()
+    get_dynamodb_client.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def no_active_run():
+    yield
+    instrumentation.finish_run()
+
+
+def test_disabled_is_a_noop():
+    assert not instrumentation.enabled()
+    with instrumentation.stage('clean') as clean:
+        clean.add(rows_in=10)
+    instrumentation.count('dynamodb', pages=1)
+    assert instrumentation.stage('demand') is instrumentation.stage('clean')
+    assert instrumentation.finish_run() is None
+
+
+def test_stages_add_up_across_threads():
+    metrics = instrumentation.start_run(Function='test')
+
+    def clean(rows):
+        with instrumentation.stage('clean') as stage:
+            stage.add(rows_in=rows, rows_out=rows - 1)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(clean, range(1, 9)))
+    instrumentation.count('dynamodb', pages=2, bytes=1000)
+    assert instrumentation.finish_run() is metrics
+
+    assert metrics.stages['clean']['calls'] == 8
+    assert metrics.stages['clean']['rows_in'] == 36 and metrics.stages['clean']['rows_out'] == 28
+    assert metrics.stages['clean']['peak_rss_bytes'] == max(metrics.stages['clean']['peak_rss_bytes'], 1)
+
+    record = metrics.emf_record(namespace='Test', run_time='2023-03-24T21:30:00+00:00')
+    directive, = record['_aws']['CloudWatchMetrics']
+    assert directive['Namespace'] == 'Test' and directive['Dimensions'] == [['Function']]
+    units = {metric['Name']: metric['Unit'] for metric in directive['Metrics']}
+    assert units['clean.seconds'] == 'Seconds' and units['dynamodb.bytes'] == 'Bytes'
+    assert units['clean.rows_in'] == 'Count'
+    assert record['Function'] == 'test' and record['dynamodb.pages'] == 2 and record['run_time']
+    json.dumps(record)
+
+
+def test_lambda_run_metrics(flights_table, tmp_path, monkeypatch, capsys):
+    import calculate_demand
+    from aerology_influxdb_api.testing import InfluxStub
+
+    with InfluxStub() as stub:
+        config = stub.write_config(tmp_path / 'config.json', metrics_bucket='aerology.metrics', airports=[
+            {"short_name": airport, "influx_bucket": "aerology.test", "lane_names": []} for airport in ['EWR', 'JFK']],
+            demand_airport_tag=True)
+        monkeypatch.setattr(calculate_demand, 'INFLUX_CONFIG_PATH', config)
+        monkeypatch.setattr(calculate_demand, '_influxdb_client', None)
+        monkeypatch.setattr(calculate_demand, 'DB_TABLE', TABLE_NAME)
+        monkeypatch.setattr(calculate_demand, 'PIPELINE_METRICS', True)
+
+        calculate_demand.lambda_demand_calculator({}, None)
+        calculate_demand._get_influxdb_client().close()
+
+    record = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    stages = record['stages']
+    assert set(stages) == {'read', 'dynamodb', 'clean', 'demand', 'write'}
+    assert stages['read']['rows_out'] == 30 and stages['dynamodb']['items'] == 30 and stages['dynamodb']['pages'] >= 1
+    assert stages['dynamodb']['read_capacity_units'] > 0
+    assert 'bytes' in stages['dynamodb']  # content-length of the responses, not set by moto
+    assert stages['clean']['calls'] == 2 and stages['clean']['rows_in'] == 30 and stages['clean']['rows_out'] == 27
+    assert stages['write']['points'] == stages['demand']['rows_out'] and stages['write']['requests'] == 1
+
+    metric_lines = [line for line in stub.lines if line.startswith('pipeline_metrics,')]
+    assert len(metric_lines) == len(stages)
+    assert all(',function=lambda_demand_calculator,' in line for line in metric_lines)
+    metric_request, = [request for request in stub.requests if request['query']['bucket'] == ['aerology.metrics']]
+    assert b'stage=write' in metric_request['body']
+    assert not instrumentation.enabled()
+
+
+@pytest.mark.parametrize('backend', ['pandas', 'numpy'])
+def test_lambda_airports_and_streaming(flights_table, tmp_path, monkeypatch, backend):
+    import calculate_demand
+    from aerology_influxdb_api.testing import InfluxStub
+
+    reads = []
+    with InfluxStub() as stub:
+        config = stub.write_config(tmp_path / 'config.json', airports=[
+            {"short_name": airport, "influx_bucket": "aerology.test", "lane_names": []} for airport in ['EWR', 'JFK']],
+            demand_airport_tag=True)
+        monkeypatch.setattr(calculate_demand, 'INFLUX_CONFIG_PATH', config)
+        monkeypatch.setattr(calculate_demand, '_influxdb_client', None)
+        monkeypatch.setattr(calculate_demand, 'DB_TABLE', TABLE_NAME)
+        monkeypatch.setattr(calculate_demand, 'DEMAND_BACKEND', backend)
+
+        # only unknown airports: nothing is read, nothing is written
+        assert calculate_demand.lambda_demand_calculator({'airports': ['LGA']}, None) == {"statusCode": 200}
+        assert stub.requests == []
+
+        calculate_demand.lambda_demand_calculator({'airports': ['ewr', 'jfk', 'EWR']}, None)
+        read_lines = list(stub.lines)
+
+        module = calculate_demand._demand_backend()
+        iter_active_flight_pages = module.iter_active_flight_pages
+        monkeypatch.setattr(module, 'iter_active_flight_pages',
+                            lambda *args, **kwargs: reads.append(args[1]) or iter_active_flight_pages(*args, **kwargs))
+        monkeypatch.setattr(calculate_demand, 'DEMAND_STREAMING', True)
+        calculate_demand.lambda_demand_calculator({'airports': ['ewr', 'jfk']}, None)
+        calculate_demand._get_influxdb_client().close()
+
+    # the streaming mode reads the table once for both airports, and gives the same demand
+    assert reads == [['EWR', 'JFK']]
+    assert stub.lines[len(read_lines):] == read_lines
+    assert {line.split(' ')[0] for line in read_lines} == {'demand,airport=EWR', 'demand,airport=JFK'}